@@ -0,0 +1,319 @@
+'''
+Summarizes negotiation results of any size in bounded memory and redraws the figures of results_plots
+Reads the results of negotiations, in the columns of results_for_plot_no_headers.csv as simulate.py writes them,
+from CSV (with or without a header), JSON lines or Parquet files, a chunk of rows at a time. Every chunk is reduced
+with NumPy group-bys into running totals, so memory depends on the number of distinct parameter values only. The
+summary tables are written as tab separated files, then the gnuplot scripts of code_for_plot draw the figures
+from them, without a display (pngcairo). Without gnuplot installed only the tables are written.
+Run from the bargain directory, e.g.
+    python aggregate.py simulation_results.csv --output ../results_plots
+    python aggregate.py ../results_for_plot_no_headers.csv shard-*.parquet --chunk-size 200000
+Tables, every metric a mean unless named otherwise:
+    summary.tsv         by buyer strategy: negotiations, success rate, agent and buyer utility, iterations,
+                        iterations of the successes, profit, amount saved, agent utility of the initial offer and
+                        target utility of the rounds, the last three over the results that have them
+    by_<parameter>.tsv  the same by value of max_initial_discount_rate, min_profit_margin and num_rounds, and strategy
+    success.tsv         negotiations by outcome
+    iterations.tsv      negotiations and successes by number of iterations
+    au_vs_bu.tsv        negotiations by agent and buyer utility, in a grid of bins over [0, 1]
+'''
+
+from __future__ import division, print_function
+
+import argparse
+import csv
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import simulate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PARAMETERS = ["max_initial_discount_rate", "min_profit_margin", "num_rounds"]
+# running sums of every group, and the metrics derived from them
+SUMS = ["negotiations", "successes", "agent_utility", "buyer_utility", "iterations", "closing_iterations", "profit",
+        "profits", "amount_saved", "initial_agent_utility", "initial_agent_utilities", "target_utility",
+        "target_utilities"]
+METRICS = ["negotiations", "success_rate", "agent_utility", "buyer_utility", "iterations", "iterations_to_close",
+           "profit", "amount_saved", "initial_agent_utility", "target_utility"]
+# columns of the results written by later versions of simulate.py, averaged over the results that have them
+OPTIONAL = ["profit", "initial_agent_utility", "target_utility"]
+# gnuplot script, table and figure of every plot
+PLOTS = [("AUvsBU.txt", "au_vs_bu.tsv", "AUvsBU.png"), ("success.txt", "success.tsv", "Success.png"),
+         ("Iterations.txt", "iterations.tsv", "Iterations.png"),
+         ("MinimumProfitMargin.txt", "by_min_profit_margin.tsv", "MinimumProfitMargin.png"),
+         ("MaximumInitialDiscount.txt", "by_max_initial_discount_rate.tsv", "MaximumDiscountRate.png"),
+         ("Delta.txt", None, "Delta.png")]
+
+
+def readChunks(path, chunk_size=100000):
+    '''
+    Parameters:
+        path        - CSV, JSON lines (.jsonl) or Parquet (.parquet) file of negotiation results
+        chunk_size  - number of rows per chunk
+    Returns:
+        generator of chunks, dictionaries of column name to the list of values of the chunk
+    '''
+
+    if path.endswith(".parquet"):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("reading %s requires pyarrow: pip install pyarrow" % path)
+        for chunk in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield chunk.to_pydict()
+        return
+
+    if path.endswith(".jsonl"):
+        with open(path) as results_file:
+            rows = []
+            for line in results_file:
+                if line.strip():
+                    rows.append(json.loads(line))
+                if len(rows) == chunk_size:
+                    yield dict((name, [row.get(name) for row in rows]) for name in rows[0])
+                    rows = []
+            if rows:
+                yield dict((name, [row.get(name) for row in rows]) for name in rows[0])
+        return
+
+    with open(path) as results_file:
+        reader = csv.reader(results_file)
+        names = None
+        rows = []
+        for row in reader:
+            if not row:
+                continue
+            if names is None:
+                # the columns of simulate.py, named by a header or in their order
+                if row[0] == simulate.RESULT_COLUMNS[0]:
+                    names = row
+                    continue
+                names = simulate.RESULT_COLUMNS[:len(row)]
+            rows.append(row)
+            if len(rows) == chunk_size:
+                yield dict(zip(names, zip(*rows)))
+                rows = []
+        if rows:
+            yield dict(zip(names, zip(*rows)))
+
+
+def numbers(values):
+    '''
+    Returns:
+        the values as a float array, nan where they are not numbers
+    '''
+
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        parsed = []
+        for value in values:
+            try:
+                parsed.append(float(value))
+            except (TypeError, ValueError):
+                parsed.append(np.nan)
+        return np.array(parsed)
+
+
+def formatValue(value):
+    if isinstance(value, float):
+        return "NaN" if np.isnan(value) else "%.6g" % value
+    return str(value)
+
+
+def writeTable(path, columns, rows):
+    with open(path, "w") as table_file:
+        # a comment for gnuplot
+        table_file.write("# " + "\t".join(columns) + "\n")
+        for row in rows:
+            table_file.write("\t".join(formatValue(value) for value in row) + "\n")
+
+
+class ResultSummary:
+    def __init__(self, bins=50):
+        '''
+        Parameters:
+            bins    - bins of each utility in the agent vs buyer utility grid
+        '''
+
+        # (parameter, value, strategy) -> running sums, the overall sums under parameter None
+        self.groups = {}
+        self.iterations = np.zeros((0, 2))
+        self.grid = np.zeros((bins, bins))
+        self.bins = bins
+        self.parameters = set()
+        self.rows = 0
+
+    def add(self, chunk):
+        '''
+        Adds a chunk of results to the running totals
+        Parameters:
+            chunk   - dictionary of column name to the values of the chunk, as readChunks returns
+        '''
+
+        agent_utility = numbers(chunk["agent_utility"])
+        n = len(agent_utility)
+        buyer_utility = numbers(chunk["buyer_utility"])
+        iterations = numbers(chunk["iterations"]).astype(np.int64)
+        success = numbers(chunk["success"])
+        optional = {}
+        for name in OPTIONAL:
+            values = numbers(chunk[name]) if name in chunk else np.full(n, np.nan)
+            known = ~np.isnan(values)
+            optional[name] = [np.where(known, values, 0), known]
+        weights = [np.ones(n), success, agent_utility, buyer_utility, iterations, iterations * success] + \
+            optional["profit"] + [numbers(chunk["amount_saved"])] + optional["initial_agent_utility"] + \
+            optional["target_utility"]
+        # every group is summed over all strategies and by strategy
+        splits = [(["all"], np.zeros(n, dtype=np.intp))]
+        if "strategy" in chunk:
+            splits.append(np.unique(np.asarray(chunk["strategy"], dtype=str), return_inverse=True))
+
+        groupings = [(None, np.zeros(n))]
+        for parameter in PARAMETERS:
+            if parameter in chunk:
+                self.parameters.add(parameter)
+                groupings.append((parameter, numbers(chunk[parameter])))
+        for parameter, values in groupings:
+            keys, value_index = np.unique(values, return_inverse=True)
+            for names, index in splits:
+                group = value_index * len(names) + index
+                sums = np.column_stack([np.bincount(group, weight, minlength=len(keys) * len(names))
+                                        for weight in weights])
+                for g in np.flatnonzero(sums[:, 0]):
+                    key = (parameter, float(keys[g // len(names)]), str(names[g % len(names)]))
+                    self.groups[key] = self.groups.get(key, 0) + sums[g]
+
+        counts = np.column_stack([np.bincount(iterations), np.bincount(iterations, success)])
+        if len(counts) > len(self.iterations):
+            self.iterations = np.concatenate([self.iterations, np.zeros((len(counts) - len(self.iterations), 2))])
+        self.iterations[:len(counts)] += counts
+        # utilities outside [0, 1] count in the edge bins
+        self.grid += np.histogram2d(np.clip(agent_utility, 0, 1), np.clip(buyer_utility, 0, 1), bins=self.bins,
+                                    range=[[0, 1], [0, 1]])[0]
+        self.rows += n
+
+    @staticmethod
+    def metrics(sums):
+        totals = dict(zip(SUMS, sums))
+        count = totals["negotiations"]
+        return [int(count), totals["successes"] / count, totals["agent_utility"] / count,
+                totals["buyer_utility"] / count, totals["iterations"] / count,
+                totals["closing_iterations"] / totals["successes"] if totals["successes"] else np.nan,
+                totals["profit"] / totals["profits"] if totals["profits"] else np.nan, totals["amount_saved"] / count,
+                totals["initial_agent_utility"] / totals["initial_agent_utilities"]
+                if totals["initial_agent_utilities"] else np.nan,
+                totals["target_utility"] / totals["target_utilities"] if totals["target_utilities"] else np.nan]
+
+    def strategies(self):
+        # all first, as the plots draw them
+        names = set(strategy for _, _, strategy in self.groups)
+        return ["all"] + sorted(names - set(["all"]))
+
+    def write(self, directory):
+        '''
+        Writes the summary tables to the directory
+        Returns:
+            list of the names of the tables written
+        '''
+
+        strategies = self.strategies()
+        writeTable(os.path.join(directory, "summary.tsv"), ["strategy"] + METRICS,
+                   [[strategy] + self.metrics(self.groups[(None, 0.0, strategy)]) for strategy in strategies])
+        tables = ["summary.tsv"]
+        for parameter in PARAMETERS:
+            if parameter not in self.parameters:
+                continue
+            rows = []
+            for strategy in strategies:
+                for value in sorted(value for name, value, group_strategy in self.groups
+                                    if name == parameter and group_strategy == strategy):
+                    rows.append([value, strategy] + self.metrics(self.groups[(parameter, value, strategy)]))
+            writeTable(os.path.join(directory, "by_%s.tsv" % parameter), ["value", "strategy"] + METRICS, rows)
+            tables.append("by_%s.tsv" % parameter)
+
+        overall = dict(zip(SUMS, self.groups[(None, 0.0, "all")]))
+        writeTable(os.path.join(directory, "success.tsv"), ["success", "negotiations"],
+                   [[0, int(overall["negotiations"] - overall["successes"])], [1, int(overall["successes"])]])
+        writeTable(os.path.join(directory, "iterations.tsv"), ["iterations", "negotiations", "successes"],
+                   [[i, int(count), int(successes)] for i, (count, successes) in enumerate(self.iterations)
+                    if count])
+        centers = (np.arange(self.bins) + 0.5) / self.bins
+        agent_bins, buyer_bins = np.nonzero(self.grid)
+        writeTable(os.path.join(directory, "au_vs_bu.tsv"), ["agent_utility", "buyer_utility", "negotiations"],
+                   [[float(centers[i]), float(centers[j]), int(self.grid[i, j])] for i, j in zip(agent_bins, buyer_bins)])
+        return tables + ["success.tsv", "iterations.tsv", "au_vs_bu.tsv"]
+
+
+def findGnuplot():
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        path = os.path.join(directory, "gnuplot")
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def drawPlots(directory, tables, strategies, exponent=-2.2, scripts=os.path.join(ROOT, "code_for_plot")):
+    '''
+    Draws the figures of the tables written to the directory with the gnuplot scripts
+    Parameters:
+        tables      - names of the tables written
+        strategies  - buyer strategies drawn as separate lines
+        exponent    - learning rate exponent of the agent, drawn by Delta.txt
+    Returns:
+        list of the figures drawn, None without gnuplot
+    '''
+
+    gnuplot = findGnuplot()
+    if gnuplot is None:
+        return None
+    drawn = []
+    for script, table, figure in PLOTS:
+        if table is not None and table not in tables:
+            continue
+        variables = "output='%s'; strategies='%s'; exponent=%r" % (
+            os.path.join(directory, figure), " ".join(strategies), exponent)
+        if table is not None:
+            variables += "; data='%s'" % os.path.join(directory, table)
+        if subprocess.call([gnuplot, "-e", variables, os.path.join(scripts, script)]) == 0:
+            drawn.append(figure)
+    return drawn
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("results", nargs="+", help="result files of simulate.py, .csv, .jsonl or .parquet")
+    parser.add_argument("--output", default=os.path.join(ROOT, "results_plots"), help="directory of tables and figures")
+    parser.add_argument("--chunk-size", type=int, default=100000, help="rows read at a time")
+    parser.add_argument("--bins", type=int, default=50, help="bins of each utility in au_vs_bu.tsv")
+    parser.add_argument("--config", help="AgentConfig saved by optimize.py, its learning rate exponent is drawn")
+    parser.add_argument("--no-plots", action="store_true", help="only write the tables")
+    args = parser.parse_args()
+
+    start = time.time()
+    summary = ResultSummary(args.bins)
+    for path in args.results:
+        for chunk in readChunks(path, args.chunk_size):
+            summary.add(chunk)
+    if not summary.rows:
+        sys.exit("no results in %s" % ", ".join(args.results))
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    tables = summary.write(args.output)
+    print("%d negotiations summarized in %.2f s: %s" % (summary.rows, time.time() - start, ", ".join(tables)))
+
+    if not args.no_plots:
+        exponent = -2.2
+        if args.config:
+            import bargain as bg
+            exponent = bg.AgentConfig.load(args.config).learning_rate_exponent
+        drawn = drawPlots(args.output, tables, summary.strategies(), exponent)
+        if drawn is None:
+            print("gnuplot not found, the figures were not drawn", file=sys.stderr)
+        else:
+            print("Drew %s in %s" % (", ".join(drawn), args.output))
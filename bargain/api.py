@@ -0,0 +1,140 @@
+'''
+JSON negotiation API, keyed by session and product ids
+main.py serves it next to the HTML views; on its own (gunicorn api:app) it skips templates entirely and can
+run on async workers, e.g. GUNICORN_WORKER_CLASS=gevent gunicorn -c gunicorn.conf.py api:app
+
+POST /api/negotiations                          {"product_id": 3}               start a negotiation
+POST /api/negotiations/<session_id>/offers      {"bundle": [4, 5], "cost": 40000} make a counter-offer
+POST /api/negotiations/<session_id>/accept                                      accept the agent's offer
+POST /api/negotiations/<session_id>/reject                                      buy the product alone
+'''
+
+import math
+import numbers
+
+from flask import Blueprint, Flask, Response, jsonify, request
+import history
+import instrument
+import sessions
+from sessions import product_list
+
+blueprint = Blueprint('api', __name__, url_prefix='/api')
+
+
+def offer_response(session_id, agent, offer, status=200):
+    bundle = [int(i) for i in offer["Bundle"]]
+    # priced as the negotiation started
+    selling_price = sessions.negotiationPrices(agent.price_version).priceDicts()[0]
+    total_selling_price = sum(selling_price[product_list[i]] for i in bundle)
+    possible_items = sessions.recommender.getListOfPossibleItems(bundle[-1])
+    return jsonify({"session_id": session_id,
+                    "offer": {"bundle": bundle, "cost": offer["Cost"], "accepted": bool(offer["Accepted"])},
+                    "amount_saved": total_selling_price - offer["Cost"],
+                    "possible_items": [int(i) for i in possible_items]}), status
+
+
+def error_response(message, status):
+    return jsonify({"error": message}), status
+
+
+def read_product_id(value):
+    if isinstance(value, bool) or not isinstance(value, numbers.Integral) or not 0 <= value < len(product_list):
+        raise ValueError("unknown product id %r" % (value,))
+    return value
+
+
+@blueprint.route('/negotiations', methods=['POST'])
+def start():
+    body = request.get_json(silent=True) or {}
+    try:
+        product_idx = read_product_id(body.get("product_id"))
+    except ValueError as e:
+        return error_response(str(e), 400)
+
+    session_id = sessions.newSessionId()
+    agent, buyer, offer, offer_history = sessions.loadNegotiation(session_id)
+    proposed_offer = {"Bundle": [product_idx], "Cost": None}
+    offer = sessions.negotiate(session_id, agent, buyer, None, proposed_offer)
+    offer["Cost"] = round(offer["Cost"])
+    offer_history.append(offer, agent.last_round)
+    sessions.saveNegotiation(session_id, agent, buyer, offer, offer_history)
+    if offer["Accepted"]:
+        sessions.finishNegotiation(offer_history, "accepted")
+    return offer_response(session_id, agent, offer, 201)
+
+
+@blueprint.route('/negotiations/<string:session_id>/offers', methods=['POST'])
+def counter_offer(session_id):
+    agent, buyer, offer, offer_history = sessions.loadNegotiation(session_id)
+    if offer is None:
+        return error_response("unknown negotiation %s" % session_id, 404)
+    if offer["Accepted"]:
+        return error_response("negotiation %s is already accepted" % session_id, 409)
+
+    body = request.get_json(silent=True) or {}
+    try:
+        bundle = [read_product_id(i) for i in body.get("bundle", [])]
+        cost = body.get("cost")
+        if isinstance(cost, bool) or not isinstance(cost, numbers.Real):
+            raise ValueError("cost must be a number")
+        # json reads NaN and Infinity
+        if math.isnan(cost) or math.isinf(cost):
+            raise ValueError("cost must be finite")
+    except (TypeError, ValueError) as e:
+        return error_response(str(e), 400)
+
+    # the product the negotiation is about always comes last
+    product_idx = int(offer["Bundle"][-1])
+    bundle = [i for i in bundle if i != product_idx] + [product_idx]
+    if len(bundle) > history.MAX_ITEMS:
+        return error_response("a bundle has at most %d items" % history.MAX_ITEMS, 400)
+    proposed_offer = {"Bundle": bundle, "Cost": int(cost)}
+    offer_history.append(proposed_offer)
+    offer = sessions.negotiate(session_id, agent, buyer, offer, proposed_offer)
+    offer["Cost"] = round(offer["Cost"])
+    if offer["Cost"] <= proposed_offer["Cost"]:
+        offer["Accepted"] = True
+    offer_history.append(offer, agent.last_round)
+    sessions.saveNegotiation(session_id, agent, buyer, offer, offer_history)
+    if offer["Accepted"]:
+        sessions.finishNegotiation(offer_history, "accepted")
+    return offer_response(session_id, agent, offer)
+
+
+@blueprint.route('/negotiations/<string:session_id>/accept', methods=['POST'])
+def accept(session_id):
+    agent, buyer, offer, offer_history = sessions.loadNegotiation(session_id)
+    if offer is None:
+        return error_response("unknown negotiation %s" % session_id, 404)
+    sessions.deleteNegotiation(session_id)
+    if not offer["Accepted"]:
+        sessions.finishNegotiation(offer_history, "accepted")
+    offer["Accepted"] = True
+    return offer_response(session_id, agent, offer)
+
+
+@blueprint.route('/negotiations/<string:session_id>/reject', methods=['POST'])
+def reject(session_id):
+    agent, buyer, offer, offer_history = sessions.loadNegotiation(session_id)
+    if offer is None:
+        return error_response("unknown negotiation %s" % session_id, 404)
+    sessions.deleteNegotiation(session_id)
+    sessions.finishNegotiation(offer_history, "rejected")
+    product_idx = int(offer["Bundle"][-1])
+    selling_price = sessions.negotiationPrices(agent.price_version).priceDicts()[0]
+    return jsonify({"session_id": session_id, "product_id": product_idx,
+                    "cost": selling_price[product_list[product_idx]]})
+
+
+def metrics():
+    return Response(instrument.metricsText(), mimetype='text/plain; version=0.0.4')
+
+
+def get_app():
+    app = Flask(__name__)
+    app.register_blueprint(blueprint)
+    app.add_url_rule('/metrics', 'metrics', metrics)
+    return app
+
+
+app = get_app()
@@ -1,25 +1,347 @@
+from __future__ import division, print_function
+
 import numpy as np
-import cPickle as pickle
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import itertools
+import json
 import math
+from collections import deque
+
+import catalog
+import instrument
+import neighbours
+import priors
+
+try:
+    # the command line negotiation reads plain strings
+    input = raw_input
+except NameError:
+    pass
+
+
+class BidSpace:
+    def __init__(self, bundle, start_price, max_price, total_selling_price, total_cost_price, bidding_distance=0.05):
+        '''
+        The integer prices from start_price up to max_price (inclusive) for a single bundle.
+        The agent utility of a bid is linear in its price for a fixed bundle, so the
+        bids are never materialized; utilities are evaluated in closed form instead
+        Parameters:
+            bundle              - the bundle every bid in the space refers to
+            start_price         - the lowest price in the bid space
+            max_price           - the highest price in the bid space
+            total_selling_price - the total selling price of the bundle
+            total_cost_price    - the total cost price of the bundle
+            bidding_distance    - the maximum distance of a reasonable bid's utility from the target utility
+        '''
+
+        self.bundle = bundle
+        self.start_price = start_price
+        self.max_price = max_price
+        self.total_selling_price = total_selling_price
+        self.total_cost_price = total_cost_price
+        self.max_profit = total_selling_price - total_cost_price
+        self.bidding_distance = bidding_distance
+
+    def __len__(self):
+        return max(0, self.max_price - self.start_price + 1)
+
+    def __iter__(self):
+        for price in range(self.start_price, self.max_price + 1):
+            yield {"Bundle": self.bundle, "Cost": price}
+
+    def prices(self):
+        return np.arange(self.start_price, self.max_price + 1)
+
+    def utilities(self, prices=None):
+        '''
+        Parameters:
+            prices  - the prices to evaluate, all prices of the bid space by default
+        Returns:
+            agent utility of the bid at each price
+        '''
+
+        if prices is None:
+            prices = self.prices()
+        return (prices - self.total_cost_price) / self.max_profit
+
+    def reasonableBids(self, target_utility):
+        '''
+        Parameters:
+            target_utility  - the target utility of the offer that the agent should propose
+        Returns:
+            the prices whose agent utility lies within bidding_distance of target_utility
+        '''
+
+        prices = self.prices()
+        return prices[np.abs(self.utilities(prices) - target_utility) <= self.bidding_distance]
+
+    def bestOffer(self, target_utility):
+        '''
+        Parameters:
+            target_utility  - the target utility of the offer that the agent should propose
+        Returns:
+            the lowest priced bid whose agent utility is closest to target_utility,
+            or an empty dictionary if the bid space is empty
+        '''
+
+        if len(self) == 0:
+            return {}
+
+        if self.max_profit > 0:
+            # utility is monotonic in price, so the closest bid is next to the
+            # price solving utility == target_utility; a small window around it
+            # absorbs the rounding of the closed form solution
+            target_price = int(math.floor(self.total_cost_price + target_utility * self.max_profit))
+            low = min(max(target_price - 2, self.start_price), self.max_price)
+            high = max(min(target_price + 3, self.max_price), self.start_price)
+            prices = np.arange(low, high + 1)
+        else:
+            prices = self.prices()
+
+        distance = np.abs(target_utility - self.utilities(prices))
+        best_price = prices[np.argmin(distance)]
+        return {"Bundle": self.bundle, "Cost": int(best_price), "Accepted": False}
+
+
+# the sums of RunningStats are exact integers in units of the smallest float, 2 ** -1074
+UNIT_BITS = 1074
+
+
+def exactUnits(value):
+    '''
+    Returns:
+        the value as an integer number of units of 2 ** -1074, which every finite float is, None for nan and inf
+    '''
+
+    value = float(value)
+    if math.isnan(value) or math.isinf(value):
+        return None
+    numerator, denominator = value.as_integer_ratio()
+    return numerator * ((1 << UNIT_BITS) // denominator)
+
+
+def sign(value):
+    return (value > 0) - (value < 0)
+
+
+def addExact(total, squares, value):
+    '''
+    Returns:
+        the exact sums of values and of their squares with the value added, None after a nan or inf
+    '''
+
+    units = exactUnits(value)
+    if units is None or total is None:
+        return None, None
+    return total + units, squares + units * units
+
+
+def compareMean(count, total, value):
+    '''
+    Returns:
+        1, 0 or -1 as the value is above, equal to or below the mean of count values summing to total, exactly;
+        nan when either is not finite, which compares as a nan value with the mean would
+    '''
+
+    units = exactUnits(value)
+    if units is None or total is None:
+        return float("nan")
+    return sign(count * units - total)
+
+
+def compareDeviation(count, total, squares, value):
+    '''
+    Returns:
+        1, 0 or -1 as the squared deviation of the value from the mean is above, equal to or below the variance,
+        exactly; nan when either is not finite
+    '''
+
+    units = exactUnits(value)
+    if units is None or total is None:
+        return float("nan")
+    # (value - mean) ** 2 against the variance, both multiplied by count ** 2
+    deviation = count * units - total
+    return sign(deviation * deviation - (count * squares - total * total))
+
+
+class RunningStats:
+    def __init__(self, window=16):
+        '''
+        Mean and variance of a stream of values updated in constant time and memory, with the most recent values
+        kept in a ring buffer. The sums of the values and of their squares are kept exactly as integers, so that a
+        value compares with the mean and the variance as in exact arithmetic: tied values stay tied however the
+        mean and the variance are rounded
+        Parameters:
+            window  - number of recent values kept
+        '''
+
+        self.count = 0
+        # sum of the values in units of 2 ** -1074 and of their squares in units of 2 ** -2148, None after a nan or
+        # inf, which no value compares with afterwards
+        self.total = 0
+        self.squares = 0
+        self.recent = deque(maxlen=window)
+
+    def __len__(self):
+        return self.count
+
+    def push(self, value):
+        self.count += 1
+        self.total, self.squares = addExact(self.total, self.squares, value)
+        self.recent.append(value)
+
+    @property
+    def mean(self):
+        if self.total is None:
+            return float("nan")
+        # int division rounds correctly
+        return self.total / (self.count << UNIT_BITS) if self.count else 0.0
+
+    @property
+    def variance(self):
+        '''
+        population variance, as np.var
+        '''
+
+        if self.total is None:
+            return float("nan")
+        if not self.count:
+            return 0.0
+        return (self.count * self.squares - self.total * self.total) / (self.count * self.count << 2 * UNIT_BITS)
+
+    def compareMean(self, value):
+        return compareMean(self.count, self.total, value)
+
+    def compareDeviation(self, value):
+        return compareDeviation(self.count, self.total, self.squares, value)
+
+    @property
+    def last(self):
+        return self.recent[-1]
+
+    def getState(self):
+        return {"count": self.count, "total": self.total, "squares": self.squares,
+                "recent": [float(v) for v in self.recent], "window": self.recent.maxlen}
+
+    def setState(self, state):
+        self.count = state["count"]
+        if "total" in state:
+            self.total = state["total"]
+            self.squares = state["squares"]
+        else:
+            # saved with a floating point mean and sum of squared deviations, before the sums were exact
+            mean, m2 = exactUnits(state["mean"]), exactUnits(state["m2"])
+            if mean is None or m2 is None:
+                self.total = self.squares = None
+            else:
+                self.total = mean * self.count
+                self.squares = mean * mean * self.count + (m2 << UNIT_BITS)
+        self.recent = deque(state["recent"], maxlen=state["window"])
+
+
+def priceArrays(product_list, selling_price, cost_price):
+    '''
+    Parameters:
+        product_list    - list of the entire product base
+        selling_price   - list with the selling price of the entire product base
+        cost_price      - list with the cost price of the entire product base
+    Returns:
+        selling_prices  - array with the selling price of every product, indexed by product id
+        cost_prices     - array with the cost price of every product, indexed by product id
+    '''
+
+    selling_prices = np.array([selling_price[name] for name in product_list])
+    cost_prices = np.array([cost_price[name] for name in product_list])
+    return selling_prices, cost_prices
+
+
+class AgentConfig:
+    def __init__(self, max_initial_discount_rate=0.1, min_profit_margin=0.3, num_rounds=0.6, alpha=0.4,
+                 decay_factor=1.3, first_round_pace=0.1, pace=0.08, bidding_distance=0.05, learning_rate_exponent=-2.2):
+        '''
+        The parameters of the agent's concession strategy, tuned with optimize.py
+        Parameters:
+            max_initial_discount_rate   - maximum discount on the add-ons of the initial offer
+            min_profit_margin           - share of the profit of the add-ons the agent keeps at least
+            num_rounds                  - share of its concession the agent starts the negotiation at
+            alpha                       - initial concession exponent of TKI, adapted to the buyer every round
+            decay_factor                - weight of the buyer utility in the target utility of TKI
+            first_round_pace            - concession added per round by the first round of TKI
+            pace                        - concession added per round by the later rounds of TKI
+            bidding_distance            - maximum distance of a reasonable bid's utility from the target utility,
+                                          only read by BidSpace.reasonableBids: the offers do not depend on it
+            learning_rate_exponent      - the opponent model weighs the prior utility by time ** exponent
+        '''
+
+        self.max_initial_discount_rate = max_initial_discount_rate
+        self.min_profit_margin = min_profit_margin
+        self.num_rounds = num_rounds
+        self.alpha = alpha
+        self.decay_factor = decay_factor
+        self.first_round_pace = first_round_pace
+        self.pace = pace
+        self.bidding_distance = bidding_distance
+        self.learning_rate_exponent = learning_rate_exponent
+
+    def asDict(self):
+        return dict(self.__dict__)
+
+    def save(self, path):
+        with open(path, "w") as config_file:
+            json.dump(self.asDict(), config_file, sort_keys=True, indent=1)
+
+    @staticmethod
+    def load(path):
+        with open(path) as config_file:
+            return AgentConfig(**json.load(config_file))
 
 
 class Agent:
     def __init__(self, product_list, cost_price, selling_price, max_initial_discount_rate=0.1, min_profit_margin=0.3,
-                 num_rounds=0.6):
+                 num_rounds=0.6, selling_prices=None, cost_prices=None, price_version=0, config=None):
+        '''
+        Parameters:
+            selling_prices  - selling_price as an array indexed by product id, see priceArrays
+            cost_prices     - cost_price as an array indexed by product id, see priceArrays
+            price_version   - version of the prices in a pricetable.PriceTable, 0 for the prices of the catalog
+            config          - AgentConfig of the agent, its max_initial_discount_rate, min_profit_margin and
+                              num_rounds take the place of the arguments of the same names
+        '''
+
+        if config is None:
+            config = AgentConfig(max_initial_discount_rate, min_profit_margin, num_rounds)
+        self.config = config
+
         self.first_offer_value = -1
         self.product_list = product_list
         self.cost_price = cost_price
         self.selling_price = selling_price
-        self.buyer_utility_list = []
-        self.prev_agent_offers_list = []
-        self.prev_agent_offers_utility_list = []
-        self.rounds = num_rounds
+        if selling_prices is None or cost_prices is None:
+            selling_prices, cost_prices = priceArrays(product_list, selling_price, cost_price)
+        self.selling_prices = selling_prices
+        self.cost_prices = cost_prices
+        self.price_version = price_version
+        self.price_key = priors.priceKey(selling_prices, cost_prices)
+        # totals of the bundles seen in this negotiation, keyed by the sorted bundle
+        self.bundle_totals = {}
+        self.utility_terms = {}
+        # opponent history in constant memory, however long the negotiation runs
+        self.buyer_utilities = RunningStats()
+        self.prev_agent_offers = deque(maxlen=16)
+        self.prev_agent_offers_utilities = RunningStats()
+        self.rounds = config.num_rounds
         self.time = 0
-        self.alpha = 0.4
-        self.max_initial_discount_rate = max_initial_discount_rate
+        self.alpha = config.alpha
+        self.max_initial_discount_rate = config.max_initial_discount_rate
         self.min_agent_utility = 1
-        self.min_profit_margin = min_profit_margin
+        self.min_profit_margin = config.min_profit_margin
+        # agent, buyer and target utilities of the latest round, for the round log
+        self.last_round = (None, None, None)
 
+    @instrument.timed("opponentModel")
     def opponentModel(self, proposed_offer, recommender):
 
         '''
@@ -34,44 +356,33 @@ class Agent:
         # the index of the product the buyer wishes to buy
         product_idx = proposed_offer["Bundle"][-1]
 
-        print proposed_offer["Bundle"]
-
         total_offered_price = proposed_offer["Cost"]
 
         # todo ##############################################
-        total_selling_price = 0
-        for i in proposed_offer["Bundle"]:
-            total_selling_price += self.selling_price[self.product_list[i]]
+        total_selling_price = self.bundleTotals(proposed_offer["Bundle"])[0]
 
         # todo ->  this is causing zero division error
-        print "selling price", total_selling_price
-        print "offer price", total_offered_price
-
         offer_value = (total_selling_price - total_offered_price) / float(total_selling_price)
 
-        print "offer value", offer_value
-        print "first offer val", self.first_offer_value
-
         if self.first_offer_value == -1:
             self.first_offer_value = offer_value
 
         current_bid_utility = offer_value / self.first_offer_value
         # todo ##############################################
 
-        prior_utility = 0
-        for i in proposed_offer["Bundle"][:-1]:
-            prior_utility += recommender.cooccurance_matrix[product_idx][i] / \
-                             recommender.cooccurance_matrix[product_idx][product_idx]
-
-        if (len(proposed_offer["Bundle"])) > 1:
-            prior_utility /= (len(proposed_offer["Bundle"]) - 1)
-        lr = self.time ** (-2.2)
+        prior_utility = recommender.prior_table.priorUtility(proposed_offer["Bundle"])
+        lr = self.time ** self.config.learning_rate_exponent
         buyer_utility = (1 - lr) * current_bid_utility + lr * prior_utility
 
-        print "buyer utitlity ", buyer_utility
+        if instrument.tracing():
+            instrument.trace("opponent_model", bundle=[int(i) for i in proposed_offer["Bundle"]],
+                             selling_price=total_selling_price, offer_price=total_offered_price,
+                             offer_value=offer_value, first_offer_value=self.first_offer_value,
+                             prior_utility=prior_utility, buyer_utility=buyer_utility)
 
         return buyer_utility
 
+    @instrument.timed("utility")
     def utility(self, proposed_offer, recommender):
         '''
         Parameters:
@@ -81,27 +392,45 @@ class Agent:
             agent utility for the proposed offer
         '''
 
-        # the index of the product the buyer wishes to buy
-        product_idx = proposed_offer["Bundle"][-1]
-
-        total_offered_price = proposed_offer["Cost"]
-        total_selling_price = 0
-        for i in proposed_offer["Bundle"]:
-            total_selling_price += self.selling_price[self.product_list[i]]
-
-        total_cost_price = 0
-        for i in proposed_offer["Bundle"]:
-            total_cost_price += self.cost_price[self.product_list[i]]
-
-        profit = total_offered_price - total_cost_price
-        max_profit = total_selling_price - total_cost_price
+        bundle = proposed_offer["Bundle"]
+        # everything but the price only depends on the bundle, in order since its last item is the product
+        key = tuple(bundle.tolist() if isinstance(bundle, np.ndarray) else bundle)
+        terms = self.utility_terms.get(key)
+        if terms is None:
+            # the index of the product the buyer wishes to buy
+            product_idx = bundle[-1]
+            total_selling_price, total_cost_price = self.bundleTotals(bundle)
+            max_profit = total_selling_price - total_cost_price
+
+            product_selling_price, product_cost_price = self.bundleTotals([product_idx])
+            initial_profit = product_selling_price - product_cost_price
+            min_agent_utility = (initial_profit + self.min_profit_margin * (max_profit - initial_profit)) / max_profit
+            terms = (total_cost_price, max_profit, min_agent_utility)
+            self.utility_terms[key] = terms
+
+        total_cost_price, max_profit, self.min_agent_utility = terms
+        profit = proposed_offer["Cost"] - total_cost_price
         agent_utility = profit / max_profit
-
-        initial_profit = self.selling_price[self.product_list[product_idx]] - self.cost_price[
-            self.product_list[product_idx]]
-        self.min_agent_utility = (initial_profit + self.min_profit_margin * (max_profit - initial_profit)) / max_profit
         return agent_utility
 
+    def bundleTotals(self, bundle):
+        '''
+        Parameters:
+            bundle  - list of indices of items in the bundle
+        Returns:
+            total_selling_price - the total selling price of the bundle
+            total_cost_price    - the total cost price of the bundle
+        '''
+
+        key = bundleKey(bundle)
+        totals = self.bundle_totals.get(key)
+        if totals is None:
+            idx = np.array(key, dtype=np.intp)
+            totals = (self.selling_prices[idx].sum().item(), self.cost_prices[idx].sum().item())
+            self.bundle_totals[key] = totals
+        return totals
+
+    @instrument.timed("TKI")
     def TKI(self, buyer_utility, agent_utility):
 
         '''
@@ -113,29 +442,31 @@ class Agent:
             target_utility  - the target utility of the offer that the agent should propose
         '''
 
-        decay_factor = 1.3
-        if len(self.buyer_utility_list) == 0:
+        decay_factor = self.config.decay_factor
+        if len(self.buyer_utilities) == 0:
             target_utility = self.min_agent_utility + (1 - self.min_agent_utility) * (
-            1 - decay_factor * buyer_utility * min(self.rounds + self.time * 0.1, 1) ** (1 / self.alpha))
+            1 - decay_factor * buyer_utility * min(self.rounds + self.time * self.config.first_round_pace, 1) ** (
+                1 / self.alpha))
             self.time += 1
-            self.buyer_utility_list.append(buyer_utility)
+            self.buyer_utilities.push(buyer_utility)
             return target_utility
         else:
-            mean_buyer_utility = np.mean(self.buyer_utility_list)
-            var_buyer_utility = np.var(self.buyer_utility_list)
-            current_var_buyer_utility = (buyer_utility - mean_buyer_utility) ** 2
+            # the buyer utility against the mean and its squared deviation against the variance of the previous ones,
+            # compared exactly
+            mean_comparison = self.buyer_utilities.compareMean(buyer_utility)
+            var_comparison = self.buyer_utilities.compareDeviation(buyer_utility)
             cooperativeness = ""
             assertiveness = ""
-            if buyer_utility > mean_buyer_utility:
+            if mean_comparison > 0:
                 cooperativeness = "uncooperative"
-            elif buyer_utility == mean_buyer_utility:
+            elif mean_comparison == 0:
                 cooperativeness = "neutral"
             else:
                 cooperativeness = "cooperative"
 
-            if current_var_buyer_utility > var_buyer_utility:
+            if var_comparison > 0:
                 assertiveness = "passive"
-            elif current_var_buyer_utility == var_buyer_utility:
+            elif var_comparison == 0:
                 assertiveness = "neutral"
             else:
                 assertiveness = "assertive"
@@ -151,57 +482,52 @@ class Agent:
                     self.alpha -= 0.25
 
             target_utility = self.min_agent_utility + (1 - self.min_agent_utility) * (
-            1 - decay_factor * buyer_utility * min(self.rounds + self.time * 0.08, 1) ** (1 / self.alpha))
+            1 - decay_factor * buyer_utility * min(self.rounds + self.time * self.config.pace, 1) ** (1 / self.alpha))
 
             self.time += 1
-            self.buyer_utility_list.append(buyer_utility)
+            self.buyer_utilities.push(buyer_utility)
             return target_utility
 
+    @instrument.timed("getBidSpace")
     def getBidSpace(self, proposed_offer, target_utility, recommender, prev_offer):
         '''
-        Provides a list of all reasonable bids that can be offered based on the
-        target utility function offered by TKI
+        Provides the space of all bids that can be offered for the proposed bundle,
+        from the mirror image of the buyer's offer up to the agent's previous offer
         Parameters:
             proposed_offer  - offer proposed by buyer
             target_utility  - the target utility of the offer that the agent should propose
             recommender     - the recommendation system used by the agent
             prev_offer      - previous offer made by the agent
         Returns:
-            reasonable_bid_space - list of reasonable bids
+            bid_space       - BidSpace of the proposed bundle
         '''
 
         max_cost = int(prev_offer["Cost"])
-        if not np.array_equal(sorted(prev_offer["Bundle"]), sorted(proposed_offer["Bundle"])):
+        if bundleKey(prev_offer["Bundle"]) != bundleKey(proposed_offer["Bundle"]):
             max_cost = int(self.getInitialOffer(proposed_offer["Bundle"], recommender)["Cost"])
 
-        bidding_distance = 0.05
+        bidding_distance = self.config.bidding_distance
         offered_price = proposed_offer["Cost"]
         # offered_price - (max_cost - offered_price)
-        start_offer_price = max(0, 2 * offered_price - max_cost)
-        bid_space = []
-        for price in range(start_offer_price, max_cost + 1):
-            bid_space.append({"Bundle": proposed_offer["Bundle"], "Cost": price})
-
-        reasonable_bid_space = []
-        for bid in bid_space:
-            agent_utility = self.utility(bid, recommender)
-            if abs(agent_utility - target_utility) <= bidding_distance:
-                reasonable_bid_space.append(bid)
-
+        start_offer_price = int(max(0, 2 * offered_price - max_cost))
+        total_selling_price, total_cost_price = self.bundleTotals(proposed_offer["Bundle"])
+        bid_space = BidSpace(proposed_offer["Bundle"], start_offer_price, max_cost, total_selling_price,
+                             total_cost_price, bidding_distance)
+        instrument.observe("bid_space_size", len(bid_space))
         return bid_space
 
+    @instrument.timed("acceptanceModel")
     def acceptanceModel(self, bid_space, proposed_offer, target_utility, recommender, agent_utility):
-        prev_offer_utility = self.prev_agent_offers_utility_list[-1]
+        prev_offer_utility = self.prev_agent_offers_utilities.last
         new_offer = {}
-        prev_mean_utility = np.mean(self.prev_agent_offers_utility_list)
-        bid_space_utility_list = [self.utility(offer, recommender) for offer in bid_space]
 
         if prev_offer_utility <= agent_utility:
             new_offer["Bundle"] = proposed_offer["Bundle"]
             new_offer["Cost"] = proposed_offer["Cost"]
             new_offer["Accepted"] = True
 
-        elif prev_mean_utility <= agent_utility:
+        # the mean of the utilities of the previous offers, compared exactly
+        elif self.prev_agent_offers_utilities.compareMean(agent_utility) >= 0:
             new_offer["Bundle"] = proposed_offer["Bundle"]
             new_offer["Cost"] = proposed_offer["Cost"]
             new_offer["Accepted"] = True
@@ -212,93 +538,177 @@ class Agent:
             new_offer["Accepted"] = True
 
         else:
-            min_difference_utility = math.inf
-            for idx in range(len(bid_space_utility_list)):
-                if min_difference_utility > abs(target_utility - bid_space_utility_list[idx]):
-                    new_offer["Bundle"] = bid_space[idx]["Bundle"]
-                    new_offer["Cost"] = bid_space[idx]["Cost"]
-                    new_offer["Accepted"] = False
-                    min_difference_utility = abs(target_utility - bid_space_utility_list[idx])
+            new_offer = bid_space.bestOffer(target_utility)
 
         return new_offer
 
     def getInitialOffer(self, product_list, recommender):
         self.time += 1
-        prior_utility = 0
         product_idx = product_list[-1]
+        # only depends on the bundle and prices, memoized for every agent pricing with the same price arrays
+        key = (tuple(product_list.tolist() if isinstance(product_list, np.ndarray) else product_list),
+               self.max_initial_discount_rate, self.price_key)
+        cost = recommender.prior_table.initial_offers.get(key)
+        if cost is None:
+            prior_utility = recommender.prior_table.priorUtility(product_list)
+            total_selling_price, total_cost_price = self.bundleTotals(product_list[:-1])
+
+            initial_discount = min((1 - prior_utility), self.max_initial_discount_rate) * (
+            total_selling_price - total_cost_price)
+            cost = total_selling_price - initial_discount + self.selling_prices[product_idx].item()
+            recommender.prior_table.initial_offers.put(key, cost)
+        initial_offer = {"Bundle": product_list, "Cost": cost, "Accepted": False}
 
-        total_selling_price = 0
-        total_cost_price = 0
-        for i in product_list[:-1]:
-            prior_utility += recommender.cooccurance_matrix[product_idx][i] / \
-                             recommender.cooccurance_matrix[product_idx][product_idx]
-            total_selling_price += self.selling_price[self.product_list[i]]
-            total_cost_price += self.cost_price[self.product_list[i]]
+        return initial_offer
 
-        if (len(product_list) > 1):
-            prior_utility /= (len(product_list) - 1)
+    def getState(self):
+        '''
+        Returns:
+            state   - the negotiation state of the agent as plain python values
+        '''
 
-        initial_discount = min((1 - prior_utility), self.max_initial_discount_rate) * (
-        total_selling_price - total_cost_price)
-        initial_offer = {"Bundle": product_list, "Cost": total_selling_price - initial_discount + self.selling_price[
-            self.product_list[product_idx]], "Accepted": False}
+        return {"first_offer_value": float(self.first_offer_value),
+                "buyer_utilities": self.buyer_utilities.getState(),
+                "prev_agent_offers": [serializeOffer(offer) for offer in self.prev_agent_offers],
+                "prev_agent_offers_utilities": self.prev_agent_offers_utilities.getState(),
+                "time": self.time,
+                "alpha": self.alpha,
+                "min_agent_utility": float(self.min_agent_utility)}
 
-        return initial_offer
+    def setState(self, state):
+        '''
+        Restores a negotiation state returned by getState
+        Parameters:
+            state   - the negotiation state of the agent
+        '''
+
+        self.first_offer_value = state["first_offer_value"]
+        self.buyer_utilities.setState(state["buyer_utilities"])
+        self.prev_agent_offers = deque(state["prev_agent_offers"], maxlen=self.prev_agent_offers.maxlen)
+        self.prev_agent_offers_utilities.setState(state["prev_agent_offers_utilities"])
+        self.time = state["time"]
+        self.alpha = state["alpha"]
+        self.min_agent_utility = state["min_agent_utility"]
 
 
 class Buyer:
     def __init__(self, no_of_products):
-        self.MOMP_lst = [0] * no_of_products
-        self.MCLP_lst = [0] * no_of_products
+        # times every item was in a bundle the buyer proposed (MOMP) and was dropped from the agent's bundle (MCLP)
+        self.MOMP = np.zeros(no_of_products, dtype=np.int64)
+        self.MCLP = np.zeros(no_of_products, dtype=np.int64)
+
+    def getState(self):
+        # only the items the buyer touched, the counters of a large catalog are mostly zeros
+        momp_idx = np.flatnonzero(self.MOMP)
+        mclp_idx = np.flatnonzero(self.MCLP)
+        return {"MOMP": [momp_idx.tolist(), self.MOMP[momp_idx].tolist()],
+                "MCLP": [mclp_idx.tolist(), self.MCLP[mclp_idx].tolist()]}
+
+    def setState(self, state):
+        if "MOMP_lst" in state:
+            # negotiations stored before the counters became arrays
+            self.MOMP[:] = state["MOMP_lst"]
+            self.MCLP[:] = state["MCLP_lst"]
+            return
+        self.MOMP[:] = 0
+        self.MCLP[:] = 0
+        self.MOMP[np.array(state["MOMP"][0], dtype=np.intp)] = state["MOMP"][1]
+        self.MCLP[np.array(state["MCLP"][0], dtype=np.intp)] = state["MCLP"][1]
 
     def initialUtility(self, recommender, product_idx, initial_item_idx):
-        return recommender.lift[product_idx][initial_item_idx]
+        '''
+        Returns:
+            array of the lift of product -> item for every item of initial_item_idx
+        '''
+
+        initial_item_idx = np.asarray(initial_item_idx, dtype=np.intp)
+        return recommender.prior_table.liftValues(np.full(len(initial_item_idx), product_idx, dtype=np.intp),
+                                                  initial_item_idx)
 
     def utility(self, proposed_offer, prev_offer, recommender):
-        proposed_bundle = proposed_offer["Bundle"]
-        if proposed_bundle == prev_offer["Bundle"]:
-            # bundle not changed but cost changed
-            for idx in proposed_bundle:
-                self.MOMP_lst[idx] += 1
-        else:
-            # bundle changed"
-            for idx in proposed_bundle:
-                self.MOMP_lst[idx] += 1
+        '''
+        Counts the items the buyer proposed and dropped, and rates the proposed bundle
+        Parameters:
+            proposed_offer  - offer proposed by the buyer
+            prev_offer      - previous offer of the agent
+            recommender     - the recommendation system used by the agent
+        Returns:
+            the buyer utility of the proposed bundle
+        '''
 
-            for idx in prev_offer["Bundle"]:
-                if idx not in proposed_bundle:
-                    self.MCLP_lst[idx] += 1
+        proposed_bundle = np.asarray(proposed_offer["Bundle"], dtype=np.intp)
+        prev_bundle = np.asarray(prev_offer["Bundle"], dtype=np.intp)
+        np.add.at(self.MOMP, proposed_bundle, 1)
+        np.add.at(self.MCLP, prev_bundle[~np.isin(prev_bundle, proposed_bundle)], 1)
+        return self.utilities([proposed_bundle], recommender)[0]
 
-        # Use MOMP, MCLP, lift value for the offered items to calculate the buyer utility
-        lift_sum = 0
-        for idx in proposed_bundle:
-            lift_sum += recommender.lift[product_idx][idx]
+    def utilities(self, bundles, recommender):
+        '''
+        Rates many bundles at once, without counting them as proposed
+        Parameters:
+            bundles     - list of bundles, each a list or array of indices with its product last
+            recommender - the recommendation system used by the agent
+        Returns:
+            array of the utility of every bundle: the mean lift of product -> add-on over the add-ons, plus the mean
+            of MOMP minus the mean of MCLP over the whole bundle
+        '''
 
-        lift_avg = lift_sum / len(proposed_bundle)
-        utility = lift_avg \
-                  + sum([self.MOMP_lst[i] for i in proposed_bundle]) / len(proposed_bundle) \
-                  - sum([self.MCLP_lst[i] for i in proposed_bundle]) / len(proposed_bundle)
+        lengths = np.fromiter(map(len, bundles), dtype=np.intp, count=len(bundles))
+        items = np.fromiter(itertools.chain.from_iterable(bundles), dtype=np.intp, count=lengths.sum())
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        products = np.repeat(items[ends - 1], lengths)
+        add_ons = np.ones(len(items), dtype=bool)
+        add_ons[ends - 1] = False
 
-        return utility
+        lift = np.zeros(len(items))
+        lift[add_ons] = recommender.prior_table.liftValues(products[add_ons], items[add_ons])
+        counts = (self.MOMP[items] - self.MCLP[items]).astype(np.float64)
+        # a product alone has no add-ons to lift it
+        return np.add.reduceat(lift, starts) / np.maximum(lengths - 1, 1) + np.add.reduceat(counts, starts) / lengths
 
 
 class RecommenderSystem:
-    def __init__(self, cooccurance_matrix):
+    def __init__(self, cooccurance_matrix, neighbour_index=None, k=10, prior_table=None, bundle_search=None):
+        '''
+        Parameters:
+            cooccurance_matrix  - the cooccurance matrix of the recommendation system
+            neighbour_index     - precomputed NeighbourIndex, built from cooccurance_matrix when not given
+            k                   - number of neighbours indexed per product when the index is built
+            prior_table         - priors.PriorTable of cooccurance_matrix, built when not given
+            bundle_search       - bundles.BundleSearch choosing the add-ons of the initial offer,
+                                  the top 2 neighbours of the product when not given
+        '''
+
         self.cooccurance_matrix = cooccurance_matrix
+        if neighbour_index is None:
+            neighbour_index = neighbours.buildNeighbourIndex(cooccurance_matrix, k)
+        self.neighbour_index = neighbour_index
+        if prior_table is None:
+            prior_table = priors.PriorTable(cooccurance_matrix)
+        self.prior_table = prior_table
+        self.bundle_search = bundle_search
 
     def getInitialBundleRecommendation(self, product_idx):
-        mx = -math.inf
-        pos = -1
-        for i in range(len(self.cooccurance_matrix[product_idx])):
-            if mx < self.cooccurance_matrix[product_idx][i] and i != product_idx:
-                mx = self.cooccurance_matrix[product_idx][i]
-                pos = i
-
-        return pos
+        recommendations = self.neighbour_index.topNeighbours(product_idx, 1)
+        if len(recommendations) == 0:
+            return -1
+        return recommendations[0]
 
     def getListOfPossibleItems(self, product_idx):
-        recommendations = np.argsort(self.cooccurance_matrix[product_idx])[::-1]
-        return recommendations[1:3]
+        if self.bundle_search is not None:
+            return self.neighbour_index.topNeighbours(product_idx, self.bundle_search.candidates)
+        return self.neighbour_index.topNeighbours(product_idx, 2)
+
+    def getInitialAddOns(self, agent, product_idx):
+        '''
+        Returns:
+            array of indices of the items the agent bundles with the product in its initial offer
+        '''
+
+        if self.bundle_search is not None:
+            return np.array(self.bundle_search.search(agent, self, product_idx), dtype=np.intp)
+        return self.getListOfPossibleItems(product_idx)
 
 
 def printMenu(product_list, product_idx, bundle_idx, offer, cost):
@@ -337,23 +747,39 @@ def getProduct(product_list):
     return product_name, (product_idx - 1)
 
 
-def getProductIndex(product_list, product_names):
-    product_name_list = product_names.split(',')
-    idx_lst = []
-    for j in range(len(product_name_list)):
-        product_name = product_name_list[j]
-        for i in range(len(product_list)):
-            if product_list[i] == product_name:
-                idx_lst.append(i)
-                break
-    return idx_lst
+def getProductIndex(product_list, product_names, product_index=None):
+    '''
+    Parameters:
+        product_list    - list of the entire product base
+        product_names   - comma separated names of the products
+        product_index   - catalog.ProductIndex of product_list, built here when not given
+    Returns:
+        list of the indices of the named products, unknown names are skipped
+    '''
+
+    if product_index is None:
+        product_index = catalog.ProductIndex(product_list)
+    return product_index.encode(product_names)
+
+
+def bundleKey(bundle):
+    '''
+    Compact encoding of a bundle under which bundles with the same items compare and hash equal
+    Parameters:
+        bundle  - list or array of indices of items in the bundle
+    Returns:
+        sorted tuple of the item indices
+    '''
 
+    return tuple(sorted(bundle.tolist() if isinstance(bundle, np.ndarray) else bundle))
 
-def getData():
+
+def getData(path="./data.pkl"):
     '''
     Load the product details and list values for the recommender system
     Parameters:
-        None
+        path                - data.pkl written by generateData.py, or a catalog directory written by catalog.py
+                              whose arrays are memory-mapped
     Returns:
         product_list        - list of the entire product base
         selling_price       - list with the selling price of the entire product base
@@ -361,11 +787,36 @@ def getData():
         cooccurance_matrix  - the cooccurance matrix of the recommendation system
     '''
 
-    data = pickle.load(open("./data.pkl", "rb"))
+    if catalog.isCatalog(path):
+        product_catalog = catalog.loadCatalog(path)
+        selling_price, cost_price = product_catalog.priceDicts()
+        return product_catalog.product_list, selling_price, cost_price, product_catalog.cooccurance_matrix
+
+    data = pickle.load(open(path, "rb"))
 
     return data["items"], data["selling_price"], data["cost_price"], data["cooccurance_matrix"],
 
 
+def serializeOffer(offer):
+    '''
+    Converts an offer to plain python values so that it can be stored outside the process
+    Parameters:
+        offer           - offer made by the agent or the buyer
+    Returns:
+        offer with the bundle as a list of ints
+    '''
+
+    if not offer:
+        return offer
+    serialized = dict(offer)
+    serialized["Bundle"] = [int(i) for i in offer["Bundle"]]
+    if isinstance(offer.get("Cost"), np.generic):
+        serialized["Cost"] = offer["Cost"].item()
+    if "Accepted" in offer:
+        serialized["Accepted"] = bool(offer["Accepted"])
+    return serialized
+
+
 def getOffer(agent, buyer, recommender, selling_price, product_list, proposed_offer, prev_offer):
     '''
     Create a new offer during the negotiation
@@ -384,25 +835,34 @@ def getOffer(agent, buyer, recommender, selling_price, product_list, proposed_of
     # prev_offer is None when negotiation has not begun
     if not prev_offer:
         product_idx = proposed_offer["Bundle"][-1]
-        initial_item_idx = recommender.getListOfPossibleItems(product_idx)
+        initial_item_idx = recommender.getInitialAddOns(agent, product_idx)
         initial_offer = agent.getInitialOffer(np.append(initial_item_idx, product_idx), recommender)
-        agent.prev_agent_offers_utility_list.append(agent.utility(initial_offer, recommender))
+        agent.prev_agent_offers_utilities.push(agent.utility(initial_offer, recommender))
+        agent.last_round = (agent.prev_agent_offers_utilities.last, None, None)
+        instrument.count("offers", stage="initial")
+        if instrument.tracing():
+            instrument.trace("initial_offer", offer=serializeOffer(initial_offer))
         return initial_offer
 
     else:
-        agent.prev_agent_offers_list.append(prev_offer)
+        agent.prev_agent_offers.append(prev_offer)
         buyer_utility = min(1, agent.opponentModel(proposed_offer, recommender))
         agent_utility = agent.utility(proposed_offer, recommender)
         if (agent_utility <= 0):
+            instrument.count("offers", stage="unprofitable")
+            agent.last_round = (agent_utility, buyer_utility, None)
             return prev_offer
 
-        print("Agent Utility : ", agent_utility)
-        print("Buyer Utility : ", buyer_utility)
         target_utility = agent.TKI(buyer_utility, agent_utility)
-        print("Target Utility : ", target_utility)
+        agent.last_round = (agent_utility, buyer_utility, target_utility)
         bid_space = agent.getBidSpace(proposed_offer, target_utility, recommender, prev_offer)
         new_offer = agent.acceptanceModel(bid_space, proposed_offer, target_utility, recommender, agent_utility)
-        agent.prev_agent_offers_utility_list.append(agent.utility(new_offer, recommender))
+        agent.prev_agent_offers_utilities.push(agent.utility(new_offer, recommender))
+        instrument.count("offers", stage="accepted" if new_offer.get("Accepted") else "counter")
+        if instrument.tracing():
+            instrument.trace("round", proposed_offer=serializeOffer(proposed_offer), offer=serializeOffer(new_offer),
+                             agent_utility=agent_utility, buyer_utility=buyer_utility,
+                             target_utility=target_utility, alpha=agent.alpha, bid_space_size=len(bid_space))
         return new_offer
 
 
@@ -467,7 +927,8 @@ def negotiation2(agent, buyer, cooccurance_matrix, product_list, selling_price,
         first_offer = False
 
 
-def negotiation(agent, buyer, cooccurance_matrix, product_list, selling_price, product_idx, offer, proposed_offer):
+def negotiation(agent, buyer, cooccurance_matrix, product_list, selling_price, product_idx, offer, proposed_offer,
+                recommender=None):
     '''
     The logic of the negotiation and its flow
     Parameters:
@@ -477,11 +938,14 @@ def negotiation(agent, buyer, cooccurance_matrix, product_list, selling_price, p
         product_list        - list of the entire product base
         selling_price       - list with the selling price of the entire product base
         product_idx         - index of the product that the buyer wishes to buy
+        recommender         - the recommendation system used by the agent, built from cooccurance_matrix when
+                              not given
     Returns:
         None
     '''
 
-    recommender = RecommenderSystem(cooccurance_matrix)
+    if recommender is None:
+        recommender = RecommenderSystem(cooccurance_matrix)
     offer = getOffer(agent, buyer, recommender, selling_price, product_list, proposed_offer, offer)
     return offer
 
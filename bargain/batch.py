@@ -0,0 +1,482 @@
+'''
+Negotiation engine advancing many negotiations in one call
+NegotiationBatch keeps the agent state of N sessions in NumPy arrays, one entry per session, and plays a round of
+any number of them at once: the opponent model, utility, TKI, acceptance model and bid selection of every pending
+counter-offer run as array operations over the batch, and what only depends on a bundle (its prices, prior utility
+and initial offer) is memoized for all sessions. Every session gets the offer getOffer would make, bit for bit,
+and its state converts to and from the state of an Agent (getState / setState), so batches can be built from the
+negotiation store. Rounds getOffer would fail on, e.g. with a division by zero, are played by getOffer itself
+'''
+
+from __future__ import division
+
+from collections import deque
+
+import numpy as np
+
+import bargain as bg
+import instrument
+import priors
+
+# bestOffer looks at the prices from 2 below to 3 above the price of the target utility
+BID_WINDOW = 6
+
+# name, dtype and initial value of the per-session arrays, as Agent.__init__ sets them; alpha, rounds and the agent
+# parameters are then set from the AgentConfig
+FIELDS = [("first_offer_value", np.float64, -1), ("time", np.int64, 0), ("alpha", np.float64, 0.4),
+          ("min_agent_utility", np.float64, 1), ("rounds", np.float64, 0.6),
+          ("max_initial_discount_rate", np.float64, 0.1), ("min_profit_margin", np.float64, 0.3),
+          ("agent_utility", np.float64, np.nan), ("buyer_utility", np.float64, np.nan),
+          ("target_utility", np.float64, np.nan)]
+# the running statistics of the buyer utilities and of the utilities of the agent's offers
+STATS = ["buyer_utilities", "offer_utilities"]
+
+
+def pythonPower(base, exponent):
+    '''
+    Raises with Python floats, as the agent does: NumPy's vectorized pow may round differently
+    Returns:
+        array of the powers, nan where Python raises
+    '''
+
+    powers = []
+    for b, e in zip(base.tolist(), exponent.tolist()):
+        try:
+            power = b ** e
+        except (ZeroDivisionError, OverflowError, ValueError):
+            power = np.nan
+        # the fractional power of a negative base is complex in Python 3
+        powers.append(np.nan if isinstance(power, complex) else power)
+    return np.array(powers, dtype=np.float64)
+
+
+class NegotiationBatch:
+    def __init__(self, product_list, cost_price, selling_price, recommender, selling_prices=None, cost_prices=None,
+                 capacity=64, window=16, price_version=0, config=None):
+        '''
+        Parameters:
+            product_list    - list of the entire product base
+            cost_price      - dictionary with the cost price of the entire product base
+            selling_price   - dictionary with the selling price of the entire product base
+            recommender     - the recommendation system used by the agents
+            selling_prices  - selling_price as an array indexed by product id, see priceArrays
+            cost_prices     - cost_price as an array indexed by product id, see priceArrays
+            capacity        - number of sessions the arrays are allocated for, they grow as needed
+            window          - number of recent utilities kept per session, as RunningStats
+            price_version   - version of the prices, as Agent's
+            config          - AgentConfig of the agents, its concession parameters apply to every session and its
+                              agent parameters are the defaults of addSession
+        '''
+
+        self.product_list = product_list
+        self.cost_price = cost_price
+        self.selling_price = selling_price
+        if selling_prices is None or cost_prices is None:
+            selling_prices, cost_prices = bg.priceArrays(product_list, selling_price, cost_price)
+        self.selling_prices = selling_prices
+        self.cost_prices = cost_prices
+        self.price_version = price_version
+        self.config = config if config is not None else bg.AgentConfig()
+        self.recommender = recommender
+        self.window = window
+        self.capacity = 0
+        self.free = []
+        self.active = np.zeros(0, dtype=bool)
+        for name, dtype, _ in FIELDS:
+            setattr(self, name, np.zeros(0, dtype=dtype))
+        for name in STATS:
+            setattr(self, name + "_count", np.zeros(0, dtype=np.int64))
+            # exact sums as RunningStats keeps them, Python integers
+            setattr(self, name + "_total", np.zeros(0, dtype=object))
+            setattr(self, name + "_squares", np.zeros(0, dtype=object))
+            setattr(self, name + "_recent", np.zeros((0, window)))
+            setattr(self, name + "_head", np.zeros(0, dtype=np.int64))
+            setattr(self, name + "_length", np.zeros(0, dtype=np.int64))
+        # offers are only kept for the state of the agents, as Agent.prev_agent_offers
+        self.prev_agent_offers = []
+        # bundle -> (total selling price, total cost price, initial profit), shared by all sessions
+        self.bundle_terms = priors.LRUCache(100000)
+        # max_initial_discount_rate -> Agent pricing the initial offers
+        self.pricers = {}
+        self.grow(capacity)
+
+    def __len__(self):
+        return int(self.active.sum())
+
+    def grow(self, capacity):
+        added = capacity - self.capacity
+        if added <= 0:
+            return
+        self.active = np.concatenate([self.active, np.zeros(added, dtype=bool)])
+        for name, dtype, value in FIELDS:
+            setattr(self, name, np.concatenate([getattr(self, name), np.full(added, value, dtype=dtype)]))
+        for name in STATS:
+            for suffix in ["_count", "_total", "_squares", "_head", "_length"]:
+                array = getattr(self, name + suffix)
+                setattr(self, name + suffix, np.concatenate([array, np.zeros(added, dtype=array.dtype)]))
+            recent = getattr(self, name + "_recent")
+            setattr(self, name + "_recent", np.concatenate([recent, np.zeros((added, self.window))]))
+        self.prev_agent_offers.extend(deque(maxlen=16) for _ in range(added))
+        self.free.extend(range(self.capacity + added - 1, self.capacity - 1, -1))
+        self.capacity += added
+
+    def addSession(self, max_initial_discount_rate=None, min_profit_margin=None, num_rounds=None):
+        '''
+        Parameters:
+            max_initial_discount_rate, min_profit_margin, num_rounds - parameters of the agent, as Agent's, those of
+                                                                       the config of the batch when None
+        Returns:
+            the session's index in the batch
+        '''
+
+        if not self.free:
+            self.grow(max(2 * self.capacity, 16))
+        session = self.free.pop()
+        self.active[session] = True
+        for name, dtype, value in FIELDS:
+            getattr(self, name)[session] = value
+        for name in STATS:
+            for suffix in ["_count", "_total", "_squares", "_head", "_length"]:
+                getattr(self, name + suffix)[session] = 0
+        config = self.config
+        self.max_initial_discount_rate[session] = (config.max_initial_discount_rate if max_initial_discount_rate is None
+                                                   else max_initial_discount_rate)
+        self.min_profit_margin[session] = config.min_profit_margin if min_profit_margin is None else min_profit_margin
+        self.rounds[session] = config.num_rounds if num_rounds is None else num_rounds
+        self.alpha[session] = config.alpha
+        self.prev_agent_offers[session] = deque(maxlen=16)
+        return session
+
+    def removeSession(self, session):
+        self.active[session] = False
+        self.prev_agent_offers[session] = deque(maxlen=16)
+        self.free.append(session)
+
+    def statsState(self, name, session):
+        count = int(getattr(self, name + "_count")[session])
+        length = int(getattr(self, name + "_length")[session])
+        head = int(getattr(self, name + "_head")[session])
+        recent = getattr(self, name + "_recent")[session]
+        return {"count": count, "total": getattr(self, name + "_total")[session],
+                "squares": getattr(self, name + "_squares")[session],
+                "recent": [float(recent[(head - length + i) % self.window]) for i in range(length)],
+                "window": self.window}
+
+    def setStatsState(self, name, session, state):
+        if state["window"] != self.window:
+            raise ValueError("the batch keeps %d recent utilities, the state %d" % (self.window, state["window"]))
+        recent = state["recent"][-self.window:]
+        # also reads the states saved before the sums were exact
+        stats = bg.RunningStats(self.window)
+        stats.setState(state)
+        getattr(self, name + "_count")[session] = stats.count
+        getattr(self, name + "_total")[session] = stats.total
+        getattr(self, name + "_squares")[session] = stats.squares
+        getattr(self, name + "_recent")[session, :len(recent)] = recent
+        getattr(self, name + "_head")[session] = len(recent) % self.window
+        getattr(self, name + "_length")[session] = len(recent)
+
+    def getState(self, session):
+        '''
+        Returns:
+            state   - the negotiation state of the session's agent, as Agent.getState returns it
+        '''
+
+        return {"first_offer_value": float(self.first_offer_value[session]),
+                "buyer_utilities": self.statsState("buyer_utilities", session),
+                "prev_agent_offers": [bg.serializeOffer(offer) for offer in self.prev_agent_offers[session]],
+                "prev_agent_offers_utilities": self.statsState("offer_utilities", session),
+                "time": int(self.time[session]),
+                "alpha": float(self.alpha[session]),
+                "min_agent_utility": float(self.min_agent_utility[session])}
+
+    def setState(self, session, state):
+        '''
+        Restores a negotiation state returned by getState or Agent.getState
+        '''
+
+        self.first_offer_value[session] = state["first_offer_value"]
+        self.setStatsState("buyer_utilities", session, state["buyer_utilities"])
+        self.prev_agent_offers[session] = deque(state["prev_agent_offers"], maxlen=16)
+        self.setStatsState("offer_utilities", session, state["prev_agent_offers_utilities"])
+        self.time[session] = state["time"]
+        self.alpha[session] = state["alpha"]
+        self.min_agent_utility[session] = state["min_agent_utility"]
+
+    def agent(self, session):
+        '''
+        Returns:
+            an Agent in the state of the session
+        '''
+
+        config = bg.AgentConfig(**self.config.asDict())
+        config.max_initial_discount_rate = float(self.max_initial_discount_rate[session])
+        config.min_profit_margin = float(self.min_profit_margin[session])
+        config.num_rounds = float(self.rounds[session])
+        agent = bg.Agent(self.product_list, self.cost_price, self.selling_price, selling_prices=self.selling_prices,
+                         cost_prices=self.cost_prices, price_version=self.price_version, config=config)
+        agent.setState(self.getState(session))
+        return agent
+
+    def pricer(self, max_initial_discount_rate):
+        pricer = self.pricers.get(max_initial_discount_rate)
+        if pricer is None or len(pricer.bundle_totals) > 100000:
+            pricer = bg.Agent(self.product_list, self.cost_price, self.selling_price,
+                              max_initial_discount_rate=max_initial_discount_rate,
+                              selling_prices=self.selling_prices, cost_prices=self.cost_prices,
+                              price_version=self.price_version)
+            self.pricers[max_initial_discount_rate] = pricer
+        return pricer
+
+    def bundleTerms(self, bundle):
+        '''
+        Parameters:
+            bundle  - tuple of indices of items in the bundle, the product last
+        Returns:
+            total selling price, total cost price and the profit of the product alone, as Agent.utility uses them
+        '''
+
+        terms = self.bundle_terms.get(bundle)
+        if terms is None:
+            key = bg.bundleKey(bundle)
+            idx = np.array(key, dtype=np.intp)
+            product_idx = np.array([bundle[-1]], dtype=np.intp)
+            # summed as Agent.bundleTotals sums them
+            terms = (self.selling_prices[idx].sum().item(), self.cost_prices[idx].sum().item(),
+                     self.selling_prices[product_idx].sum().item() - self.cost_prices[product_idx].sum().item())
+            self.bundle_terms.put(bundle, terms)
+        return terms
+
+    def pushStats(self, name, sessions, values):
+        count = getattr(self, name + "_count")
+        total = getattr(self, name + "_total")
+        squares = getattr(self, name + "_squares")
+        head = getattr(self, name + "_head")
+        length = getattr(self, name + "_length")
+        count[sessions] += 1
+        for session, value in zip(sessions.tolist(), values.tolist()):
+            total[session], squares[session] = bg.addExact(total[session], squares[session], value)
+        getattr(self, name + "_recent")[sessions, head[sessions]] = values
+        head[sessions] = (head[sessions] + 1) % self.window
+        length[sessions] = np.minimum(length[sessions] + 1, self.window)
+
+    def lastStats(self, name, sessions):
+        head = getattr(self, name + "_head")[sessions]
+        return getattr(self, name + "_recent")[sessions, (head - 1) % self.window]
+
+    def compareStats(self, name, sessions, values):
+        '''
+        Returns:
+            the comparisons of the values with the mean of the sessions' statistics and of their squared deviations
+            with the variance, as RunningStats.compareMean and compareDeviation make them
+        '''
+
+        counts = getattr(self, name + "_count")[sessions].tolist()
+        totals = getattr(self, name + "_total")[sessions]
+        squares = getattr(self, name + "_squares")[sessions]
+        mean_comparison = np.empty(len(values))
+        var_comparison = np.empty(len(values))
+        for i, value in enumerate(values.tolist()):
+            mean_comparison[i] = bg.compareMean(counts[i], totals[i], value)
+            var_comparison[i] = bg.compareDeviation(counts[i], totals[i], squares[i], value)
+        return mean_comparison, var_comparison
+
+    def lastRound(self, session):
+        '''
+        Returns:
+            agent, buyer and target utilities of the session's latest round, as Agent.last_round
+        '''
+
+        return tuple(None if np.isnan(value) else float(value) for value in
+                     [self.agent_utility[session], self.buyer_utility[session], self.target_utility[session]])
+
+    def start(self, sessions, product_ids):
+        '''
+        Makes the initial offers of new sessions
+        Parameters:
+            sessions    - indices of the sessions
+            product_ids - index of the product the buyer of every session wishes to buy
+        Returns:
+            list of the initial offers, as getOffer makes them
+        '''
+
+        sessions = np.asarray(sessions, dtype=np.intp)
+        offers = []
+        utilities = np.zeros(len(sessions))
+        min_agent_utilities = np.zeros(len(sessions))
+        for i, (session, product_idx) in enumerate(zip(sessions.tolist(), product_ids)):
+            pricer = self.pricer(float(self.max_initial_discount_rate[session]))
+            initial_item_idx = self.recommender.getInitialAddOns(pricer, product_idx)
+            offer = pricer.getInitialOffer(np.append(initial_item_idx, product_idx), self.recommender)
+            total_selling_price, total_cost_price, initial_profit = self.bundleTerms(tuple(offer["Bundle"].tolist()))
+            max_profit = total_selling_price - total_cost_price
+            utilities[i] = (offer["Cost"] - total_cost_price) / max_profit
+            min_agent_utilities[i] = (initial_profit + float(self.min_profit_margin[session]) * (
+                max_profit - initial_profit)) / max_profit
+            offers.append(offer)
+        self.time[sessions] += 1
+        self.min_agent_utility[sessions] = min_agent_utilities
+        self.pushStats("offer_utilities", sessions, utilities)
+        self.agent_utility[sessions] = utilities
+        self.buyer_utility[sessions] = np.nan
+        self.target_utility[sessions] = np.nan
+        instrument.count("offers", len(offers), stage="initial")
+        if instrument.tracing():
+            for offer in offers:
+                instrument.trace("initial_offer", offer=bg.serializeOffer(offer))
+        return offers
+
+    @instrument.timed("batchStep")
+    def step(self, sessions, proposed_offers, prev_offers):
+        '''
+        Plays a round of many negotiations
+        Parameters:
+            sessions        - indices of the sessions, each at most once
+            proposed_offers - offer proposed by the buyer of every session
+            prev_offers     - previous offer of the agent of every session
+        Returns:
+            list of the new offers of the agents, as getOffer makes them
+        A round getOffer raises on raises here too, after the rounds of the other sessions were played
+        '''
+
+        config = self.config
+        sessions = np.asarray(sessions, dtype=np.intp)
+        n = len(sessions)
+        selling = np.zeros(n)
+        cost = np.zeros(n)
+        initial_profit = np.zeros(n)
+        prior_utility = np.zeros(n)
+        offered_price = np.zeros(n)
+        prev_cost = np.zeros(n)
+        changed = np.zeros(n, dtype=bool)
+        initial_cost = np.zeros(n)
+        fallback = np.zeros(n, dtype=bool)
+        prior_table = self.recommender.prior_table
+        for i, (session, proposed_offer, prev_offer) in enumerate(zip(sessions.tolist(), proposed_offers,
+                                                                      prev_offers)):
+            bundle = proposed_offer["Bundle"]
+            key = tuple(bundle.tolist() if isinstance(bundle, np.ndarray) else bundle)
+            if not key or proposed_offer["Cost"] is None or not prev_offer:
+                fallback[i] = True
+                continue
+            selling[i], cost[i], initial_profit[i] = self.bundleTerms(key)
+            prior_utility[i] = prior_table.priorUtility(key)
+            offered_price[i] = proposed_offer["Cost"]
+            prev_cost[i] = prev_offer["Cost"]
+            if bg.bundleKey(prev_offer["Bundle"]) != bg.bundleKey(key):
+                changed[i] = True
+                pricer = self.pricer(float(self.max_initial_discount_rate[session]))
+                initial_cost[i] = pricer.getInitialOffer(bundle, self.recommender)["Cost"]
+
+        time = self.time[sessions]
+        alpha = self.alpha[sessions]
+        first_offer_value = self.first_offer_value[sessions]
+        buyer_count = self.buyer_utilities_count[sessions]
+        with np.errstate(all="ignore"):
+            # the opponent model
+            offer_value = (selling - offered_price) / selling
+            first_offer_value = np.where(first_offer_value == -1, offer_value, first_offer_value)
+            current_bid_utility = offer_value / first_offer_value
+            lr = pythonPower(time.astype(np.float64), np.full(n, config.learning_rate_exponent))
+            buyer_utility = (1 - lr) * current_bid_utility + lr * prior_utility
+            # min(1, buyer_utility)
+            buyer_utility = np.where(buyer_utility < 1, buyer_utility, 1.0)
+
+            # the agent utility
+            max_profit = selling - cost
+            agent_utility = (offered_price - cost) / max_profit
+            min_agent_utility = (initial_profit + self.min_profit_margin[sessions] * (
+                max_profit - initial_profit)) / max_profit
+            unprofitable = agent_utility <= 0
+
+            # TKI
+            first_round = buyer_count == 0
+            # compared exactly, nan where a utility is not finite
+            mean_comparison, var_comparison = self.compareStats("buyer_utilities", sessions, buyer_utility)
+            cooperative = ~(mean_comparison > 0) & ~(mean_comparison == 0)
+            passive = var_comparison > 0
+            neutral = (mean_comparison == 0) & (var_comparison == 0)
+            new_alpha = np.where(cooperative & passive, np.where(alpha < 1, alpha + 0.15, alpha),
+                                 np.where(neutral, alpha - 0.05, np.where(alpha > 0.3, alpha - 0.25, alpha)))
+            new_alpha = np.where(first_round, alpha, new_alpha)
+            pace = np.where(first_round, self.rounds[sessions] + time * config.first_round_pace,
+                            self.rounds[sessions] + time * config.pace)
+            pace = np.where(1 < pace, 1.0, pace)
+            target_utility = min_agent_utility + (1 - min_agent_utility) * (
+                1 - config.decay_factor * buyer_utility * pythonPower(pace, 1 / new_alpha))
+
+            # the bid space, from the mirror image of the buyer's offer up to the previous offer
+            max_cost = np.trunc(np.where(changed, initial_cost, prev_cost))
+            mirror = 2 * offered_price - max_cost
+            start_price = np.trunc(np.where(mirror > 0, mirror, 0))
+
+            # the acceptance model
+            accepted = (self.lastStats("offer_utilities", sessions) <= agent_utility) | \
+                       (self.compareStats("offer_utilities", sessions, agent_utility)[0] >= 0) | \
+                       (target_utility <= agent_utility)
+            target_price = np.floor(cost + target_utility * max_profit)
+            low = np.minimum(np.maximum(target_price - 2, start_price), max_cost)
+            high = np.maximum(np.minimum(target_price + 3, max_cost), start_price)
+            prices = low[:, np.newaxis] + np.arange(BID_WINDOW)
+            distance = np.abs(target_utility[:, np.newaxis] - (prices - cost[:, np.newaxis]) /
+                              max_profit[:, np.newaxis])
+            distance[prices > high[:, np.newaxis]] = np.inf
+            best_price = prices[np.arange(n), np.argmin(distance, axis=1)]
+            offer_utility = np.where(accepted, agent_utility, (best_price - cost) / max_profit)
+
+            # rounds getOffer raises on, or whose bid space bestOffer searches in full, are played by getOffer
+            counter = ~unprofitable & ~accepted
+            fallback |= (selling == 0) | (first_offer_value == 0) | (time == 0) | (max_profit == 0) | \
+                np.isnan(lr) | (self.offer_utilities_count[sessions] == 0)
+            fallback |= ~unprofitable & (~np.isfinite(target_utility) | ~np.isfinite(max_cost) |
+                                         ~np.isfinite(start_price) | (new_alpha == 0))
+            fallback |= counter & ((max_profit < 0) | (start_price > max_cost) | ~np.isfinite(target_price))
+
+        ok = ~fallback
+        played = sessions[ok]
+        for session, prev_offer in zip(played.tolist(), [prev_offers[i] for i in np.flatnonzero(ok).tolist()]):
+            self.prev_agent_offers[session].append(prev_offer)
+        self.first_offer_value[played] = first_offer_value[ok]
+        self.min_agent_utility[played] = min_agent_utility[ok]
+        self.agent_utility[played] = agent_utility[ok]
+        self.buyer_utility[played] = buyer_utility[ok]
+        profitable = ok & ~unprofitable
+        bidding = sessions[profitable]
+        self.target_utility[played] = np.where(unprofitable[ok], np.nan, target_utility[ok])
+        self.alpha[bidding] = new_alpha[profitable]
+        # TKI counts the round, getInitialOffer prices a new bundle as one more
+        self.time[bidding] += 1 + changed[profitable]
+        self.pushStats("buyer_utilities", bidding, buyer_utility[profitable])
+        self.pushStats("offer_utilities", bidding, offer_utility[profitable])
+
+        offers = []
+        for i, session in enumerate(sessions.tolist()):
+            proposed_offer = proposed_offers[i]
+            if fallback[i]:
+                agent = self.agent(session)
+                offer = bg.getOffer(agent, None, self.recommender, self.selling_price, self.product_list,
+                                    proposed_offer, prev_offers[i])
+                self.setState(session, agent.getState())
+                self.agent_utility[session], self.buyer_utility[session], self.target_utility[session] = [
+                    np.nan if value is None else value for value in agent.last_round]
+            elif unprofitable[i]:
+                offer = prev_offers[i]
+            elif accepted[i]:
+                offer = {"Bundle": proposed_offer["Bundle"], "Cost": proposed_offer["Cost"], "Accepted": True}
+            else:
+                offer = {"Bundle": proposed_offer["Bundle"], "Cost": int(best_price[i]), "Accepted": False}
+            offers.append(offer)
+
+        instrument.count("offers", int((ok & unprofitable).sum()), stage="unprofitable")
+        instrument.count("offers", int((profitable & accepted).sum()), stage="accepted")
+        instrument.count("offers", int((profitable & ~accepted).sum()), stage="counter")
+        if instrument.metrics_enabled or instrument.tracing():
+            bid_space_size = np.maximum(0, max_cost - start_price + 1)
+            for i in np.flatnonzero(profitable).tolist():
+                instrument.observe("bid_space_size", int(bid_space_size[i]))
+                if instrument.tracing():
+                    instrument.trace("round", proposed_offer=bg.serializeOffer(proposed_offers[i]),
+                                     offer=bg.serializeOffer(offers[i]), agent_utility=agent_utility[i],
+                                     buyer_utility=buyer_utility[i], target_utility=target_utility[i],
+                                     alpha=new_alpha[i], bid_space_size=int(bid_space_size[i]))
+        return offers
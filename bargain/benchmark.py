@@ -0,0 +1,1016 @@
+'''
+Benchmarks for the negotiation engine and the web endpoints
+Run from the bargain directory, e.g.
+    python benchmark.py --suites micro,e2e,http --sizes data.pkl,1000 --output results.json
+    python benchmark.py --suites micro,e2e --compare results.json
+Suites:
+    micro       - Agent.utility, getBidSpace, acceptanceModel, TKI and recommender lookups by bundle size and price
+    e2e         - full negotiations through getOffer
+    http        - /first_negotiate and /negotiate against a local gunicorn
+    comparisons - the optimized code paths against the implementations they replaced
+Every result is a record of suite, name, catalog, parameters, value and unit, written as JSON with --output;
+--compare flags the results that got slower than in an earlier output
+'''
+
+from __future__ import division, print_function
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from fractions import Fraction
+
+import numpy as np
+
+import bargain as bg
+import batch
+import bundles
+import catalog
+import generateData
+import history
+import instrument
+import neighbours
+import priors
+import store
+
+
+def syntheticCatalog(size, seed=0):
+    '''
+    Parameters:
+        size    - number of products
+        seed    - seed of the random catalog
+    Returns:
+        product_list, selling_price, cost_price and cooccurance_matrix as bargain.getData returns them,
+        the matrix is sparse beyond 5000 products
+    '''
+
+    return generateData.syntheticCatalog(size, sparse=size > 5000, random_state=np.random.RandomState(seed + size))
+
+
+def writePickle(path, product_list, selling_price, cost_price, cooccurance_matrix):
+    with open(path, "wb") as data_file:
+        bg.pickle.dump({"items": product_list, "selling_price": selling_price, "cost_price": cost_price,
+                        "cooccurance_matrix": cooccurance_matrix}, data_file, 2)
+
+
+def loadCatalog(name):
+    '''
+    Parameters:
+        name    - path of a data.pkl or catalog directory, or a number of products of a synthetic catalog
+    '''
+
+    if name.isdigit():
+        return syntheticCatalog(int(name))
+    return bg.getData(name)
+
+
+def record(suite, name, catalog_name, value, unit, **parameters):
+    return {"suite": suite, "name": name, "catalog": catalog_name, "parameters": parameters, "value": value,
+            "unit": unit}
+
+
+def bestTime(function, number, repeat=3):
+    # microseconds per call of the fastest repetition
+    return min(timeit.repeat(function, number=number, repeat=repeat)) * 1e6 / number
+
+
+def benchmarkBundles(product_list, selling_price, recommender, bundle_sizes=(1, 3, 10)):
+    '''
+    Bundles around the cheapest and the most expensive product, e.g. Screen Guard and Laptop in data.pkl
+    Returns:
+        list of (price label, bundle size, bundle)
+    '''
+
+    prices = [selling_price[name] for name in product_list]
+    bundles = []
+    for label, product_idx in [("cheapest", int(np.argmin(prices))), ("priciest", int(np.argmax(prices)))]:
+        others = [int(i) for i in recommender.getListOfPossibleItems(product_idx)]
+        others += [i for i in range(len(product_list)) if i != product_idx and i not in others]
+        for size in bundle_sizes:
+            if size <= len(product_list):
+                bundles.append((label, size, others[:size - 1] + [product_idx]))
+    return bundles
+
+
+def benchmarkMicro(catalog_name, product_list, selling_price, cost_price, cooccurance_matrix, number=2000):
+    '''
+    Times the stages of a negotiation round and the recommender lookups by bundle size and price
+    Returns:
+        list of result records, microseconds per call
+    '''
+
+    recommender = bg.RecommenderSystem(cooccurance_matrix)
+    selling_prices, cost_prices = bg.priceArrays(product_list, selling_price, cost_price)
+    results = []
+    for label, size, bundle in benchmarkBundles(product_list, selling_price, recommender):
+        agent = bg.Agent(product_list, cost_price, selling_price, selling_prices=selling_prices,
+                         cost_prices=cost_prices)
+        total_selling_price = agent.bundleTotals(bundle)[0]
+        prev_offer = {"Bundle": bundle, "Cost": total_selling_price, "Accepted": False}
+        proposed_offer = {"Bundle": bundle, "Cost": int(0.6 * total_selling_price)}
+        agent.prev_agent_offers_utilities.push(agent.utility(prev_offer, recommender))
+        agent_utility = agent.utility(proposed_offer, recommender)
+        bid_space = agent.getBidSpace(proposed_offer, 0.8, recommender, prev_offer)
+        parameters = {"price": label, "bundle_size": size, "selling_price": total_selling_price,
+                      "bids": len(bid_space)}
+        stages = [("utility", lambda: agent.utility(proposed_offer, recommender)),
+                  ("getBidSpace", lambda: agent.getBidSpace(proposed_offer, 0.8, recommender, prev_offer)),
+                  ("acceptanceModel", lambda: agent.acceptanceModel(bid_space, proposed_offer, 1.1, recommender,
+                                                                     agent_utility)),
+                  ("TKI", lambda: agent.TKI(0.5, agent_utility)),
+                  ("getListOfPossibleItems", lambda: recommender.getListOfPossibleItems(bundle[-1])),
+                  ("getInitialBundleRecommendation", lambda: recommender.getInitialBundleRecommendation(bundle[-1]))]
+        for name, function in stages:
+            results.append(record("micro", name, catalog_name, bestTime(function, number), "us", **parameters))
+    return results
+
+
+def replayNegotiations(recommender, product_list, selling_price, cost_price, negotiations, fractions,
+                       selling_prices=None, cost_prices=None):
+    '''
+    Plays scripted negotiations through getOffer, the buyer raising its counter-offer every round
+    Returns:
+        number of offers the agents made
+    '''
+
+    offers = 0
+    for n in range(negotiations):
+        product_idx = n % len(product_list)
+        agent = bg.Agent(product_list, cost_price, selling_price, selling_prices=selling_prices,
+                         cost_prices=cost_prices)
+        buyer = bg.Buyer(len(product_list))
+        offer = bg.getOffer(agent, buyer, recommender, selling_price, product_list,
+                            {"Bundle": [product_idx], "Cost": None}, None)
+        offers += 1
+        bundle = [int(i) for i in offer["Bundle"]]
+        total_selling_price = agent.bundleTotals(bundle)[0]
+        for fraction in fractions:
+            offer = bg.getOffer(agent, buyer, recommender, selling_price, product_list,
+                                {"Bundle": bundle, "Cost": int(total_selling_price * fraction)}, offer)
+            offers += 1
+            if offer.get("Accepted"):
+                break
+    return offers
+
+
+def benchmarkEndToEnd(catalog_name, product_list, selling_price, cost_price, cooccurance_matrix, negotiations=500):
+    '''
+    Times whole negotiations through getOffer
+    Returns:
+        list of result records
+    '''
+
+    recommender = bg.RecommenderSystem(cooccurance_matrix)
+    selling_prices, cost_prices = bg.priceArrays(product_list, selling_price, cost_price)
+    fractions = [0.55, 0.65, 0.75, 0.85]
+    start = timeit.default_timer()
+    offers = replayNegotiations(recommender, product_list, selling_price, cost_price, negotiations, fractions,
+                                selling_prices, cost_prices)
+    elapsed = timeit.default_timer() - start
+    return [record("e2e", "negotiation", catalog_name, elapsed * 1e6 / negotiations, "us", negotiations=negotiations),
+            record("e2e", "getOffer", catalog_name, elapsed * 1e6 / offers, "us", offers=offers)]
+
+
+def benchmarkHttp(catalog_name, product_list, selling_price, cost_price, cooccurance_matrix, negotiations=100,
+                  concurrency=4, workers=2, port=8098):
+    '''
+    Times the HTML views of a local gunicorn serving the catalog
+    Returns:
+        list of result records, latency percentiles in milliseconds and throughput in requests per second
+    '''
+
+    import loadtest
+
+    directory = tempfile.mkdtemp()
+    try:
+        catalog_path = os.path.join(directory, "catalog")
+        selling_prices, cost_prices = bg.priceArrays(product_list, selling_price, cost_price)
+        catalog.Catalog(product_list, selling_prices, cost_prices, cooccurance_matrix).save(catalog_path)
+        recommender = bg.RecommenderSystem(cooccurance_matrix)
+        scripts = [loadtest.negotiationScript(n, product_list, selling_price, recommender)
+                   for n in range(negotiations)]
+        server = loadtest.startServer(port, workers, "sqlite:///" + os.path.join(directory, "store.db"),
+                                      catalog_path=catalog_path)
+        try:
+            first_latencies, latencies = [], []
+
+            def run(base_url, product_name, rounds, _):
+                # the first request of a negotiation is /first_negotiate, the others /negotiate
+                calls = []
+                transcript = loadtest.runNegotiation(base_url, product_name, rounds, calls)
+                first_latencies.append(calls[0])
+                latencies.extend(calls[1:])
+                return transcript
+
+            _, _, elapsed = loadtest.runAll("http://127.0.0.1:%d" % port, scripts, concurrency, run)
+        finally:
+            server.terminate()
+            server.wait()
+    finally:
+        shutil.rmtree(directory)
+
+    parameters = {"workers": workers, "concurrency": concurrency, "negotiations": negotiations}
+    results = [record("http", "throughput", catalog_name, (len(first_latencies) + len(latencies)) / elapsed, "req/s",
+                      **parameters)]
+    for name, values in [("first_negotiate", first_latencies), ("negotiate", latencies)]:
+        for q in [0.5, 0.95, 0.99]:
+            results.append(record("http", "%s_p%d" % (name, q * 100), catalog_name,
+                                  loadtest.percentile(values, q) * 1000, "ms", **parameters))
+    return results
+
+
+def benchmarkComparisons(product_list, selling_price, cost_price, cooccurance_matrix):
+    '''
+    Runs the comparisons of the optimized code paths against the code they replaced on the bundled catalog
+    Returns:
+        list of result records, one per variant
+    '''
+
+    results = []
+    for names, size, legacy_time, engine_time in benchmarkBidSpace(product_list, selling_price, cost_price,
+                                                                   cooccurance_matrix):
+        for variant, value in [("legacy", legacy_time), ("engine", engine_time)]:
+            results.append(record("comparisons", "bid_space", "data.pkl", value * 1000, "ms", bundle=names, bids=size,
+                                  variant=variant))
+    for size, legacy_rate, array_rate in benchmarkUtility(product_list, selling_price, cost_price, cooccurance_matrix):
+        for variant, value in [("dict", legacy_rate), ("array", array_rate)]:
+            results.append(record("comparisons", "utility", "data.pkl", value, "calls/s", bundle_size=size,
+                                  variant=variant))
+    for variant, offer_time in benchmarkInstrumentation(product_list, selling_price, cost_price, cooccurance_matrix):
+        results.append(record("comparisons", "instrumentation", "data.pkl", offer_time, "us", variant=variant))
+    for variant, round_time, prior_hit_rate, offer_hit_rate in benchmarkPriors():
+        results.append(record("comparisons", "prior_utility", "1000", round_time, "us", variant=variant,
+                              prior_hit_rate=prior_hit_rate, initial_offer_hit_rate=offer_hit_rate))
+    for length, legacy_rate, running_rate in benchmarkRunningStats():
+        for variant, value in [("numpy", legacy_rate), ("running", running_rate)]:
+            results.append(record("comparisons", "tki_statistics", "", value, "calls/s", history=length,
+                                  variant=variant))
+    for kind, histories, exact_mismatches, numpy_mismatches in checkTkiTies():
+        results.append(record("comparisons", "tki_ties", "", exact_mismatches, "comparisons", history=kind,
+                              histories=histories, numpy_mismatches=numpy_mismatches))
+    for size, legacy_rate, index_rate in benchmarkProductIndex():
+        for variant, value in [("scan", legacy_rate), ("index", index_rate)]:
+            results.append(record("comparisons", "product_names", str(size), value, "calls/s", variant=variant))
+    for size, pickle_time, catalog_time in benchmarkCatalogLoad():
+        for variant, value in [("pickle", pickle_time), ("mmap", catalog_time)]:
+            results.append(record("comparisons", "catalog_load", str(size), value * 1000, "ms", variant=variant))
+    for variant, search_time, expected_profit, optimum in benchmarkBundleSearch():
+        results.append(record("comparisons", "bundle_search", "2000", search_time, "us", variant=variant,
+                              expected_profit=expected_profit, share_of_optimum=optimum))
+    for variant, value, state_size in benchmarkBuyer():
+        results.append(record("comparisons", "buyer_utilities", "4000", value, "us", variant=variant,
+                              state_bytes=state_size))
+    for page, variant, value in benchmarkPages():
+        results.append(record("comparisons", "page_render", "data.pkl", value, "us", page=page, variant=variant))
+    for batch_size, variant, value in benchmarkBatch():
+        results.append(record("comparisons", "batch_step", "1000", value, "us", variant=variant, batch_size=batch_size))
+    for variant, growth, state_size, rss in benchmarkHistory():
+        results.append(record("comparisons", "history_memory", "", growth, "MB", variant=variant,
+                              state_bytes=state_size, rss_mb=rss))
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.STDOUT).decode().strip()
+    except Exception:
+        commit = None
+    return {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+            "processor": platform.processor(), "cpus": multiprocessing.cpu_count(), "commit": commit,
+            "time": time.time()}
+
+
+def resultKey(result):
+    return (result["suite"], result["name"], result["catalog"], json.dumps(result["parameters"], sort_keys=True))
+
+
+# units of results where more is better, the others are times
+RATE_UNITS = ["req/s", "calls/s"]
+
+
+def compareResults(results, baseline, tolerance=0.2):
+    '''
+    Parameters:
+        results     - result records of this run
+        baseline    - result records of an earlier run
+        tolerance   - relative slowdown tolerated before a result counts as a regression
+    Returns:
+        list of (result, baseline value, relative change) of the results that got slower
+    '''
+
+    previous = dict((resultKey(result), result["value"]) for result in baseline)
+    regressions = []
+    for result in results:
+        value = previous.get(resultKey(result))
+        if not value:
+            continue
+        if result["unit"] in RATE_UNITS:
+            change = value / result["value"] - 1 if result["value"] else float("inf")
+        else:
+            change = result["value"] / value - 1
+        if change > tolerance:
+            regressions.append((result, value, change))
+    return regressions
+
+
+def printResults(results):
+    print("%-12s %-32s %-10s %12s %-8s %s" % ("suite", "name", "catalog", "value", "unit", "parameters"))
+    for result in results:
+        print("%-12s %-32s %-10s %12.3f %-8s %s" % (result["suite"], result["name"], result["catalog"],
+                                                   result["value"], result["unit"],
+                                                   " ".join("%s=%s" % item
+                                                            for item in sorted(result["parameters"].items()))))
+
+
+SUITES = ["micro", "e2e", "http", "comparisons"]
+
+
+def legacyBidSpaceOffer(agent, proposed_offer, target_utility, recommender, prev_offer):
+    '''
+    The per-integer-price bid space and acceptance loop the BidSpace engine replaced,
+    kept as the reference the engine is checked and timed against
+    Parameters:
+        agent           - the agent participating in the negotiation
+        proposed_offer  - offer proposed by buyer
+        target_utility  - the target utility of the offer that the agent should propose
+        recommender     - the recommendation system used by the agent
+        prev_offer      - previous offer made by the agent
+    Returns:
+        new_offer       - the counter-offer closest to target_utility
+    '''
+
+    max_cost = int(prev_offer["Cost"])
+    offered_price = proposed_offer["Cost"]
+    start_offer_price = int(max(0, 2 * offered_price - max_cost))
+    bid_space = []
+    for price in range(start_offer_price, max_cost + 1):
+        bid_space.append({"Bundle": proposed_offer["Bundle"], "Cost": price})
+
+    bid_space_utility_list = [agent.utility(offer, recommender) for offer in bid_space]
+    new_offer = {}
+    min_difference_utility = float("inf")
+    for idx in range(len(bid_space_utility_list)):
+        if min_difference_utility > abs(target_utility - bid_space_utility_list[idx]):
+            new_offer["Bundle"] = bid_space[idx]["Bundle"]
+            new_offer["Cost"] = bid_space[idx]["Cost"]
+            new_offer["Accepted"] = False
+            min_difference_utility = abs(target_utility - bid_space_utility_list[idx])
+    return new_offer
+
+
+def engineBidSpaceOffer(agent, proposed_offer, target_utility, recommender, prev_offer):
+    bid_space = agent.getBidSpace(proposed_offer, target_utility, recommender, prev_offer)
+    return bid_space.bestOffer(target_utility)
+
+
+def benchmarkBidSpace(product_list, selling_price, cost_price, cooccurance_matrix, repeat=5):
+    '''
+    Times the legacy bid space loop against the BidSpace engine for bundles of growing size
+    and checks that both pick the same counter-offer
+    Parameters:
+        product_list        - list of the entire product base
+        selling_price       - list with the selling price of the entire product base
+        cost_price          - list with the cost price of the entire product base
+        cooccurance_matrix  - the cooccurance matrix of the recommendation system
+        repeat              - number of timed runs per bundle, the best one is reported
+    Returns:
+        results             - list of (bundle names, bid space size, legacy seconds, engine seconds)
+    '''
+
+    recommender = bg.RecommenderSystem(cooccurance_matrix)
+    bundles = [["Screen Guard"], ["Phone Case", "Screen Guard"], ["Phone Case", "Screen Guard", "Smartphone"],
+               ["Laptop"], ["Mouse", "Laptop"], ["Mouse", "Keyboard", "Laptop"]]
+    results = []
+    for names in bundles:
+        agent = bg.Agent(product_list, cost_price, selling_price)
+        bundle = bg.getProductIndex(product_list, ",".join(names))
+        total_selling_price, total_cost_price = agent.bundleTotals(bundle)
+        prev_offer = {"Bundle": bundle, "Cost": total_selling_price, "Accepted": False}
+        proposed_offer = {"Bundle": bundle, "Cost": int(0.6 * total_selling_price)}
+        for target_utility in [0.0, 0.35, 0.8, 1.2]:
+            legacy = legacyBidSpaceOffer(agent, proposed_offer, target_utility, recommender, prev_offer)
+            engine = engineBidSpaceOffer(agent, proposed_offer, target_utility, recommender, prev_offer)
+            assert legacy == engine, (names, target_utility, legacy, engine)
+
+        size = len(agent.getBidSpace(proposed_offer, 0.8, recommender, prev_offer))
+        legacy_time = min(timeit.repeat(
+            lambda: legacyBidSpaceOffer(agent, proposed_offer, 0.8, recommender, prev_offer), number=1, repeat=repeat))
+        engine_time = min(timeit.repeat(
+            lambda: engineBidSpaceOffer(agent, proposed_offer, 0.8, recommender, prev_offer), number=1, repeat=repeat))
+        results.append((" + ".join(names), size, legacy_time, engine_time))
+    return results
+
+
+def legacyUtility(agent, proposed_offer):
+    '''
+    Agent.utility as it was before prices were held in arrays: a name lookup per item and per call
+    '''
+
+    product_idx = proposed_offer["Bundle"][-1]
+    total_selling_price = 0
+    for i in proposed_offer["Bundle"]:
+        total_selling_price += agent.selling_price[agent.product_list[i]]
+    total_cost_price = 0
+    for i in proposed_offer["Bundle"]:
+        total_cost_price += agent.cost_price[agent.product_list[i]]
+
+    max_profit = total_selling_price - total_cost_price
+    initial_profit = agent.selling_price[agent.product_list[product_idx]] - agent.cost_price[
+        agent.product_list[product_idx]]
+    agent.min_agent_utility = (initial_profit + agent.min_profit_margin * (max_profit - initial_profit)) / max_profit
+    return (proposed_offer["Cost"] - total_cost_price) / max_profit
+
+
+def benchmarkUtility(product_list, selling_price, cost_price, cooccurance_matrix, number=20000):
+    '''
+    Compares the throughput of the name-keyed and the array-backed agent utility for bundles of growing size
+    Returns:
+        results - list of (bundle size, legacy calls per second, array-backed calls per second)
+    '''
+
+    recommender = bg.RecommenderSystem(cooccurance_matrix)
+    agent = bg.Agent(product_list, cost_price, selling_price)
+    results = []
+    for size in range(1, len(product_list) + 1, 3):
+        bundle = list(range(size))
+        offer = {"Bundle": bundle, "Cost": agent.bundleTotals(bundle)[0] * 0.8}
+        assert legacyUtility(agent, offer) == agent.utility(offer, recommender)
+        legacy_time = min(timeit.repeat(lambda: legacyUtility(agent, offer), number=number, repeat=3))
+        array_time = min(timeit.repeat(lambda: agent.utility(offer, recommender), number=number, repeat=3))
+        results.append((size, number / legacy_time, number / array_time))
+    return results
+
+
+def legacyPriorUtility(cooccurance_matrix, bundle):
+    '''
+    The prior utility as Agent.opponentModel and Agent.getInitialOffer computed it on every call
+    '''
+
+    prior_utility = 0
+    product_idx = bundle[-1]
+    for i in bundle[:-1]:
+        prior_utility += cooccurance_matrix[product_idx][i] / cooccurance_matrix[product_idx][product_idx]
+    if len(bundle) > 1:
+        prior_utility /= (len(bundle) - 1)
+    return prior_utility
+
+
+def benchmarkPriors(size=1000, negotiations=20000, bundles_per_product=3, rounds=4):
+    '''
+    Replays the prior utility lookups of many negotiations, a first offer and a few rounds each, without the
+    prior table, with its caches disabled and with them enabled
+    Parameters:
+        size                - number of products of the synthetic catalog
+        negotiations        - number of negotiations replayed, enough for the caches to warm up: with 2000 they
+                              hit about a quarter of the initial offers and save little
+        bundles_per_product - number of distinct bundles the buyers of a product ask for
+        rounds              - number of rounds of every negotiation
+    Returns:
+        results - list of (variant, microseconds per round, prior hit rate, initial offer hit rate)
+    '''
+
+    random_state = np.random.RandomState(size)
+    matrix = random_state.randint(1, 1000, (size, size))
+    np.fill_diagonal(matrix, 1000)
+    items = ["Product %d" % i for i in range(size)]
+    prices = dict(zip(items, random_state.randint(100, 10000, size).tolist()))
+    costs = dict((name, price // 2) for name, price in prices.items())
+    selling_prices, cost_prices = bg.priceArrays(items, prices, costs)
+    products = random_state.randint(0, size, negotiations)
+    bundles = [[(random_state.randint(0, size, 1 + n % 3).tolist() + [product_idx]) for n in range(bundles_per_product)]
+               for product_idx in range(size)]
+    scripts = [[bundles[product_idx][random_state.randint(bundles_per_product)] for _ in range(rounds)]
+               for product_idx in products]
+
+    neighbour_index = neighbours.buildNeighbourIndex(matrix)
+
+    def replay(prior_table):
+        recommender = bg.RecommenderSystem(matrix, neighbour_index, prior_table=prior_table)
+        for script in scripts:
+            # a new agent per negotiation, as the web app restores one per round
+            agent = bg.Agent(items, costs, prices, selling_prices=selling_prices, cost_prices=cost_prices)
+            agent.getInitialOffer(np.array(script[0]), recommender)
+            for bundle in script:
+                prior_table.priorUtility(bundle)
+
+    def replayLegacy():
+        for script in scripts:
+            agent = bg.Agent(items, costs, prices, selling_prices=selling_prices, cost_prices=cost_prices)
+            bundle = np.array(script[0])
+            legacyPriorUtility(matrix, bundle)
+            agent.bundleTotals(bundle[:-1])
+            for bundle in script:
+                legacyPriorUtility(matrix, bundle)
+
+    results = []
+    start = timeit.default_timer()
+    replayLegacy()
+    results.append(("recomputed", (timeit.default_timer() - start) * 1e6 / (negotiations * rounds), 0, 0))
+    for variant, capacity in [("table, no cache", 0), ("table, lru cache", 100000)]:
+        prior_table = priors.PriorTable(matrix, capacity)
+        start = timeit.default_timer()
+        replay(prior_table)
+        elapsed = timeit.default_timer() - start
+        results.append((variant, elapsed * 1e6 / (negotiations * rounds), prior_table.priors.hitRate(),
+                        prior_table.initial_offers.hitRate()))
+    return results
+
+
+def benchmarkInstrumentation(product_list, selling_price, cost_price, cooccurance_matrix, negotiations=300):
+    '''
+    Times scripted negotiations with the instrumentation off, collecting metrics and also tracing
+    Returns:
+        results - list of (variant, microseconds per offer)
+    '''
+
+    recommender = bg.RecommenderSystem(cooccurance_matrix)
+    selling_prices, cost_prices = bg.priceArrays(product_list, selling_price, cost_price)
+
+    def replay():
+        return replayNegotiations(recommender, product_list, selling_price, cost_price, negotiations,
+                                  [0.55, 0.65, 0.75, 0.85], selling_prices, cost_prices)
+
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        for variant, metrics, trace in [("off", False, ""), ("metrics", True, ""),
+                                        ("metrics and trace", True, os.path.join(directory, "trace.jsonl"))]:
+            instrument.configure(metrics=metrics, trace=trace)
+            start = timeit.default_timer()
+            offers = replay()
+            results.append((variant, (timeit.default_timer() - start) * 1e6 / offers))
+    finally:
+        instrument.configure(metrics=False, trace="")
+        instrument.reset()
+        shutil.rmtree(directory)
+    return results
+
+
+def tkiMode(buyer_utility, mean_buyer_utility, var_buyer_utility):
+    # the comparisons Agent.TKI bases its cooperativeness and assertiveness on
+    current_var_buyer_utility = (buyer_utility - mean_buyer_utility) ** 2
+    return (buyer_utility > mean_buyer_utility, buyer_utility == mean_buyer_utility,
+            current_var_buyer_utility > var_buyer_utility, current_var_buyer_utility == var_buyer_utility)
+
+
+def runningTkiMode(buyer_utility, stats):
+    # the same comparisons, as Agent.TKI makes them on its running statistics
+    mean_comparison, var_comparison = stats.compareMean(buyer_utility), stats.compareDeviation(buyer_utility)
+    return mean_comparison > 0, mean_comparison == 0, var_comparison > 0, var_comparison == 0
+
+
+def exactTkiMode(buyer_utility, history):
+    # the same comparisons in rational arithmetic
+    values = [Fraction(value) for value in history]
+    mean = sum(values) / len(values)
+    variance = sum((value - mean) ** 2 for value in values) / len(values)
+    return tkiMode(Fraction(buyer_utility), mean, variance)
+
+
+def benchmarkRunningStats(lengths=(10, 1000, 100000), number=200):
+    '''
+    Compares a TKI round recomputing mean and variance over the whole buyer utility history
+    against the running statistics, for histories of growing length
+    Returns:
+        results - list of (history length, recomputed rounds per second, running rounds per second)
+    '''
+
+    random_state = np.random.RandomState(0)
+    results = []
+    for length in lengths:
+        history = random_state.random_sample(length).tolist()
+        stats = bg.RunningStats()
+        for buyer_utility in history:
+            stats.push(buyer_utility)
+        # without ties numpy rounds the same way
+        for buyer_utility in random_state.random_sample(100).tolist():
+            assert tkiMode(buyer_utility, np.mean(history), np.var(history)) == runningTkiMode(buyer_utility, stats)
+
+        legacy_time = min(timeit.repeat(lambda: tkiMode(0.5, np.mean(history), np.var(history)), number=number,
+                                        repeat=3))
+        running_time = min(timeit.repeat(lambda: runningTkiMode(0.5, stats), number=number, repeat=3))
+        results.append((length, number / legacy_time, number / running_time))
+    return results
+
+
+def checkTkiTies(histories=6000, max_length=12):
+    '''
+    Compares the TKI comparisons of the running statistics with rational arithmetic and numpy on histories full of
+    ties: utilities drawn from three values, repeated and alternating
+    Returns:
+        results - list of (history kind, histories, comparisons differing from rational arithmetic, from numpy)
+    '''
+
+    random_state = np.random.RandomState(0)
+    values = [0.0, 0.4, round(1 / 3, 2)]
+    kinds = [("drawn", lambda length: [values[i] for i in random_state.randint(0, 3, length)]),
+             ("repeated", lambda length: [values[random_state.randint(0, 3)]] * length),
+             ("alternating", lambda length: [values[i % 2 + random_state.randint(0, 2)] for i in range(length)])]
+    results = []
+    for kind, draw in kinds:
+        exact_mismatches = numpy_mismatches = 0
+        for _ in range(histories // len(kinds)):
+            history = draw(random_state.randint(1, max_length + 1))
+            stats = bg.RunningStats()
+            for buyer_utility in history:
+                stats.push(buyer_utility)
+            for buyer_utility in values:
+                running = runningTkiMode(buyer_utility, stats)
+                exact_mismatches += sum(bool(a != b) for a, b in zip(running, exactTkiMode(buyer_utility, history)))
+                numpy_mismatches += sum(bool(a != b) for a, b in zip(
+                    running, tkiMode(buyer_utility, np.mean(history), np.var(history))))
+        results.append((kind, histories // len(kinds), exact_mismatches, numpy_mismatches))
+    return results
+
+
+def legacyProductIndex(product_list, product_names):
+    '''
+    bargain.getProductIndex before the name index: a scan of the product base for every name
+    '''
+
+    product_name_list = product_names.split(',')
+    idx_lst = []
+    for j in range(len(product_name_list)):
+        product_name = product_name_list[j]
+        for i in range(len(product_list)):
+            if product_list[i] == product_name:
+                idx_lst.append(i)
+                break
+    return idx_lst
+
+
+def benchmarkProductIndex(sizes=(10, 1000, 10000), bundle_size=4, number=200):
+    '''
+    Compares resolving a bundle of product names by scanning the product base against the ProductIndex
+    Returns:
+        results - list of (number of products, scan lookups per second, index lookups per second)
+    '''
+
+    results = []
+    for size in sizes:
+        product_list = ["Product %d" % i for i in range(size)]
+        product_index = catalog.ProductIndex(product_list)
+        # the last products are the worst case of the scan
+        product_names = ",".join(product_list[-bundle_size:])
+        assert legacyProductIndex(product_list, product_names) == bg.getProductIndex(product_list, product_names,
+                                                                                        product_index)
+        legacy_time = min(timeit.repeat(lambda: legacyProductIndex(product_list, product_names), number=number,
+                                        repeat=3))
+        index_time = min(timeit.repeat(lambda: bg.getProductIndex(product_list, product_names, product_index),
+                                       number=number, repeat=3))
+        results.append((size, number / legacy_time, number / index_time))
+    return results
+
+
+def benchmarkCatalogLoad(sizes=(10, 1000, 4000), repeat=5):
+    '''
+    Times bargain.getData on a data.pkl against the memory-mapped catalog converted from it
+    Parameters:
+        sizes   - numbers of products of the synthetic catalogs, the bundled data.pkl is used for 10
+        repeat  - number of timed loads per format, the best one is reported
+    Returns:
+        results - list of (number of products, pickle seconds, catalog seconds)
+    '''
+
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        for size in sizes:
+            pickle_path = os.path.join(directory, "data%d.pkl" % size)
+            catalog_path = os.path.join(directory, "catalog%d" % size)
+            if size == 10:
+                shutil.copy("./data.pkl", pickle_path)
+            else:
+                writePickle(pickle_path, *syntheticCatalog(size))
+            catalog.convertPickle(pickle_path, catalog_path)
+            pickle_time = min(timeit.repeat(lambda: bg.getData(pickle_path), number=1, repeat=repeat))
+            catalog_time = min(timeit.repeat(lambda: bg.getData(catalog_path), number=1, repeat=repeat))
+            results.append((size, pickle_time, catalog_time))
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def benchmarkBundleSearch(size=2000, products=300, max_items=3, candidates=10):
+    '''
+    Compares the add-ons of the initial offers chosen by the top 2 neighbours, greedy selection and beam search
+    against the best bundle of up to max_items add-ons, found by trying them all
+    Returns:
+        results - list of (variant, microseconds per uncached search, mean expected profit, share of the optimum)
+    '''
+
+    product_list, selling_price, cost_price, cooccurance_matrix = syntheticCatalog(size)
+    selling_prices, cost_prices = bg.priceArrays(product_list, selling_price, cost_price)
+    recommender = bg.RecommenderSystem(cooccurance_matrix, k=candidates)
+    agent = bg.Agent(product_list, cost_price, selling_price, selling_prices=selling_prices, cost_prices=cost_prices)
+    scorer = bundles.BundleSearch(candidates=candidates)
+    # products that never sold with another one have nothing to bundle
+    product_ids = [product_idx for product_idx in np.random.RandomState(size).permutation(size).tolist()
+                   if len(recommender.neighbour_index.topNeighbours(product_idx, 1))][:products]
+    products = len(product_ids)
+
+    def score(add_ons, product_idx):
+        return scorer.score(agent, recommender, tuple(sorted(int(i) for i in add_ons)), product_idx)
+
+    optimum = []
+    for product_idx in product_ids:
+        top = recommender.neighbour_index.topNeighbours(product_idx, candidates).tolist()
+        optimum.append(max(score(combination, product_idx) for n in range(1, max_items + 1)
+                           for combination in itertools.combinations(top, n)))
+    optimum_total = sum(optimum)
+
+    results = []
+    start = timeit.default_timer()
+    top_two = [recommender.getListOfPossibleItems(product_idx) for product_idx in product_ids]
+    elapsed = timeit.default_timer() - start
+    total = sum(score(add_ons, product_idx) for add_ons, product_idx in zip(top_two, product_ids))
+    results.append(("top 2", elapsed * 1e6 / products, total / products, total / optimum_total))
+    for variant, beam_width in [("greedy", 1), ("beam 4", 4)]:
+        search = bundles.BundleSearch(max_items=max_items, beam_width=beam_width, candidates=candidates,
+                                      time_budget=1.0)
+        start = timeit.default_timer()
+        found = [search.search(agent, recommender, product_idx) for product_idx in product_ids]
+        elapsed = timeit.default_timer() - start
+        total = sum(score(add_ons, product_idx) for add_ons, product_idx in zip(found, product_ids))
+        results.append((variant, elapsed * 1e6 / products, total / products, total / optimum_total))
+    return results
+
+
+def legacyBuyerUtility(lift, momp, mclp, proposed_bundle):
+    # the list based Buyer.utility, with the lift of the product as it was meant to be read
+    product_idx = proposed_bundle[-1]
+    lift_sum = 0
+    for idx in proposed_bundle[:-1]:
+        lift_sum += lift[product_idx][idx]
+    return lift_sum / max(len(proposed_bundle) - 1, 1) \
+        + sum([momp[i] for i in proposed_bundle]) / len(proposed_bundle) \
+        - sum([mclp[i] for i in proposed_bundle]) / len(proposed_bundle)
+
+
+def benchmarkBuyer(size=4000, bundles=1000, number=5):
+    '''
+    Rates the candidate bundles of a buyer one by one with list counters and in one call of Buyer.utilities
+    Returns:
+        results - list of (variant, microseconds per bundle, bytes of the stored buyer state)
+    '''
+
+    product_list, selling_price, cost_price, cooccurance_matrix = syntheticCatalog(size)
+    recommender = bg.RecommenderSystem(cooccurance_matrix)
+    random_state = np.random.RandomState(size)
+    candidates = [random_state.randint(0, size, 1 + n % 4).tolist() for n in range(bundles)]
+    buyer = bg.Buyer(size)
+    for bundle in candidates[:20]:
+        buyer.utility({"Bundle": bundle}, {"Bundle": candidates[-1]}, recommender)
+    # the rows of the lift matrix the legacy model reads, gathered beforehand
+    lift = {}
+    for bundle in candidates:
+        lift.setdefault(bundle[-1], {}).update(zip(bundle[:-1], buyer.initialUtility(recommender, bundle[-1],
+                                                                                      bundle[:-1])))
+    momp, mclp = buyer.MOMP.tolist(), buyer.MCLP.tolist()
+
+    legacy = [legacyBuyerUtility(lift, momp, mclp, bundle) for bundle in candidates]
+    if not np.allclose(legacy, buyer.utilities(candidates, recommender)):
+        raise AssertionError("Buyer.utilities differs from the list based model")
+    legacy_state = len(json.dumps({"MOMP_lst": momp, "MCLP_lst": mclp}, separators=(',', ':')))
+    state = len(json.dumps(buyer.getState(), separators=(',', ':')))
+    return [("lists", bestTime(lambda: [legacyBuyerUtility(lift, momp, mclp, bundle) for bundle in candidates],
+                               number) / bundles, legacy_state),
+            ("arrays, batched", bestTime(lambda: buyer.utilities(candidates, recommender), number) / bundles, state)]
+
+
+def benchmarkPages(number=500):
+    '''
+    Times the rendering of the index and negotiate pages with the fragment cache of pages.py disabled and enabled
+    Returns:
+        results - list of (page, variant, microseconds per page)
+    '''
+
+    # the web app reads its catalog when imported, flask is only needed by this benchmark
+    import main
+    import pages
+
+    offer = {"Bundle": [5, 4, 3], "Cost": 40000, "Accepted": False}
+    offer_history = [{"Bundle": [5, 4, 3], "Cost": 41000}, {"Bundle": [4, 3], "Cost": 30000}] * 3
+    results = []
+    capacity = pages.fragments.capacity
+    try:
+        with main.app.test_request_context():
+            for variant, fragment_capacity in [("uncached", 0), ("cached", capacity)]:
+                pages.clear()
+                pages.fragments.capacity = fragment_capacity
+
+                def index():
+                    if not fragment_capacity:
+                        pages.index_page = None
+                    pages.indexPage()
+                for page, function in [("index", index),
+                                       ("negotiate", lambda: pages.negotiatePage(offer, 1000, offer_history, 0))]:
+                    function()
+                    results.append((page, variant, bestTime(function, number)))
+    finally:
+        pages.fragments.capacity = capacity
+        pages.clear()
+    return results
+
+
+def playBatch(negotiation_batch, recommender, product_ids, fractions):
+    '''
+    Plays the negotiations of replayNegotiations through a NegotiationBatch, a round of all open ones per step
+    Returns:
+        list of the offers of every negotiation
+    '''
+
+    sessions = [negotiation_batch.addSession() for _ in product_ids]
+    offers = negotiation_batch.start(sessions, product_ids)
+    history = [[offer] for offer in offers]
+    bundles = [[int(i) for i in offer["Bundle"]] for offer in offers]
+    totals = [negotiation_batch.bundleTerms(tuple(bundle))[0] for bundle in bundles]
+    open_negotiations = list(range(len(product_ids)))
+    for fraction in fractions:
+        proposed_offers = [{"Bundle": bundles[n], "Cost": int(totals[n] * fraction)} for n in open_negotiations]
+        offers = negotiation_batch.step([sessions[n] for n in open_negotiations], proposed_offers,
+                                        [history[n][-1] for n in open_negotiations])
+        for n, offer in zip(open_negotiations, offers):
+            history[n].append(offer)
+        open_negotiations = [n for n in open_negotiations if not history[n][-1].get("Accepted")]
+    for session in sessions:
+        negotiation_batch.removeSession(session)
+    return history
+
+
+def playScalar(recommender, product_list, selling_price, cost_price, selling_prices, cost_prices, product_ids,
+               fractions):
+    # replayNegotiations, keeping the offers
+    history = []
+    for product_idx in product_ids:
+        agent = bg.Agent(product_list, cost_price, selling_price, selling_prices=selling_prices,
+                         cost_prices=cost_prices)
+        offers = [bg.getOffer(agent, None, recommender, selling_price, product_list,
+                              {"Bundle": [product_idx], "Cost": None}, None)]
+        bundle = [int(i) for i in offers[0]["Bundle"]]
+        total_selling_price = agent.bundleTotals(bundle)[0]
+        for fraction in fractions:
+            offers.append(bg.getOffer(agent, None, recommender, selling_price, product_list,
+                                      {"Bundle": bundle, "Cost": int(total_selling_price * fraction)}, offers[-1]))
+            if offers[-1].get("Accepted"):
+                break
+        history.append(offers)
+    return history
+
+
+def benchmarkBatch(size=1000, batch_sizes=(1, 16, 256), fractions=(0.5, 0.6, 0.7, 0.75, 0.8, 0.85, 0.9),
+                   number=3):
+    '''
+    Plays the same scripted negotiations session by session through getOffer and a batch at a time through
+    NegotiationBatch.step
+    Returns:
+        results - list of (batch size, variant, microseconds per offer)
+    '''
+
+    product_list, selling_price, cost_price, cooccurance_matrix = syntheticCatalog(size)
+    recommender = bg.RecommenderSystem(cooccurance_matrix)
+    selling_prices, cost_prices = bg.priceArrays(product_list, selling_price, cost_price)
+    negotiation_batch = batch.NegotiationBatch(product_list, cost_price, selling_price, recommender,
+                                               selling_prices=selling_prices, cost_prices=cost_prices)
+    results = []
+    for batch_size in batch_sizes:
+        product_ids = [n * 7 % size for n in range(batch_size)]
+        scalar = playScalar(recommender, product_list, selling_price, cost_price, selling_prices, cost_prices,
+                            product_ids, fractions)
+        batched = playBatch(negotiation_batch, recommender, product_ids, fractions)
+        serialized = [[bg.serializeOffer(offer) for offer in offers] for offers in scalar]
+        if serialized != [[bg.serializeOffer(offer) for offer in offers] for offers in batched]:
+            raise AssertionError("NegotiationBatch.step differs from getOffer")
+        offers = sum(len(offers) for offers in scalar)
+        results.append((batch_size, "getOffer", bestTime(
+            lambda: playScalar(recommender, product_list, selling_price, cost_price, selling_prices, cost_prices,
+                               product_ids, fractions), number) / offers))
+        results.append((batch_size, "batch", bestTime(
+            lambda: playBatch(negotiation_batch, recommender, product_ids, fractions), number) / offers))
+    return results
+
+
+
+def residentMemory():
+    '''
+    Returns:
+        the resident set size of the process in MB, its peak where /proc is not available
+    '''
+
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (IOError, OSError):
+        import resource
+        # kilobytes on Linux, bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def playHistory(variant, sessions, rounds, checkpoints):
+    '''
+    Plays long negotiations of many sessions round by round through a MemoryStore, as the web app saves them
+    Parameters:
+        variant - list to keep the offer history as a list of offers, record as a history.OfferHistory
+    Returns:
+        growth of the resident memory in MB from the first checkpoint to the last, bytes of the saved state of a
+        session and resident memory at every checkpoint
+    '''
+
+    random_state = np.random.RandomState(0)
+    negotiation_store = store.MemoryStore(capacity=sessions)
+    rss = []
+    for number in range(rounds):
+        for session in range(sessions):
+            # offers of a buyer and an agent conceding on bundles of a few items
+            bundle = random_state.randint(0, 1000, 3).tolist()
+            cost = int(random_state.randint(20000, 40000))
+            proposed_offer = {"Bundle": bundle[1:], "Cost": cost}
+            offer = {"Bundle": bundle, "Cost": float(cost + random_state.randint(0, 10000)), "Accepted": False}
+            state = negotiation_store.load(str(session))
+            if variant == "list":
+                offer_history = [] if state is None else state["offer_history"]
+                offer_history.extend([dict(proposed_offer), dict(offer)])
+                state = {"offer_history": offer_history}
+            else:
+                offer_history = history.OfferHistory()
+                if state is not None:
+                    offer_history.setState(state["offer_history"])
+                offer_history.append(proposed_offer)
+                offer_history.append(offer, (0.5, 0.5))
+                state = {"offer_history": offer_history.getState()}
+            negotiation_store.save(str(session), state)
+        if (number + 1) % (rounds // checkpoints) == 0:
+            rss.append(round(residentMemory(), 1))
+    return round(rss[-1] - rss[0], 1), len(negotiation_store.sessions["0"][1]), rss
+
+
+def benchmarkHistory(sessions=100, rounds=200, checkpoints=4):
+    '''
+    Compares the resident memory of long negotiations with the offer history kept as a list of offers and as a
+    history.OfferHistory, see playHistory. Every variant is played by a new interpreter: in a process that ran other
+    benchmarks the memory they freed absorbs the growth, and the variant played first would warm up the heap
+    Returns:
+        results - list of (variant, growth of the resident memory in MB, bytes of the saved state of a session,
+                  resident memory at every checkpoint)
+    '''
+
+    results = []
+    for variant in ["record", "list"]:
+        code = "import json, benchmark; print(json.dumps(benchmark.playHistory(%r, %d, %d, %d)))" % (
+            variant, sessions, rounds, checkpoints)
+        output = subprocess.check_output([sys.executable, "-c", code],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        growth, state_size, rss = json.loads(output.decode().strip().splitlines()[-1])
+        results.append((variant, growth, state_size, rss))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--suites", default="micro,e2e,comparisons",
+                        help="comma separated suites out of %s" % ", ".join(SUITES))
+    parser.add_argument("--sizes", default="./data.pkl,1000",
+                        help="comma separated catalogs: data.pkl or catalog paths, or numbers of synthetic products")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown counted as a regression")
+    args = parser.parse_args()
+
+    suites = args.suites.split(",")
+    for suite in suites:
+        if suite not in SUITES:
+            parser.error("unknown suite %s" % suite)
+
+    results = []
+    for catalog_name in args.sizes.split(","):
+        product_list, selling_price, cost_price, cooccurance_matrix = loadCatalog(catalog_name)
+        catalog_name = os.path.basename(catalog_name.rstrip("/"))
+        if "micro" in suites:
+            results += benchmarkMicro(catalog_name, product_list, selling_price, cost_price, cooccurance_matrix)
+        if "e2e" in suites:
+            results += benchmarkEndToEnd(catalog_name, product_list, selling_price, cost_price, cooccurance_matrix)
+        if "http" in suites:
+            results += benchmarkHttp(catalog_name, product_list, selling_price, cost_price, cooccurance_matrix)
+    if "comparisons" in suites:
+        results += benchmarkComparisons(*bg.getData())
+
+    printResults(results)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({"environment": environment(), "results": results}, output_file, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compareResults(results, json.load(baseline_file)["results"], args.tolerance)
+        for result, value, change in regressions:
+            print("regression: %s %s %s %s %.3f -> %.3f %s (%+.0f%%)" % (
+                result["suite"], result["name"], result["catalog"], json.dumps(result["parameters"], sort_keys=True),
+                value, result["value"], result["unit"], change * 100))
+        sys.exit(1 if regressions else 0)
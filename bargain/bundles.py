@@ -0,0 +1,130 @@
+'''
+Search of the add-ons the agent opens a negotiation with, among the top neighbours of the product
+A bundle is scored by the expected profit of its initial offer: the profit of the offer, priced as
+Agent.getInitialOffer prices it, times the mean confidence of product -> add-on as the chance that the buyer
+takes the bundle. The mean makes the score non-additive, adding a weakly related add-on raises the profit but
+lowers the chance, so bundles are grown by beam search (greedy selection with a beam width of 1)
+'''
+
+from __future__ import division
+
+import os
+import time
+
+import priors
+
+
+class BundleSearch:
+    def __init__(self, max_items=3, beam_width=4, candidates=10, time_budget=0.005, capacity=100000):
+        '''
+        Parameters:
+            max_items   - maximum number of add-ons in a bundle
+            beam_width  - number of bundles of every size kept for growing, 1 for greedy selection
+            candidates  - number of top neighbours of the product the add-ons are chosen from
+            time_budget - seconds a search may take, the best bundle found by then is returned
+            capacity    - number of bundle scores and searches memoized
+        '''
+
+        self.max_items = max_items
+        self.beam_width = beam_width
+        self.candidates = candidates
+        self.time_budget = time_budget
+        self.scores = priors.LRUCache(capacity)
+        self.searches = priors.LRUCache(capacity)
+        self.timeouts = 0
+
+    def score(self, agent, recommender, add_ons, product_idx):
+        '''
+        Parameters:
+            agent       - the agent making the initial offer
+            recommender - the recommendation system used by the agent
+            add_ons     - tuple of indices of the add-ons, sorted
+            product_idx - index of the product the buyer wishes to buy
+        Returns:
+            the expected profit of the initial offer of the bundle
+        '''
+
+        key = (add_ons, product_idx, agent.max_initial_discount_rate, agent.price_key)
+        score = self.scores.get(key)
+        if score is None:
+            bundle = list(add_ons) + [product_idx]
+            prior_utility = recommender.prior_table.priorUtility(bundle)
+            add_ons_selling_price, add_ons_cost_price = agent.bundleTotals(list(add_ons))
+            product_selling_price, product_cost_price = agent.bundleTotals([product_idx])
+            initial_discount = min((1 - prior_utility), agent.max_initial_discount_rate) * (
+                add_ons_selling_price - add_ons_cost_price)
+            profit = add_ons_selling_price - initial_discount - add_ons_cost_price + \
+                product_selling_price - product_cost_price
+            score = prior_utility * profit
+            self.scores.put(key, score)
+        return score
+
+    def search(self, agent, recommender, product_idx):
+        '''
+        Parameters:
+            agent       - the agent making the initial offer
+            recommender - the recommendation system used by the agent
+            product_idx - index of the product the buyer wishes to buy
+        Returns:
+            list of indices of the add-ons of the best bundle found, best neighbour first
+        '''
+
+        key = (product_idx, agent.max_initial_discount_rate, agent.price_key)
+        add_ons = self.searches.get(key)
+        if add_ons is not None:
+            return list(add_ons)
+
+        deadline = time.time() + self.time_budget
+        candidates = [int(i) for i in recommender.neighbour_index.topNeighbours(product_idx, self.candidates)]
+        rank = dict((idx, position) for position, idx in enumerate(candidates))
+        best, best_score = (), None
+        beam = [()]
+        timed_out = False
+        for _ in range(min(self.max_items, len(candidates))):
+            grown = {}
+            for add_ons in beam:
+                for idx in candidates:
+                    if idx in add_ons:
+                        continue
+                    bundle = tuple(sorted(add_ons + (idx,)))
+                    if bundle not in grown:
+                        grown[bundle] = self.score(agent, recommender, bundle, product_idx)
+                if time.time() > deadline:
+                    timed_out = True
+                    break
+            if not grown:
+                break
+            # ties go to the bundle of the better ranked neighbours
+            beam = sorted(grown, key=lambda bundle: (-grown[bundle], sorted(rank[i] for i in bundle)))
+            beam = beam[:self.beam_width]
+            if best_score is None or grown[beam[0]] > best_score:
+                best, best_score = beam[0], grown[beam[0]]
+            if timed_out:
+                break
+
+        add_ons = sorted(best, key=lambda idx: rank[idx])
+        if timed_out:
+            # a cut short search is not memoized, the next one may get further
+            self.timeouts += 1
+        else:
+            self.searches.put(key, tuple(add_ons))
+        return add_ons
+
+    def stats(self):
+        return {"bundle_score_hit_rate": self.scores.hitRate(), "bundle_search_hit_rate": self.searches.hitRate(),
+                "bundle_search_timeouts": self.timeouts}
+
+
+def fromEnvironment(environ=os.environ):
+    '''
+    Returns:
+        the BundleSearch configured by BARGAIN_BUNDLE_ITEMS, BARGAIN_BUNDLE_BEAM, BARGAIN_BUNDLE_CANDIDATES and
+        BARGAIN_BUNDLE_BUDGET, None when BARGAIN_BUNDLE_ITEMS is not set
+    '''
+
+    if not environ.get('BARGAIN_BUNDLE_ITEMS'):
+        return None
+    return BundleSearch(max_items=int(environ['BARGAIN_BUNDLE_ITEMS']),
+                        beam_width=int(environ.get('BARGAIN_BUNDLE_BEAM', 4)),
+                        candidates=int(environ.get('BARGAIN_BUNDLE_CANDIDATES', 10)),
+                        time_budget=float(environ.get('BARGAIN_BUNDLE_BUDGET', 0.005)))
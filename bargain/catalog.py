@@ -0,0 +1,201 @@
+'''
+Versioned binary catalog format, opened memory-mapped so that workers share its pages
+A catalog is a directory holding
+    catalog.json        - format version, product names and the layout of the cooccurance matrix
+    selling_price.npy   - selling price of every product, indexed by product id
+    cost_price.npy      - cost price of every product, indexed by product id
+    cooccurance.npy     - dense cooccurance matrix, or
+    cooccurance_data.npy, cooccurance_indices.npy, cooccurance_indptr.npy - the matrix in CSR form
+Convert the existing pickle with
+    python catalog.py data.pkl ./catalog
+'''
+
+from __future__ import division, print_function
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+CATALOG_VERSION = 1
+
+
+class ProductIndex:
+    def __init__(self, product_list):
+        '''
+        Two-way index between product names and ids, built once per catalog
+        Parameters:
+            product_list    - list of the entire product base, a product's id is its position
+        '''
+
+        self.product_list = product_list
+        self.ids = {}
+        for idx, name in enumerate(product_list):
+            # a repeated name resolves to its first product
+            self.ids.setdefault(name, idx)
+
+    def __len__(self):
+        return len(self.product_list)
+
+    def encode(self, product_names):
+        '''
+        Parameters:
+            product_names   - comma separated names, or a list of names
+        Returns:
+            ids of the named products in the same order, unknown names are skipped
+        '''
+
+        if not isinstance(product_names, list):
+            product_names = product_names.split(",")
+        ids = self.ids
+        return [ids[name] for name in product_names if name in ids]
+
+    def decode(self, bundle):
+        return [self.product_list[idx] for idx in bundle]
+
+
+class Catalog:
+    def __init__(self, product_list, selling_prices, cost_prices, cooccurance_matrix):
+        '''
+        Parameters:
+            product_list        - list of the entire product base, a product's id is its position
+            selling_prices      - array with the selling price of every product
+            cost_prices         - array with the cost price of every product
+            cooccurance_matrix  - dense array or scipy CSR cooccurance matrix
+        '''
+
+        self.product_list = product_list
+        self.selling_prices = selling_prices
+        self.cost_prices = cost_prices
+        self.cooccurance_matrix = cooccurance_matrix
+        self.product_index = ProductIndex(product_list)
+
+    def priceDicts(self):
+        '''
+        Returns:
+            selling_price   - dictionary with the selling price of every product name
+            cost_price      - dictionary with the cost price of every product name
+        '''
+
+        selling_price = dict(zip(self.product_list, self.selling_prices.tolist()))
+        cost_price = dict(zip(self.product_list, self.cost_prices.tolist()))
+        return selling_price, cost_price
+
+    def save(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        np.save(os.path.join(directory, "selling_price.npy"), np.asarray(self.selling_prices))
+        np.save(os.path.join(directory, "cost_price.npy"), np.asarray(self.cost_prices))
+        layout = saveMatrix(directory, "cooccurance", self.cooccurance_matrix)
+        # written last, a directory without it is not a catalog
+        with open(os.path.join(directory, "catalog.json"), "w") as catalog_file:
+            json.dump({"version": CATALOG_VERSION, "items": list(self.product_list), "cooccurance": layout},
+                      catalog_file)
+
+
+def saveMatrix(directory, name, matrix):
+    '''
+    Parameters:
+        directory   - directory the matrix is saved to
+        name        - name of the matrix, name.npy when dense and name_data.npy, name_indices.npy and
+                      name_indptr.npy in CSR form
+        matrix      - dense array or scipy sparse matrix
+    Returns:
+        layout of the matrix, dense or csr
+    '''
+
+    if hasattr(matrix, "tocsr"):
+        matrix = matrix.tocsr()
+        np.save(os.path.join(directory, name + "_data.npy"), matrix.data)
+        np.save(os.path.join(directory, name + "_indices.npy"), matrix.indices)
+        np.save(os.path.join(directory, name + "_indptr.npy"), matrix.indptr)
+        return "csr"
+    np.save(os.path.join(directory, name + ".npy"), np.asarray(matrix))
+    return "dense"
+
+
+def loadMatrix(directory, name, layout, shape, mmap=True):
+    '''
+    Parameters:
+        directory   - directory the matrix was saved to
+        name        - name of the matrix, as saveMatrix
+        layout      - layout saveMatrix returned
+        shape       - shape of the matrix, needed by the csr layout
+        mmap        - map the arrays into memory instead of reading them
+    Returns:
+        the dense array or scipy CSR matrix
+    '''
+
+    mmap_mode = "r" if mmap else None
+
+    def load(suffix):
+        return np.load(os.path.join(directory, name + suffix + ".npy"), mmap_mode=mmap_mode)
+
+    if layout == "csr":
+        from scipy.sparse import csr_matrix
+        return csr_matrix((load("_data"), load("_indices"), load("_indptr")), shape=shape, copy=False)
+    return load("")
+
+
+def isCatalog(path):
+    return os.path.isfile(os.path.join(path, "catalog.json"))
+
+
+def loadCatalog(directory, mmap=True):
+    '''
+    Parameters:
+        directory   - directory the catalog was saved to
+        mmap        - map the arrays into memory instead of reading them
+    Returns:
+        the Catalog
+    '''
+
+    with open(os.path.join(directory, "catalog.json")) as catalog_file:
+        meta = json.load(catalog_file)
+    if meta["version"] != CATALOG_VERSION:
+        raise ValueError("Unsupported catalog version %s in %s" % (meta["version"], directory))
+
+    mmap_mode = "r" if mmap else None
+
+    def load(name):
+        return np.load(os.path.join(directory, name + ".npy"), mmap_mode=mmap_mode)
+
+    product_list = meta["items"]
+    cooccurance_matrix = loadMatrix(directory, "cooccurance", meta["cooccurance"],
+                                    (len(product_list), len(product_list)), mmap)
+    return Catalog(product_list, load("selling_price"), load("cost_price"), cooccurance_matrix)
+
+
+def convertPickle(pickle_path, directory):
+    '''
+    Converts a data.pkl written by generateData.py into a catalog directory
+    '''
+
+    try:
+        import cPickle as pickle
+    except ImportError:
+        import pickle
+
+    with open(pickle_path, "rb") as data_file:
+        if sys.version_info[0] == 2:
+            data = pickle.load(data_file)
+        else:
+            # numpy arrays pickled by python 2
+            data = pickle.load(data_file, encoding="latin1")
+    product_list = data["items"]
+    catalog = Catalog(product_list, np.array([data["selling_price"][name] for name in product_list]),
+                      np.array([data["cost_price"][name] for name in product_list]), data["cooccurance_matrix"])
+    catalog.save(directory)
+    return catalog
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("pickle", help="data.pkl to convert")
+    parser.add_argument("output", help="catalog directory to write")
+    args = parser.parse_args()
+
+    catalog = convertPickle(args.pickle, args.output)
+    print("Converted %d products to %s" % (len(catalog.product_list), args.output))
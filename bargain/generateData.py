@@ -1,7 +1,21 @@
 '''
 Generate synthetic data that is "ideal"/realistic with 10 items
+Invoices are sampled (or read from an invoice file) in chunks and folded into the co-occurance
+matrix as they come, so memory stays bounded however many invoices there are
+The catalog of an invoice file holds every product named in it, priced by a file of lines of name, selling
+price and cost price (--prices), e.g.
+    python generateData.py --invoice-file invoices.csv --prices prices.csv --sparse --output ./data.pkl
+With --items N a synthetic catalog of N products is generated instead: products fall into clusters, invoices
+mostly stay within a cluster and pick products by power-law popularity, prices are log-normal per cluster, e.g.
+    python generateData.py --items 100000 --sparse --seed 1 --output ./data.pkl --catalog ./catalog
 '''
 
+from __future__ import division, print_function
+
+import argparse
+import sys
+import time
+
 import numpy as np
 import pickle as pkl
 
@@ -53,26 +67,316 @@ probabilities_of_cooccurance = {"Smartphone" :      [1, 0.8, 0.6, 0.001, 0.05, 0
                                 "Color Book" :      [0.001, 0.01, 0.01, 0, 0.1, 0.05, 0, 0.001, 1, 0.95],           \
                                 "Crayons" :         [0, 0.02, 0.02, 0, 0.05, 0.1, 0, 0, 0.5, 1]                     }
 
+def sampleInvoices(probabilities, invoices_per_item=10000, chunk_size=10000, random_state=None):
+    '''
+    Samples invoices in which every item j appears with probability probabilities[i][j], where i is the item
+    the invoice was sampled for
+    Parameters:
+        probabilities       - matrix of the probabilities of cooccurance
+        invoices_per_item   - number of invoices sampled for every item
+        chunk_size          - maximum number of invoices in a chunk
+        random_state        - numpy RandomState used for sampling
+    Returns:
+        generator of boolean invoice matrices with one row per invoice
+    '''
+
+    if random_state is None:
+        random_state = np.random.RandomState()
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    for i in range(probabilities.shape[0]):
+        for start in range(0, invoices_per_item, chunk_size):
+            size = min(chunk_size, invoices_per_item - start)
+            yield random_state.uniform(0, 1, (size, probabilities.shape[1])) <= probabilities[i]
+
+
+def invoiceItems(path):
+    '''
+    Reads the products named in an invoice file, a first pass before its invoices are streamed
+    Parameters:
+        path        - path of the invoice file, one invoice per line given as comma separated item names
+    Returns:
+        list of the product names, in the order they first appear
+    '''
+
+    item_index = {}
+    with open(path) as invoice_file:
+        for line in invoice_file:
+            for name in line.split(","):
+                name = name.strip()
+                if name and name not in item_index:
+                    item_index[name] = len(item_index)
+    return sorted(item_index, key=item_index.get)
+
+
+def readPrices(path):
+    '''
+    Parameters:
+        path            - path of a file of lines of product name, selling price and cost price, comma separated
+    Returns:
+        selling_price   - dictionary with the selling price of every product of the file
+        cost_price      - dictionary with the cost price of every product of the file
+    '''
+
+    def price(field):
+        value = float(field)
+        return int(value) if value.is_integer() else value
+
+    selling_price, cost_price = {}, {}
+    with open(path) as price_file:
+        for line in price_file:
+            fields = [field.strip() for field in line.split(",")]
+            if len(fields) != 3:
+                continue
+            selling_price[fields[0]], cost_price[fields[0]] = price(fields[1]), price(fields[2])
+    return selling_price, cost_price
+
+
+def readInvoices(path, items, chunk_size=10000, sparse=False):
+    '''
+    Streams an invoice file with one invoice per line, given as comma separated item names
+    Parameters:
+        path        - path of the invoice file
+        items       - list of the entire product base
+        chunk_size  - maximum number of invoices in a chunk
+        sparse      - yield scipy CSR matrices instead of dense boolean matrices
+    Returns:
+        generator of invoice matrices with one row per invoice
+    '''
+
+    item_index = dict((item, idx) for idx, item in enumerate(items))
+    invoices = []
+
+    def toMatrix(invoices):
+        if sparse:
+            from scipy.sparse import csr_matrix
+            indptr = np.cumsum([0] + [len(invoice) for invoice in invoices])
+            indices = np.array([idx for invoice in invoices for idx in invoice], dtype=np.int32)
+            return csr_matrix((np.ones(len(indices), dtype=np.float32), indices, indptr),
+                              shape=(len(invoices), len(items)))
+        matrix = np.zeros((len(invoices), len(items)), dtype=bool)
+        for row, invoice in enumerate(invoices):
+            matrix[row, invoice] = True
+        return matrix
+
+    with open(path) as invoice_file:
+        for line in invoice_file:
+            names = [name.strip() for name in line.split(",")]
+            invoice = sorted(set(item_index[name] for name in names if name in item_index))
+            if invoice:
+                invoices.append(invoice)
+            if len(invoices) == chunk_size:
+                yield toMatrix(invoices)
+                invoices = []
+    if invoices:
+        yield toMatrix(invoices)
+
+
+def cooccuranceMatrix(chunks, no_of_items, sparse=False):
+    '''
+    Accumulates X^T X over chunks of the invoice matrix X
+    Parameters:
+        chunks      - iterable of dense boolean or scipy sparse invoice matrices
+        no_of_items - number of items in the catalog
+        sparse      - accumulate into a scipy CSR matrix instead of a dense array
+    Returns:
+        cooccurance_matrix  - the cooccurance matrix
+        no_of_invoices      - the number of invoices seen
+    '''
+
+    if sparse:
+        from scipy.sparse import csr_matrix
+        cooccurance_matrix = csr_matrix((no_of_items, no_of_items), dtype=np.int64)
+    else:
+        cooccurance_matrix = np.zeros((no_of_items, no_of_items), dtype=np.int64)
+
+    no_of_invoices = 0
+    for chunk in chunks:
+        no_of_invoices += chunk.shape[0]
+        if hasattr(chunk, "tocsr"):
+            counts = chunk.T.dot(chunk)
+            counts = counts.astype(np.int64) if sparse else counts.toarray().astype(np.int64)
+        else:
+            # float32 products go through BLAS and stay exact while a chunk has less than 2^24 invoices
+            chunk = chunk.astype(np.float32)
+            counts = np.rint(np.dot(chunk.T, chunk)).astype(np.int64)
+            if sparse:
+                counts = csr_matrix(counts)
+        cooccurance_matrix = cooccurance_matrix + counts
+
+    return cooccurance_matrix, no_of_invoices
+
+
+def syntheticCatalog(no_of_items, no_of_clusters=None, invoices_per_item=10, cross_cluster=0.1,
+                     mean_basket_size=3, popularity_exponent=1.1, chunk_size=1000000, sparse=False,
+                     random_state=None):
+    '''
+    Generates a catalog whose products fall into clusters, e.g. phones and their accessories
+    Every invoice belongs to a cluster, picked by the power-law popularity of the clusters, and holds a geometric
+    number of products, each from the cluster of the invoice or, with probability cross_cluster, from the whole
+    catalog, picked by the power-law popularity of the products
+    Parameters:
+        no_of_items         - number of products
+        no_of_clusters      - number of clusters, about the square root of no_of_items by default
+        invoices_per_item   - number of invoices sampled per product
+        cross_cluster       - probability of a product picked outside the cluster of the invoice
+        mean_basket_size    - mean number of products in an invoice
+        popularity_exponent - exponent of the power law of the popularity of products and clusters
+        chunk_size          - maximum number of invoices sampled at once
+        sparse              - return the cooccurance matrix as a scipy CSR matrix, for large catalogs
+        random_state        - numpy RandomState used for sampling
+    Returns:
+        items               - list of the product names
+        selling_price       - dictionary with the selling price of every product
+        cost_price          - dictionary with the cost price of every product
+        cooccurance_matrix  - the cooccurance matrix
+    '''
+
+    if random_state is None:
+        random_state = np.random.RandomState()
+    if no_of_clusters is None:
+        no_of_clusters = max(1, int(round(np.sqrt(no_of_items))))
+    no_of_clusters = min(no_of_clusters, no_of_items)
+
+    # products are numbered cluster by cluster, cluster c holding products starts[c] to starts[c + 1] - 1
+    cluster_of_item = np.sort(random_state.randint(0, no_of_clusters, no_of_items))
+    cluster_of_item[:no_of_clusters] = np.arange(no_of_clusters)
+    cluster_of_item.sort()
+    starts = np.searchsorted(cluster_of_item, np.arange(no_of_clusters + 1))
+
+    # power-law popularity in a random order, so that popular products are spread over the clusters
+    item_weight = 1 / random_state.permutation(np.arange(1, no_of_items + 1)) ** popularity_exponent
+    cumulative_weight = np.cumsum(item_weight)
+    cluster_weight = np.add.reduceat(item_weight, starts[:-1])
+    cluster_before = np.concatenate([[0], cumulative_weight])[starts[:-1]]
+    cluster_probability = cluster_weight / cluster_weight.sum()
+
+    # prices are log-normal around a price level of the cluster
+    cluster_price = random_state.lognormal(np.log(2000), 1.2, no_of_clusters)
+    prices = np.maximum(10, np.rint(cluster_price[cluster_of_item] * random_state.lognormal(0, 0.3, no_of_items)))
+    costs = np.maximum(1, np.rint(prices * random_state.uniform(0.25, 0.8, no_of_items)))
+
+    def sampleChunk(no_of_invoices):
+        clusters = random_state.choice(no_of_clusters, no_of_invoices, p=cluster_probability)
+        sizes = random_state.geometric(1 / mean_basket_size, no_of_invoices)
+        invoice_of_slot = np.repeat(np.arange(no_of_invoices), sizes)
+        cluster_of_slot = clusters[invoice_of_slot]
+        # inverse transform sampling on the cumulative popularity, within the cluster or over all products
+        draws = random_state.uniform(0, 1, len(invoice_of_slot))
+        targets = cluster_before[cluster_of_slot] + draws * cluster_weight[cluster_of_slot]
+        outside = random_state.uniform(0, 1, len(invoice_of_slot)) < cross_cluster
+        targets[outside] = draws[outside] * cumulative_weight[-1]
+        items_of_slot = np.minimum(np.searchsorted(cumulative_weight, targets, side="right"), no_of_items - 1)
+        # a product is in an invoice at most once
+        keys = np.unique(invoice_of_slot.astype(np.int64) * no_of_items + items_of_slot)
+        rows, columns = keys // no_of_items, keys % no_of_items
+        # every ordered pair of products of an invoice, including a product with itself, invoices of one size
+        # at a time so that their products form a matrix
+        basket_sizes = np.bincount(rows, minlength=no_of_invoices)
+        offsets = np.concatenate([[0], np.cumsum(basket_sizes)])[:-1]
+        firsts, seconds = [], []
+        for size in np.unique(basket_sizes[basket_sizes > 0]):
+            baskets = columns[offsets[basket_sizes == size][:, np.newaxis] + np.arange(size)]
+            firsts.append(np.repeat(baskets, size, axis=1).ravel())
+            seconds.append(np.tile(baskets, (1, size)).ravel())
+        return np.concatenate(firsts), np.concatenate(seconds)
+
+    if sparse:
+        from scipy.sparse import coo_matrix
+        cooccurance_matrix = coo_matrix((no_of_items, no_of_items), dtype=np.int64).tocsr()
+    else:
+        cooccurance_matrix = np.zeros((no_of_items, no_of_items), dtype=np.int64)
+    no_of_invoices = invoices_per_item * no_of_items
+    for start in range(0, no_of_invoices, chunk_size):
+        firsts, seconds = sampleChunk(min(chunk_size, no_of_invoices - start))
+        if sparse:
+            # duplicate pairs are summed by the conversion
+            cooccurance_matrix = cooccurance_matrix + coo_matrix(
+                (np.ones(len(firsts), dtype=np.int64), (firsts, seconds)), shape=(no_of_items, no_of_items)).tocsr()
+        else:
+            np.add.at(cooccurance_matrix, (firsts, seconds), 1)
+
+    # every product sold at least once, alone if no invoice picked it
+    unsold = np.flatnonzero(np.asarray(cooccurance_matrix.diagonal()) == 0)
+    if len(unsold):
+        if sparse:
+            cooccurance_matrix = cooccurance_matrix + coo_matrix(
+                (np.ones(len(unsold), dtype=np.int64), (unsold, unsold)), shape=cooccurance_matrix.shape).tocsr()
+        else:
+            cooccurance_matrix[unsold, unsold] = 1
+
+    items = ["Product %d" % i for i in range(no_of_items)]
+    return (items, dict(zip(items, prices.astype(np.int64).tolist())), dict(zip(items, costs.astype(np.int64).tolist())),
+            cooccurance_matrix)
+
+
+def writeData(path, items, selling_price, cost_price, cooccurance_matrix, sparse=False):
+    '''
+    Writes the catalog in the schema read by bargain.getData
+    Parameters:
+        sparse  - keep a scipy sparse cooccurance matrix sparse, reading the file then requires scipy
+    '''
+
+    if hasattr(cooccurance_matrix, "toarray") and not sparse:
+        cooccurance_matrix = cooccurance_matrix.toarray()
+    final_data = {"items" : items, "selling_price" : selling_price, "cost_price" : cost_price, "cooccurance_matrix" : cooccurance_matrix}
+    # protocol 2 can be read by both python 2 and python 3
+    with open(path, 'wb') as data_file:
+        pkl.dump(final_data, data_file, protocol=2)
+
+
 if __name__ == "__main__":
-    data = []
-    for i in range(len(items)):
-        for _ in range(10000):
-            invoice = []
-            for j in range(len(items)):
-                prob = np.random.uniform(0, 1)
-                if prob <= probabilities_of_cooccurance[items[i]][j]:
-                    invoice.append(1)
-                else:
-                    invoice.append(0)
-
-            data.append(invoice)
-
-    data = np.array(data)
-    print(data.shape)
-    cooccurance_matrix = np.matmul(np.transpose(data), data)
-    user_vector = [1, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-    recommendation_vector = np.matmul(cooccurance_matrix, user_vector)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--invoices-per-item", type=int,
+                        help="10000 for the 10 item catalog, 10 for a synthetic catalog by default")
+    parser.add_argument("--invoice-file", help="read invoices from this file instead of sampling them")
+    parser.add_argument("--prices", help="prices of the products of the invoice file, lines of name, selling price "
+                                         "and cost price; the 10 items are priced by default")
+    parser.add_argument("--chunk-size", type=int, help="10000 invoices, 1000000 for a synthetic catalog by default")
+    parser.add_argument("--sparse", action="store_true", help="accumulate a sparse matrix (requires scipy)")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--output", default="./data.pkl")
+    parser.add_argument("--items", type=int, help="generate a synthetic catalog of this many products")
+    parser.add_argument("--clusters", type=int, help="number of clusters of the synthetic catalog")
+    parser.add_argument("--cross-cluster", type=float, default=0.1)
+    parser.add_argument("--catalog", help="also write the catalog as a binary catalog directory, see catalog.py")
+    args = parser.parse_args()
+
+    if args.items:
+        start = time.time()
+        items, selling_price, cost_price, cooccurance_matrix = syntheticCatalog(
+            args.items, args.clusters, args.invoices_per_item or 10, args.cross_cluster,
+            chunk_size=args.chunk_size or 1000000, sparse=args.sparse, random_state=np.random.RandomState(args.seed))
+        print("Generated %d products in %.1f s" % (len(items), time.time() - start))
+        writeData(args.output, items, selling_price, cost_price, cooccurance_matrix, sparse=args.sparse)
+        if args.catalog:
+            import catalog
+            catalog.Catalog(items, np.array([selling_price[name] for name in items]),
+                            np.array([cost_price[name] for name in items]), cooccurance_matrix).save(args.catalog)
+        sys.exit(0)
+
+    if args.invoice_file:
+        items = invoiceItems(args.invoice_file)
+        if args.prices:
+            file_selling_price, file_cost_price = readPrices(args.prices)
+            selling_price.update(file_selling_price)
+            cost_price.update(file_cost_price)
+        unpriced = [item for item in items if item not in selling_price or item not in cost_price]
+        if unpriced:
+            parser.error("%d products of the invoice file have no price, e.g. %s; give them with --prices"
+                         % (len(unpriced), unpriced[0]))
+        selling_price = dict((item, selling_price[item]) for item in items)
+        cost_price = dict((item, cost_price[item]) for item in items)
+        chunks = readInvoices(args.invoice_file, items, args.chunk_size or 10000, sparse=args.sparse)
+    else:
+        probabilities = [probabilities_of_cooccurance[item] for item in items]
+        chunks = sampleInvoices(probabilities, args.invoices_per_item or 10000, args.chunk_size or 10000,
+                                np.random.RandomState(args.seed))
+
+    cooccurance_matrix, no_of_invoices = cooccuranceMatrix(chunks, len(items), sparse=args.sparse)
+    print((no_of_invoices, len(items)))
+    user_vector = np.zeros(len(items))
+    user_vector[0] = 1
+    recommendation_vector = cooccurance_matrix.dot(user_vector)
     print(recommendation_vector)
 
-    final_data = {"items" : items, "selling_price" : selling_price, "cost_price" : cost_price, "cooccurance_matrix" : cooccurance_matrix}
-    pkl.dump(final_data, open("./data.pkl", 'wb'))
\ No newline at end of file
+    writeData(args.output, items, selling_price, cost_price, cooccurance_matrix, sparse=args.sparse)
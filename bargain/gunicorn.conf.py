@@ -1,5 +1,25 @@
 import multiprocessing
+import os
 
 workers = multiprocessing.cpu_count() * 2 + 1
+# load the catalog once in the master so that workers share it copy-on-write
+preload_app = True
+# e.g. gevent to serve the JSON API on async workers, sync workers by default
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
 forwarded_allow_ips = '*'
-secure_scheme_headers = {'X-Forwarded-Proto': 'https'}
\ No newline at end of file
+secure_scheme_headers = {'X-Forwarded-Proto': 'https'}
+
+def post_fork(server, worker):
+    # the sampling profiler of instrument.py does not survive the fork of a preloaded app
+    import instrument
+    instrument.afterFork()
+    # the thread loading the snapshots of learning.py runs in the workers only, started before their first request
+    import sessions
+    if sessions.snapshot_watcher is not None:
+        sessions.snapshot_watcher.start()
+
+def worker_exit(server, worker):
+    # rounds still buffered by the round log of the worker
+    import sessions
+    if sessions.round_log is not None:
+        sessions.round_log.flush()
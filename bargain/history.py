@@ -0,0 +1,140 @@
+'''
+Offer history of a negotiation in a fixed-capacity NumPy record array
+Every entry is an offer of the agent or a counter-offer of the buyer: its round, the items of its bundle, its cost,
+whether it was accepted and the utilities the agent rated the round with. Once the history is full the oldest
+entries are dropped, so the state of a negotiation keeps the same size however many rounds it runs. The history is
+saved with the negotiation as the bytes of its entries
+'''
+
+import base64
+import numbers
+
+import numpy as np
+
+# items of a bundle an entry holds, the API refuses longer bundles
+MAX_ITEMS = 16
+AGENT, BUYER = 0, 1
+# little endian, the bytes may be read on another machine through a shared store
+# integer marks costs given as int, which the pages show without decimals
+ENTRY = np.dtype([("round", "<i4"), ("party", "i1"), ("accepted", "i1"), ("integer", "i1"), ("size", "<i2"),
+                  ("items", "<i4", (MAX_ITEMS,)), ("cost", "<f8"), ("agent_utility", "<f8"),
+                  ("buyer_utility", "<f8")])
+
+
+def optionalFloat(value):
+    return np.nan if value is None else float(value)
+
+
+class OfferHistory:
+    def __init__(self, capacity=32):
+        '''
+        Parameters:
+            capacity    - number of offers kept, the latest ones
+        '''
+
+        self.entries = np.zeros(capacity, dtype=ENTRY)
+        # offers appended since the negotiation began and counter-offers of the buyer among them
+        self.appended = 0
+        self.rounds = 0
+
+    def __len__(self):
+        return min(self.appended, len(self.entries))
+
+    def records(self):
+        '''
+        Returns:
+            the entries kept, oldest first
+        '''
+
+        length = len(self)
+        return self.entries[(self.appended - length + np.arange(length)) % len(self.entries)]
+
+    def append(self, offer, utilities=(None, None)):
+        '''
+        Parameters:
+            offer       - an offer of the agent, which has an Accepted key, or a counter-offer of the buyer
+            utilities   - agent and buyer utility of the round the offer was made in, e.g. Agent.last_round
+        '''
+
+        bundle = [int(i) for i in offer["Bundle"]]
+        if len(bundle) > MAX_ITEMS:
+            raise ValueError("a bundle has at most %d items" % MAX_ITEMS)
+        party = AGENT if "Accepted" in offer else BUYER
+        if party == BUYER:
+            self.rounds += 1
+        entry = self.entries[self.appended % len(self.entries)]
+        entry["round"] = self.rounds
+        entry["party"] = party
+        entry["accepted"] = bool(offer.get("Accepted"))
+        entry["size"] = len(bundle)
+        entry["items"] = bundle + [-1] * (MAX_ITEMS - len(bundle))
+        entry["integer"] = isinstance(offer["Cost"], numbers.Integral)
+        entry["cost"] = optionalFloat(offer["Cost"])
+        entry["agent_utility"] = optionalFloat(utilities[0])
+        entry["buyer_utility"] = optionalFloat(utilities[1])
+        self.appended += 1
+
+    @staticmethod
+    def offer(entry):
+        cost = entry["cost"]
+        offer = {"Bundle": entry["items"][:entry["size"]].tolist(),
+                 "Cost": None if np.isnan(cost) else int(cost) if entry["integer"] else float(cost)}
+        if entry["party"] == AGENT:
+            offer["Accepted"] = bool(entry["accepted"])
+        return offer
+
+    def __iter__(self):
+        '''
+        Yields the offers kept as dictionaries, oldest first, from an offer of the agent on so that the offers and
+        counter-offers pair up
+        '''
+
+        records = self.records()
+        start = 1 if len(records) and records[0]["party"] == BUYER else 0
+        for entry in records[start:]:
+            yield self.offer(entry)
+
+    def last(self, party=AGENT):
+        '''
+        Returns:
+            the latest offer of the party kept, None when there is none
+        '''
+
+        records = self.records()
+        matching = np.flatnonzero(records["party"] == party)
+        return self.offer(records[matching[-1]]) if len(matching) else None
+
+    def getState(self):
+        '''
+        Returns:
+            state   - the history as plain python values
+        '''
+
+        return {"entries": base64.b64encode(self.records().tobytes()).decode("ascii"), "appended": self.appended,
+                "rounds": self.rounds}
+
+    def setState(self, state):
+        '''
+        Restores a history returned by getState
+        Parameters:
+            state   - the history state
+        '''
+
+        records = np.frombuffer(base64.b64decode(state["entries"]), dtype=ENTRY)[-len(self.entries):]
+        self.appended = state["appended"]
+        self.rounds = state["rounds"]
+        self.entries[(self.appended - len(records) + np.arange(len(records))) % len(self.entries)] = records
+
+
+def fromOffers(offers, capacity=32):
+    '''
+    Parameters:
+        offers      - list of offers, as negotiations saved before the history were
+    Returns:
+        the OfferHistory of the offers
+    '''
+
+    offer_history = OfferHistory(capacity)
+    for offer in offers:
+        offer_history.append(offer)
+    return offer_history
@@ -0,0 +1,229 @@
+'''
+Instrumentation of the negotiation engine: per-stage timers, counters and summaries, a JSONL trace of every
+round and a sampling profiler. Everything is off unless switched on, by environment or by calling configure:
+    BARGAIN_METRICS=1               collect timers, counters and summaries, exported by metricsText
+    BARGAIN_TRACE=/path/trace.jsonl append one JSON line per traced event
+    BARGAIN_PROFILE=0.005           sample the stack of the main thread every 5 ms of CPU time
+With gunicorn every worker keeps its own metrics, /metrics shows those of the worker serving it
+'''
+
+from __future__ import division
+
+import atexit
+import functools
+import json
+import os
+import signal
+import threading
+import time
+
+lock = threading.Lock()
+metrics_enabled = False
+trace_fd = None
+# (name, labels) -> value
+counters = {}
+# (name, labels) -> [count, sum, max]
+summaries = {}
+# "file:function" -> samples
+profile_samples = {}
+profile_interval = 0
+gauge_callbacks = []
+
+
+def configure(metrics=None, trace=None, profile=None):
+    '''
+    Parameters:
+        metrics - collect timers, counters and summaries
+        trace   - path of the JSONL trace file, "" closes the trace
+        profile - seconds of CPU time between two profiler samples, 0 stops the profiler
+    Arguments left as None keep their current setting
+    '''
+
+    global metrics_enabled, trace_fd
+    if metrics is not None:
+        metrics_enabled = bool(metrics)
+    if trace is not None:
+        if trace_fd is not None:
+            os.close(trace_fd)
+            trace_fd = None
+        if trace:
+            # lines appended with a single write do not interleave between worker processes
+            trace_fd = os.open(trace, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    if profile is not None:
+        if profile:
+            startProfiler(profile)
+        else:
+            stopProfiler()
+
+
+def reset():
+    with lock:
+        counters.clear()
+        summaries.clear()
+        profile_samples.clear()
+
+
+def labelKey(labels):
+    return tuple(sorted(labels.items()))
+
+
+def count(name, value=1, **labels):
+    if not metrics_enabled:
+        return
+    key = (name, labelKey(labels))
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    '''
+    Adds value to the summary (count, sum and max) of name
+    '''
+
+    if not metrics_enabled:
+        return
+    key = (name, labelKey(labels))
+    with lock:
+        summary = summaries.get(key)
+        if summary is None:
+            summaries[key] = [1, value, value]
+        else:
+            summary[0] += 1
+            summary[1] += value
+            if value > summary[2]:
+                summary[2] = value
+
+
+def timed(stage):
+    '''
+    Decorator adding the run time of the function to the stage_seconds summary of stage
+    '''
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not metrics_enabled:
+                return function(*args, **kwargs)
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                observe("stage_seconds", time.time() - start, stage=stage)
+        return wrapper
+    return decorator
+
+
+def tracing():
+    return trace_fd is not None
+
+
+def trace(event, **fields):
+    '''
+    Appends an event to the trace file, fields must be JSON serializable
+    '''
+
+    if trace_fd is None:
+        return
+    fields["event"] = event
+    fields["time"] = time.time()
+    fields["pid"] = os.getpid()
+    os.write(trace_fd, (json.dumps(fields, sort_keys=True, default=float) + "\n").encode("utf-8"))
+
+
+def registerGauges(callback):
+    '''
+    Parameters:
+        callback    - function returning a dictionary of gauge names and values, read on every export
+    '''
+
+    gauge_callbacks.append(callback)
+
+
+def sample(signum, frame):
+    if frame is None:
+        return
+    key = "%s:%s" % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+    profile_samples[key] = profile_samples.get(key, 0) + 1
+
+
+def startProfiler(interval=0.005):
+    '''
+    Samples the innermost frame of the main thread every interval seconds of CPU time, unix only
+    '''
+
+    global profile_interval
+    if not hasattr(signal, "setitimer"):
+        return
+    profile_interval = interval
+    signal.signal(signal.SIGPROF, sample)
+    signal.setitimer(signal.ITIMER_PROF, interval, interval)
+
+
+def afterFork():
+    '''
+    Restarts the profiler in a forked worker, interval timers are not inherited
+    '''
+
+    if profile_interval:
+        startProfiler(profile_interval)
+
+
+def stopProfiler():
+    global profile_interval
+    if profile_interval and hasattr(signal, "setitimer"):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+    profile_interval = 0
+
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in labels)
+
+
+def metricsText(prefix="bargain_"):
+    '''
+    Returns:
+        the metrics in the Prometheus text exposition format
+    '''
+
+    lines = []
+    with lock:
+        counter_items = sorted(counters.items())
+        summary_items = sorted((key, list(value)) for key, value in summaries.items())
+        sample_items = sorted(profile_samples.items())
+
+    typed = set()
+    for (name, labels), value in counter_items:
+        if name not in typed:
+            lines.append("# TYPE %s%s_total counter" % (prefix, name))
+            typed.add(name)
+        lines.append("%s%s_total%s %s" % (prefix, name, formatLabels(labels), value))
+    for (name, labels), (number, total, maximum) in summary_items:
+        if name not in typed:
+            lines.append("# TYPE %s%s summary" % (prefix, name))
+            typed.add(name)
+        lines.append("%s%s_count%s %d" % (prefix, name, formatLabels(labels), number))
+        lines.append("%s%s_sum%s %r" % (prefix, name, formatLabels(labels), float(total)))
+    for (name, labels), (number, total, maximum) in summary_items:
+        if name + "_max" not in typed:
+            lines.append("# TYPE %s%s_max gauge" % (prefix, name))
+            typed.add(name + "_max")
+        lines.append("%s%s_max%s %r" % (prefix, name, formatLabels(labels), float(maximum)))
+    if sample_items:
+        lines.append("# TYPE %sprofile_samples_total counter" % prefix)
+        for function, samples in sample_items:
+            lines.append("%sprofile_samples_total%s %d" % (prefix, formatLabels([("function", function)]), samples))
+    for callback in gauge_callbacks:
+        for name, value in sorted(callback().items()):
+            lines.append("# TYPE %s%s gauge" % (prefix, name))
+            lines.append("%s%s %r" % (prefix, name, float(value)))
+    return "\n".join(lines) + "\n"
+
+
+configure(metrics=os.environ.get("BARGAIN_METRICS", "") not in ("", "0"),
+          trace=os.environ.get("BARGAIN_TRACE") or None,
+          profile=float(os.environ.get("BARGAIN_PROFILE") or 0) or None)
+atexit.register(stopProfiler)
@@ -0,0 +1,420 @@
+'''
+Online learning of the cooccurance matrix from the negotiations that ended
+With BARGAIN_DEAL_LOG=/path/deals.jsonl every worker appends the bundle of every accepted or rejected negotiation
+to a deal log. The learner, a separate process, folds the new deals into the cooccurance counts as invoices and
+rescores the neighbours of the products they touched, then publishes a snapshot named by a version number. A base
+snapshot is a catalog directory (catalog.py) holding the counts, their confidence matrix and the neighbour index;
+the snapshots after it only hold the neighbour index and the rows of the counts and confidences of the products
+touched since the base, until these are more than a share of the catalog and a new base is written. The version is
+published by atomically replacing the CURRENT file of the snapshot directory, e.g.
+    python learning.py deals.jsonl ./snapshots --catalog ./data.pkl --interval 60
+Workers started with BARGAIN_SNAPSHOTS=./snapshots poll CURRENT from a background thread, load a new snapshot
+memory-mapped, the rows over those of its base, and swap the recommender of the process for one built on it;
+requests keep the recommender they started with and never wait for a snapshot
+'''
+
+from __future__ import division, print_function
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+import numpy as np
+
+import bargain as bg
+import catalog
+import neighbours as nb
+import priors
+
+CURRENT = "CURRENT"
+# description of a snapshot, its base and the layout of its rows
+SNAPSHOT = "snapshot.json"
+
+
+class DealLog:
+    def __init__(self, path):
+        '''
+        Parameters:
+            path    - path of the log file, appended to by every worker
+        '''
+
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def record(self, bundle, outcome):
+        '''
+        Parameters:
+            bundle  - indices of the items of the agent's last offer, the product last
+            outcome - accepted, the bundle was bought, or rejected, the product was bought alone
+        '''
+
+        line = json.dumps({"bundle": [int(i) for i in bundle], "outcome": outcome, "time": time.time()},
+                          separators=(',', ':')) + "\n"
+        # a single short write, appended whole whichever worker writes at the same time
+        os.write(self.fd, line.encode("utf-8"))
+
+    def close(self):
+        os.close(self.fd)
+        self.fd = None
+
+
+def openDealLog(path=None):
+    '''
+    Returns:
+        the DealLog of BARGAIN_DEAL_LOG, or None when deals are not logged
+    '''
+
+    if path is None:
+        path = os.environ.get("BARGAIN_DEAL_LOG")
+    if not path:
+        return None
+    return DealLog(path)
+
+
+def readDeals(deal_file):
+    '''
+    Parameters:
+        deal_file   - deal log opened in binary mode, read from its current position
+    Returns:
+        list of the complete deals read, the position is left after the last one
+    '''
+
+    deals = []
+    while True:
+        position = deal_file.tell()
+        line = deal_file.readline()
+        if not line.endswith(b"\n"):
+            # a line still being written, read again next time
+            deal_file.seek(position)
+            return deals
+        deals.append(json.loads(line.decode("utf-8")))
+
+
+def dealCounts(deals, no_of_products):
+    '''
+    Parameters:
+        deals           - deals read from a deal log
+        no_of_products  - number of products of the catalog, deals of other products are skipped
+    Returns:
+        rows, cols  - the entries of the cooccurance matrix incremented by one per deal, an invoice of the bundle
+                      when it was accepted and of the product alone when it was rejected
+    '''
+
+    rows, cols = [], []
+    for deal in deals:
+        bundle = deal["bundle"]
+        if not bundle:
+            continue
+        items = sorted(set(bundle)) if deal["outcome"] == "accepted" else [bundle[-1]]
+        if any(not 0 <= idx < no_of_products for idx in items):
+            continue
+        for i in items:
+            rows.extend(items)
+            cols.extend([i] * len(items))
+    return np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)
+
+
+def addCounts(cooccurance_matrix, rows, cols):
+    '''
+    Returns:
+        the cooccurance matrix with one added at every (rows, cols), a dense matrix is updated in place
+    '''
+
+    if hasattr(cooccurance_matrix, "tocsr"):
+        from scipy.sparse import coo_matrix
+        # duplicate entries are summed by the conversion
+        return cooccurance_matrix + coo_matrix((np.ones(len(rows), dtype=cooccurance_matrix.dtype), (rows, cols)),
+                                               shape=cooccurance_matrix.shape).tocsr()
+    np.add.at(cooccurance_matrix, (rows, cols), 1)
+    return cooccurance_matrix
+
+
+def readSnapshot(snapshot):
+    '''
+    Returns:
+        the description of a snapshot, its base is None when it is a base, as are those written without one
+    '''
+
+    try:
+        with open(os.path.join(snapshot, SNAPSHOT)) as snapshot_file:
+            return json.load(snapshot_file)
+    except (IOError, OSError):
+        return {"base": None, "confidence": None}
+
+
+def loadRows(snapshot, meta, shape, mmap=True):
+    '''
+    Parameters:
+        snapshot    - directory of a snapshot that is not a base
+        meta        - its description, readSnapshot
+        shape       - shape of the cooccurance matrix
+        mmap        - map the rows into memory instead of reading them
+    Returns:
+        rows        - indices of the products touched since the base
+        counts      - their rows of the cooccurance matrix
+        confidence  - their rows of the confidence matrix
+    '''
+
+    rows = np.load(os.path.join(snapshot, "rows.npy"), mmap_mode="r" if mmap else None)
+    row_shape = (len(rows), shape[1])
+    return (rows, catalog.loadMatrix(snapshot, "cooccurance_rows", meta["layout"], row_shape, mmap),
+            catalog.loadMatrix(snapshot, "confidence_rows", meta["layout"], row_shape, mmap))
+
+
+def readCurrent(directory):
+    '''
+    Returns:
+        the description of the current snapshot of the directory, None before the first one
+    '''
+
+    try:
+        with open(os.path.join(directory, CURRENT)) as current_file:
+            return json.load(current_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class Learner:
+    def __init__(self, deals_path, directory, catalog_path="./data.pkl", k=10, score="confidence", keep=3,
+                 rebase=0.25):
+        '''
+        Parameters:
+            deals_path      - the deal log
+            directory       - directory the snapshots are published in
+            catalog_path    - catalog the counts start from, unless a snapshot was published already
+            k, score        - neighbours indexed per product and their score, as neighbours.py
+            keep            - number of snapshots kept besides their bases, workers may still be loading them
+            rebase          - share of the products touched since the base above which a new base is written
+        '''
+
+        self.deals_path = deals_path
+        self.directory = directory
+        self.keep = keep
+        self.rebase = rebase
+        current = readCurrent(directory)
+        # the base snapshot and the products touched since, None before the first base
+        self.base = None
+        self.touched = np.zeros(0, dtype=np.intp)
+        if current is None:
+            self.version = 0
+            self.offset = 0
+            self.deals = 0
+            product_list, selling_price, cost_price, cooccurance_matrix = bg.getData(catalog_path)
+            selling_prices, cost_prices = bg.priceArrays(product_list, selling_price, cost_price)
+            self.catalog = catalog.Catalog(product_list, selling_prices, cost_prices, cooccurance_matrix)
+            self.index = nb.buildNeighbourIndex(cooccurance_matrix, k, score)
+        else:
+            # resume from the latest snapshot and the deals after it
+            self.version = current["version"]
+            self.offset = current["offset"]
+            self.deals = current["deals"]
+            snapshot = os.path.join(directory, current["snapshot"])
+            meta = readSnapshot(snapshot)
+            base = meta["base"] or current["snapshot"]
+            self.catalog = catalog.loadCatalog(os.path.join(directory, base), mmap=False)
+            if meta["base"] is not None:
+                self.touched, counts, _ = loadRows(snapshot, meta, self.catalog.cooccurance_matrix.shape, mmap=False)
+                self.catalog.cooccurance_matrix = priors.RowOverlay(self.catalog.cooccurance_matrix, self.touched,
+                                                                    counts).materialize()
+            if meta["base"] is not None or meta["confidence"] is not None:
+                # a snapshot written without the confidences is no base for the next ones
+                self.base = base
+            self.index = nb.NeighbourIndex.load(os.path.join(snapshot, "neighbours"), mmap=False)
+        if not hasattr(self.catalog.cooccurance_matrix, "tocsr"):
+            # counted in place
+            self.catalog.cooccurance_matrix = np.array(self.catalog.cooccurance_matrix)
+
+    def fold(self):
+        '''
+        Adds the deals logged since the last call to the cooccurance counts and the neighbour index
+        Returns:
+            number of deals folded
+        '''
+
+        if not os.path.exists(self.deals_path):
+            return 0
+        with open(self.deals_path, "rb") as deal_file:
+            deal_file.seek(self.offset)
+            deals = readDeals(deal_file)
+            self.offset = deal_file.tell()
+        rows, cols = dealCounts(deals, len(self.catalog.product_list))
+        if len(rows):
+            self.catalog.cooccurance_matrix = addCounts(self.catalog.cooccurance_matrix, rows, cols)
+            touched = np.unique(rows)
+            self.index = nb.updateNeighbourIndex(self.index, self.catalog.cooccurance_matrix, touched)
+            self.touched = np.union1d(self.touched, touched)
+        self.deals += len(deals)
+        return len(deals)
+
+    def publish(self):
+        '''
+        Writes the neighbour index and the rows of the products touched since the base as a new snapshot, or the
+        counts and confidences as a new base when there is none or too many were touched, and makes it the
+        current one
+        Returns:
+            the version of the snapshot
+        '''
+
+        version = self.version + 1
+        name = "%08d" % version
+        path = os.path.join(self.directory, name)
+        if os.path.isdir(path):
+            # left by a learner that stopped before publishing it
+            shutil.rmtree(path)
+        matrix = self.catalog.cooccurance_matrix
+        if self.base is None or len(self.touched) > self.rebase * len(self.catalog.product_list):
+            self.catalog.save(path)
+            meta = {"base": None, "confidence": catalog.saveMatrix(path, "confidence",
+                                                                   priors.confidenceMatrix(matrix))}
+            self.base = name
+            self.touched = np.zeros(0, dtype=np.intp)
+        else:
+            os.makedirs(path)
+            np.save(os.path.join(path, "rows.npy"), self.touched)
+            layout = catalog.saveMatrix(path, "cooccurance_rows", matrix[self.touched])
+            catalog.saveMatrix(path, "confidence_rows", priors.confidenceRows(matrix, self.touched))
+            meta = {"base": self.base, "layout": layout}
+        self.index.save(os.path.join(path, "neighbours"))
+        with open(os.path.join(path, SNAPSHOT), "w") as snapshot_file:
+            json.dump(meta, snapshot_file)
+        current = {"version": version, "snapshot": name, "offset": self.offset, "deals": self.deals,
+                   "published": time.time()}
+        temporary = os.path.join(self.directory, CURRENT + ".tmp")
+        with open(temporary, "w") as current_file:
+            json.dump(current, current_file)
+        # readers see the previous CURRENT or this one, never a partial file
+        os.rename(temporary, os.path.join(self.directory, CURRENT))
+        self.version = version
+        snapshots = sorted(entry for entry in os.listdir(self.directory) if entry.isdigit())
+        # the bases of the snapshots kept are kept with them
+        bases = set(readSnapshot(os.path.join(self.directory, kept))["base"] for kept in snapshots[-self.keep:])
+        for stale in snapshots[:-self.keep]:
+            if stale not in bases:
+                shutil.rmtree(os.path.join(self.directory, stale), ignore_errors=True)
+        return version
+
+    def run(self, interval=60, once=False):
+        '''
+        Folds the new deals every interval seconds and publishes a snapshot when there were any
+        '''
+
+        if self.version == 0:
+            self.publish()
+        while True:
+            if self.fold():
+                self.publish()
+            if once:
+                return
+            time.sleep(interval)
+
+
+class SnapshotWatcher:
+    def __init__(self, directory, swap, interval=5.0, load=None):
+        '''
+        Parameters:
+            directory   - directory the learner publishes snapshots in
+            swap        - called with the recommender built on every new snapshot
+            interval    - seconds between two reads of CURRENT
+            load        - function building a recommender from a snapshot directory, loadRecommender by default
+        '''
+
+        self.directory = directory
+        self.swap = swap
+        self.interval = interval
+        self.load = load or loadRecommender
+        self.version = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.failures = 0
+
+    def poll(self):
+        '''
+        Loads the current snapshot when it is newer than the last one swapped in
+        Returns:
+            True when a new recommender was swapped in
+        '''
+
+        current = readCurrent(self.directory)
+        if current is None or current["version"] == self.version:
+            return False
+        try:
+            recommender = self.load(os.path.join(self.directory, current["snapshot"]))
+        except (IOError, OSError, ValueError):
+            # e.g. removed by the learner in the meantime, the next poll reads the newer one
+            self.failures += 1
+            return False
+        self.swap(recommender)
+        self.version = current["version"]
+        return True
+
+    def watch(self):
+        while True:
+            self.poll()
+            time.sleep(self.interval)
+
+    def start(self):
+        '''
+        Starts polling from a daemon thread unless it is polling already, again in a forked worker whose thread did
+        not survive the fork
+        '''
+
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.watch, name="snapshot-watcher")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def stats(self):
+        return {"recommender_version": self.version or 0, "snapshot_load_failures": self.failures}
+
+
+def loadRecommender(snapshot, bundle_search=None):
+    '''
+    Parameters:
+        snapshot        - directory of a snapshot written by Learner.publish
+        bundle_search   - bundles.BundleSearch of the recommender
+    Returns:
+        the RecommenderSystem of the snapshot, its arrays memory-mapped, the rows of the snapshot over its base
+    '''
+
+    meta = readSnapshot(snapshot)
+    base = snapshot if meta["base"] is None else os.path.join(os.path.dirname(snapshot), meta["base"])
+    base_meta = readSnapshot(base)
+    snapshot_catalog = catalog.loadCatalog(base)
+    cooccurance_matrix = snapshot_catalog.cooccurance_matrix
+    confidence = None
+    if base_meta["confidence"] is not None:
+        confidence = catalog.loadMatrix(base, "confidence", base_meta["confidence"], cooccurance_matrix.shape)
+    if meta["base"] is not None:
+        rows, counts, confidence_rows = loadRows(snapshot, meta, cooccurance_matrix.shape)
+        cooccurance_matrix = priors.RowOverlay(cooccurance_matrix, rows, counts)
+        confidence = priors.RowOverlay(confidence, rows, confidence_rows)
+    return bg.RecommenderSystem(cooccurance_matrix, nb.NeighbourIndex.load(os.path.join(snapshot, "neighbours")),
+                                prior_table=priors.PriorTable(cooccurance_matrix, confidence=confidence),
+                                bundle_search=bundle_search)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("deals", help="deal log written with BARGAIN_DEAL_LOG")
+    parser.add_argument("snapshots", help="directory the snapshots are published in")
+    parser.add_argument("--catalog", default=os.environ.get("BARGAIN_CATALOG", "./data.pkl"),
+                        help="catalog the counts start from before the first snapshot")
+    parser.add_argument("--interval", type=float, default=60, help="seconds between two folds of the deal log")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--score", choices=nb.SCORES, default="confidence")
+    parser.add_argument("--rebase", type=float, default=0.25,
+                        help="share of the products touched since the base above which a new base is written")
+    parser.add_argument("--once", action="store_true", help="fold the deals logged so far and exit")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.snapshots):
+        os.makedirs(args.snapshots)
+    learner = Learner(args.deals, args.snapshots, args.catalog, args.k, args.score, rebase=args.rebase)
+    learner.run(args.interval, args.once)
+    print("Folded %d deals into snapshot %d in %s" % (learner.deals, learner.version, args.snapshots),
+          file=sys.stderr)
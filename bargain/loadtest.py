@@ -0,0 +1,202 @@
+'''
+Load test running many concurrent negotiations against several gunicorn workers
+Every scripted negotiation is first run alone against a single worker; running them concurrently
+across all workers must reproduce exactly the same offers, which only holds when sessions are isolated
+Run from the bargain directory: python loadtest.py --workers 4 --negotiations 200 --concurrency 32
+--api plays the same negotiations through the JSON API served on its own by api:app
+'''
+
+from __future__ import division, print_function
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from urllib.request import build_opener, HTTPCookieProcessor, Request
+    from urllib.parse import quote, urlencode
+    from urllib.error import HTTPError
+    from http.cookiejar import CookieJar
+except ImportError:
+    from urllib2 import build_opener, HTTPCookieProcessor, Request
+    from urllib import quote, urlencode
+    from urllib2 import HTTPError
+    from cookielib import CookieJar
+
+import bargain as bg
+
+OFFER_PATTERN = re.compile(r"at a cost of <b>Rs\.([\d.]+)|To Pay = <b>Rs\. ([\d.]+)")
+
+
+def startServer(port, workers, store_url, app="main:app", worker_class="sync", catalog_path=None):
+    env = dict(os.environ, BARGAIN_STORE=store_url)
+    if catalog_path:
+        env["BARGAIN_CATALOG"] = catalog_path
+    server = subprocess.Popen(["gunicorn", "-w", str(workers), "-k", worker_class, "-b", "127.0.0.1:%d" % port, app],
+                              env=env, stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+    opener = build_opener()
+    for _ in range(100):
+        try:
+            opener.open("http://127.0.0.1:%d/" % port).read()
+            return server
+        except HTTPError:
+            # the API has no index page, any answer means it is up
+            return server
+        except Exception:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("gunicorn did not start on port %d" % port)
+
+
+def negotiationScript(number, product_list, selling_price, recommender):
+    '''
+    Parameters:
+        number          - number of the scripted negotiation
+        product_list    - list of the entire product base
+        selling_price   - list with the selling price of the entire product base
+        recommender     - the recommendation system used by the agent
+    Returns:
+        product_name    - name of the product that the buyer wishes to buy
+        rounds          - list of (bundle indices, proposed cost) offered by the buyer
+    '''
+
+    product_idx = number % len(product_list)
+    possible_items = [int(i) for i in recommender.getListOfPossibleItems(product_idx)]
+    bundle = possible_items[:1 + number % len(possible_items)] + [product_idx]
+    total_selling_price = sum(selling_price[product_list[i]] for i in bundle)
+    rounds = [(bundle, int(total_selling_price * fraction)) for fraction in [0.55, 0.65, 0.75, 0.85]]
+    return product_list[product_idx], rounds
+
+
+def runNegotiation(base_url, product_name, rounds, latencies):
+    '''
+    Plays a scripted negotiation through the HTML views with its own session cookie
+    Returns:
+        transcript  - the cost of every offer the agent made
+    '''
+
+    opener = build_opener(HTTPCookieProcessor(CookieJar()))
+    transcript = []
+
+    def call(url, data=None):
+        start = time.time()
+        page = opener.open(url, data).read().decode("utf-8")
+        latencies.append(time.time() - start)
+        match = OFFER_PATTERN.search(page)
+        transcript.append(match.group(1) or match.group(2))
+        return "To Pay" in page
+
+    accepted = call("%s/first_negotiate/%s" % (base_url, quote(product_name)))
+    for bundle, cost in rounds:
+        if accepted:
+            break
+        form = [(str(i), "on") for i in bundle[:-1]] + [("cost", str(cost))]
+        accepted = call("%s/negotiate/%s" % (base_url, quote(product_name)), urlencode(form).encode("utf-8"))
+    return transcript
+
+
+def runApiNegotiation(base_url, product_idx, rounds, latencies):
+    '''
+    Plays a scripted negotiation through the JSON API
+    Returns:
+        transcript  - the cost of every offer the agent made
+    '''
+
+    opener = build_opener()
+    transcript = []
+
+    def call(url, body):
+        start = time.time()
+        request = Request(url, json.dumps(body).encode("utf-8"), {"Content-Type": "application/json"})
+        response = json.loads(opener.open(request).read().decode("utf-8"))
+        latencies.append(time.time() - start)
+        transcript.append("%.1f" % response["offer"]["cost"])
+        return response
+
+    response = call("%s/api/negotiations" % base_url, {"product_id": product_idx})
+    url = "%s/api/negotiations/%s/offers" % (base_url, response["session_id"])
+    for bundle, cost in rounds:
+        if response["offer"]["accepted"]:
+            break
+        response = call(url, {"bundle": bundle[:-1], "cost": cost})
+    return transcript
+
+
+def runAll(base_url, scripts, concurrency, run=runNegotiation):
+    transcripts = [None] * len(scripts)
+    latencies = []
+    pending = list(range(len(scripts)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                number = pending.pop()
+            transcripts[number] = run(base_url, scripts[number][0], scripts[number][1], latencies)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return transcripts, latencies, time.time() - start
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--negotiations", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--store", default=None,
+                        help="negotiation store url, a fresh SQLite file in the temp directory by default")
+    parser.add_argument("--api", action="store_true", help="negotiate through the JSON API instead of the HTML views")
+    parser.add_argument("--worker-class", default="sync", help="gunicorn worker class, e.g. gevent")
+    args = parser.parse_args()
+
+    product_list, selling_price, cost_price, cooccurance_matrix = bg.getData()
+    recommender = bg.RecommenderSystem(cooccurance_matrix)
+    scripts = [negotiationScript(n, product_list, selling_price, recommender) for n in range(args.negotiations)]
+    base_url = "http://127.0.0.1:%d" % args.port
+    app, run = "main:app", runNegotiation
+    if args.api:
+        app, run = "api:app", runApiNegotiation
+        scripts = [(product_list.index(name), rounds) for name, rounds in scripts]
+
+    store_url = args.store or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "loadtest.db")
+    server = startServer(args.port, 1, store_url, app, args.worker_class)
+    try:
+        expected, _, _ = runAll(base_url, scripts, 1, run)
+    finally:
+        server.terminate()
+        server.wait()
+
+    server = startServer(args.port, args.workers, store_url, app, args.worker_class)
+    try:
+        transcripts, latencies, elapsed = runAll(base_url, scripts, args.concurrency, run)
+    finally:
+        server.terminate()
+        server.wait()
+
+    mismatches = sum(1 for a, b in zip(expected, transcripts) if a != b)
+    print("%d negotiations, %d requests on %d workers with %d clients in %.2f s" % (
+        len(scripts), len(latencies), args.workers, args.concurrency, elapsed))
+    print("throughput %.1f requests/s, latency p50 %.1f ms, p95 %.1f ms, p99 %.1f ms" % (
+        len(latencies) / elapsed, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000,
+        percentile(latencies, 0.99) * 1000))
+    print("%d negotiations differ from their isolated run" % mismatches)
+    sys.exit(1 if mismatches else 0)
@@ -1,108 +1,124 @@
-from flask import Flask, render_template, request
+from flask import Flask, render_template, request, g
 import bargain as bg
+import api
+import pages
+import sessions
+from sessions import product_list, product_index
 from werkzeug.serving import run_simple
 
-# set to True to inform that the app needs to be re-created
-to_reload = False
-offer = None
+SESSION_COOKIE = 'negotiation_id'
 
 def get_app():
     app = Flask(__name__)
-    product_list, selling_price, cost_price, cooccurance_matrix = bg.getData()
-    agent = bg.Agent(product_list, cost_price, selling_price, max_initial_discount_rate=0.1, min_profit_margin = 0.3)
-    buyer = bg.Buyer(len(product_list))
-    offer_history = list()
+    app.register_blueprint(api.blueprint)
+    app.add_url_rule('/metrics', 'metrics', api.metrics)
+
+    def get_session_id():
+        if 'session_id' not in g:
+            g.session_id = request.cookies.get(SESSION_COOKIE)
+            if not g.session_id:
+                g.session_id = g.new_session_id = sessions.newSessionId()
+        return g.session_id
+
+    def load_negotiation():
+        return sessions.loadNegotiation(get_session_id())
+
+    def selling_price_of(agent):
+        # the prices the negotiation started with
+        return sessions.negotiationPrices(agent.price_version).priceDicts()[0]
+
+    def save_negotiation(agent, buyer, offer, offer_history):
+        sessions.saveNegotiation(get_session_id(), agent, buyer, offer, offer_history)
+
+    @app.after_request
+    def set_session_cookie(response):
+        if 'new_session_id' in g:
+            response.set_cookie(SESSION_COOKIE, g.new_session_id, httponly=True)
+        return response
 
     @app.route('/', methods=['GET'])
     def index():
-        print("RELOADED")
-        global offer
-        offer = None
-        offer_history = list()
-        global to_reload
-        to_reload = True
-        return render_template('index.html', product_list=product_list, selling_price=selling_price)
+        # a visit to the index starts a new negotiation for this session only
+        sessions.deleteNegotiation(get_session_id())
+        # the page only changes with the catalog, browsers revalidate it with If-None-Match
+        html, etag = pages.indexPage()
+        response = app.make_response(html)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
 
     @app.route('/first_negotiate/<string:product_name>', methods=['GET', 'POST'])
     def first_negotiate(product_name):
-        global offer
-        offer = None
-        idx = bg.getProductIndex(product_list, product_name)[0]
-        recommender = bg.RecommenderSystem(cooccurance_matrix)
+        # a new negotiation, whatever the session negotiated before
+        agent, buyer, offer, offer_history = sessions.newNegotiation()
+        selling_price = selling_price_of(agent)
+        idx = bg.getProductIndex(product_list, product_name, product_index)[0]
         proposed_offer = {"Bundle" : [idx], "Cost" : None}
-        offer = bg.negotiation(agent, buyer, cooccurance_matrix, product_list, selling_price, idx, offer, proposed_offer)
-        offer_history.append(offer)
+        offer = sessions.negotiate(get_session_id(), agent, buyer, offer, proposed_offer)
         bundle_idx = offer["Bundle"][:-1]
         offer["Cost"] = round(offer["Cost"])
+        offer_history.append(offer, agent.last_round)
+        save_negotiation(agent, buyer, offer, offer_history)
         if offer["Accepted"]:
+            sessions.finishNegotiation(offer_history, 'accepted')
             product_idx = offer["Bundle"][-1]
             total_selling_price = 0
             for i in offer["Bundle"]:
                 total_selling_price += selling_price[product_list[i]]
-            return render_template('accept.html', product_list=product_list, product_idx=idx, product_names=','.join([product_list[idx] for idx in bundle_idx]), amount_saved=total_selling_price - offer["Cost"], cost=offer["Cost"], offer_history=offer_history)
+            return pages.acceptPage(idx, bundle_idx, total_selling_price - offer["Cost"], offer["Cost"], agent.price_version, offer_history)
         else:
             product_idx = offer["Bundle"][-1]
             amount_saved = selling_price[product_list[product_idx]] + sum([selling_price[product_list[i]] for i in bundle_idx]) - offer["Cost"]
-            return render_template('negotiate.html', product_list=product_list, product_idx=product_idx, selling_price=selling_price, amount_saved=round(amount_saved), offer=offer, possible_items = recommender.getListOfPossibleItems(product_idx), product_names=','.join([product_list[i] for i in offer['Bundle']]), offer_history=offer_history)
+            return pages.negotiatePage(offer, round(amount_saved), offer_history, agent.price_version)
 
     @app.route('/negotiate/<string:product_name>', methods=['POST'])
     def rest_negotiate(product_name):
-        global offer
-        print(request.form)
+        agent, buyer, offer, offer_history = load_negotiation()
+        selling_price = selling_price_of(agent)
         idx = [int(i) for i in request.form if i != 'cost']
-        idx.append(bg.getProductIndex(product_list,product_name)[0])
-        recommender = bg.RecommenderSystem(cooccurance_matrix)
+        idx.append(bg.getProductIndex(product_list, product_name, product_index)[0])
         proposed_offer = {"Bundle" : idx, "Cost" : int(request.form['cost'])}
         offer_history.append(proposed_offer)
-        offer = bg.negotiation(agent, buyer, cooccurance_matrix, product_list, selling_price, idx, offer, proposed_offer)
-        offer_history.append(offer)
+        offer = sessions.negotiate(get_session_id(), agent, buyer, offer, proposed_offer)
         bundle_idx = offer["Bundle"][:-1]
         offer["Cost"] = round(offer["Cost"])
         if(offer["Cost"] <= proposed_offer["Cost"]):
             offer["Accepted"] = True
-            
+        offer_history.append(offer, agent.last_round)
+        save_negotiation(agent, buyer, offer, offer_history)
+
         if offer["Accepted"]:
+            sessions.finishNegotiation(offer_history, 'accepted')
             product_idx = offer["Bundle"][-1]
             total_selling_price = 0
             for i in offer["Bundle"]:
                 total_selling_price += selling_price[product_list[i]]
-            return render_template('accept.html', product_list=product_list, product_idx=product_idx, product_names=','.join([product_list[idx] for idx in bundle_idx]), amount_saved=total_selling_price - offer["Cost"], cost=offer["Cost"], offer_history=offer_history)
+            return pages.acceptPage(product_idx, bundle_idx, total_selling_price - offer["Cost"], offer["Cost"], agent.price_version, offer_history)
         else:
             product_idx = offer["Bundle"][-1]
             amount_saved = selling_price[product_list[product_idx]] + sum([selling_price[product_list[i]] for i in bundle_idx]) - offer["Cost"]
-            return render_template('negotiate.html', product_list=product_list, product_idx=product_idx, selling_price=selling_price, amount_saved=amount_saved, offer=offer, possible_items = recommender.getListOfPossibleItems(product_idx), product_names=','.join([product_list[i] for i in offer['Bundle']]), offer_history=offer_history)
+            return pages.negotiatePage(offer, amount_saved, offer_history, agent.price_version)
 
     @app.route('/accept/<string:product_names>/<int:accept>/<int:cost>/<int:amount_saved>')
     def accept(product_names, accept, cost, amount_saved):
-        indices = bg.getProductIndex(product_list, product_names)
+        agent, buyer, offer, offer_history = load_negotiation()
+        selling_price = selling_price_of(agent)
+        if offer is not None and not offer["Accepted"]:
+            sessions.finishNegotiation(offer_history, 'accepted' if accept else 'rejected')
+        # the negotiation ended, its state is dropped rather than left to expire
+        sessions.deleteNegotiation(get_session_id())
+        indices = bg.getProductIndex(product_list, product_names, product_index)
         bundle_idx = indices[:-1]
         product_idx = indices[-1]
         if accept:
-            return render_template('accept.html', product_list=product_list, product_idx=product_idx, product_names=','.join([product_list[idx] for idx in bundle_idx]), amount_saved=round(amount_saved), cost=round(cost))
+            return pages.acceptPage(product_idx, bundle_idx, round(amount_saved), round(cost), agent.price_version)
         else:
             return render_template('reject.html', product=product_list[product_idx], cost=int(selling_price[product_list[product_idx]]))
 
     return app
 
-class AppReloader(object):
-    def __init__(self, create_app):
-        self.create_app = create_app
-        self.app = create_app()
-
-    def get_application(self):
-        global to_reload
-        if to_reload:
-            self.app = self.create_app()
-            to_reload = False
-
-        return self.app
-
-    def __call__(self, environ, start_response):
-        app = self.get_application()
-        return app(environ, start_response)
-
-app = AppReloader(get_app)
+app = get_app()
 
 if __name__ == "__main__":
-    run_simple('localhost', 8080, application,
+    run_simple('localhost', 8080, app,
                use_reloader=True, use_debugger=True, use_evalex=True)
\ No newline at end of file
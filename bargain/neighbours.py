@@ -0,0 +1,199 @@
+'''
+Top-k neighbour index of the cooccurance matrix used by the recommender system
+The index can be rebuilt offline and is loaded memory-mapped, e.g.
+    python neighbours.py --k 10 --score confidence --output ./neighbours
+'''
+
+from __future__ import division, print_function
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+SCORES = ["confidence", "lift"]
+INDEX_VERSION = 1
+
+
+class NeighbourIndex:
+    def __init__(self, neighbours, scores, score="confidence"):
+        '''
+        Parameters:
+            neighbours  - matrix with the indices of the top-k neighbours of every product, best first,
+                          padded with -1 for products with fewer neighbours
+            scores      - matrix with the score of every neighbour
+            score       - name of the score the neighbours are ordered by
+        '''
+
+        self.neighbours = neighbours
+        self.scores = scores
+        self.score = score
+        self.k = neighbours.shape[1]
+
+    def topNeighbours(self, product_idx, k=None):
+        '''
+        Parameters:
+            product_idx - index of the product
+            k           - number of neighbours, all indexed neighbours by default
+        Returns:
+            indices of the best neighbours of the product, best first
+        '''
+
+        row = self.neighbours[product_idx, :self.k if k is None else k]
+        if len(row) and row[-1] < 0:
+            row = row[row >= 0]
+        return row.astype(np.intp)
+
+    def save(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        np.save(os.path.join(directory, "neighbours.npy"), self.neighbours)
+        np.save(os.path.join(directory, "scores.npy"), self.scores)
+        with open(os.path.join(directory, "index.json"), "w") as index_file:
+            json.dump({"version": INDEX_VERSION, "score": self.score, "k": self.k}, index_file)
+
+    @staticmethod
+    def load(directory, mmap=True):
+        '''
+        Parameters:
+            directory   - directory the index was saved to
+            mmap        - map the index into memory instead of reading it, so that processes share its pages
+        Returns:
+            the NeighbourIndex
+        '''
+
+        with open(os.path.join(directory, "index.json")) as index_file:
+            meta = json.load(index_file)
+        if meta["version"] != INDEX_VERSION:
+            raise ValueError("Unsupported neighbour index version %s in %s" % (meta["version"], directory))
+        mmap_mode = "r" if mmap else None
+        return NeighbourIndex(np.load(os.path.join(directory, "neighbours.npy"), mmap_mode=mmap_mode),
+                              np.load(os.path.join(directory, "scores.npy"), mmap_mode=mmap_mode), meta["score"])
+
+
+def rowScores(counts, product_idx, neighbour_idx, diagonal, score):
+    # confidence of product -> neighbour, or lift up to the constant number of invoices
+    support = max(diagonal[product_idx], 1)
+    if score == "confidence":
+        return counts / support
+    return counts / (support * np.maximum(diagonal[neighbour_idx], 1))
+
+
+def topK(neighbour_idx, scores, k):
+    '''
+    Returns:
+        the k best neighbours and their scores, by decreasing score and then increasing index
+    '''
+
+    keep = scores > 0
+    neighbour_idx, scores = neighbour_idx[keep], scores[keep]
+    if len(scores) > k:
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        # neighbours tied with the k-th best compete on their index
+        candidates = np.flatnonzero(scores >= scores[candidates].min())
+        neighbour_idx, scores = neighbour_idx[candidates], scores[candidates]
+    order = np.lexsort((neighbour_idx, -scores))[:k]
+    return neighbour_idx[order], scores[order]
+
+
+def countMatrix(cooccurance_matrix):
+    # the matrix in the form its rows are read in, and its diagonal
+    if hasattr(cooccurance_matrix, "tocsr"):
+        matrix = cooccurance_matrix.tocsr()
+        return matrix, np.asarray(matrix.diagonal(), dtype=np.float64)
+    matrix = np.asarray(cooccurance_matrix)
+    return matrix, np.diag(matrix).astype(np.float64)
+
+
+def indexRows(matrix, diagonal, rows, neighbours, scores, score, chunk_size=256):
+    '''
+    Writes the top-k neighbours of the given products into neighbours and scores
+    Parameters:
+        matrix, diagonal    - the cooccurance matrix and its diagonal, as countMatrix returns them
+        rows                - indices of the products
+        neighbours, scores  - matrices of the index, k columns
+    '''
+
+    sparse = hasattr(matrix, "indptr")
+    no_of_products = matrix.shape[0]
+    k = neighbours.shape[1]
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        if not sparse:
+            chunk_rows = matrix[chunk].astype(np.float64)
+        for position, product_idx in enumerate(chunk):
+            if sparse:
+                row_start, row_stop = matrix.indptr[product_idx], matrix.indptr[product_idx + 1]
+                neighbour_idx = matrix.indices[row_start:row_stop]
+                counts = matrix.data[row_start:row_stop].astype(np.float64)
+            else:
+                neighbour_idx = np.arange(no_of_products)
+                counts = chunk_rows[position]
+            other = neighbour_idx != product_idx
+            neighbour_idx, counts = neighbour_idx[other], counts[other]
+            best_idx, best_scores = topK(neighbour_idx, rowScores(counts, product_idx, neighbour_idx, diagonal,
+                                                                  score), k)
+            neighbours[product_idx] = -1
+            scores[product_idx] = 0
+            neighbours[product_idx, :len(best_idx)] = best_idx
+            scores[product_idx, :len(best_idx)] = best_scores
+
+
+def buildNeighbourIndex(cooccurance_matrix, k=10, score="confidence", chunk_size=256):
+    '''
+    Parameters:
+        cooccurance_matrix  - dense array or scipy sparse cooccurance matrix
+        k                   - number of neighbours kept for every product
+        score               - confidence or lift
+        chunk_size          - rows of a dense matrix scored at once
+    Returns:
+        the NeighbourIndex
+    '''
+
+    if score not in SCORES:
+        raise ValueError("Unknown neighbour score %s, expected one of %s" % (score, ", ".join(SCORES)))
+
+    matrix, diagonal = countMatrix(cooccurance_matrix)
+    no_of_products = matrix.shape[0]
+    k = max(1, min(k, no_of_products - 1))
+    neighbours = np.full((no_of_products, k), -1, dtype=np.int32)
+    scores = np.zeros((no_of_products, k), dtype=np.float32)
+    indexRows(matrix, diagonal, np.arange(no_of_products), neighbours, scores, score, chunk_size)
+    return NeighbourIndex(neighbours, scores, score)
+
+
+def updateNeighbourIndex(index, cooccurance_matrix, rows):
+    '''
+    Parameters:
+        index               - NeighbourIndex of the matrix before some of its rows changed, left unchanged
+        cooccurance_matrix  - the changed cooccurance matrix
+        rows                - indices of the products whose row or diagonal entry changed
+    Returns:
+        the NeighbourIndex of the changed matrix, as buildNeighbourIndex builds it. Confidence only depends on the
+        row of a product, only the given rows are rescored; lift also depends on the sales of the neighbours,
+        every row is
+    '''
+
+    matrix, diagonal = countMatrix(cooccurance_matrix)
+    if index.score != "confidence":
+        rows = np.arange(matrix.shape[0])
+    neighbours = np.array(index.neighbours)
+    scores = np.array(index.scores)
+    indexRows(matrix, diagonal, np.unique(np.asarray(rows, dtype=np.intp)), neighbours, scores, index.score)
+    return NeighbourIndex(neighbours, scores, index.score)
+
+
+if __name__ == "__main__":
+    import bargain as bg
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--score", choices=SCORES, default="confidence")
+    parser.add_argument("--output", default="./neighbours")
+    args = parser.parse_args()
+
+    product_list, selling_price, cost_price, cooccurance_matrix = bg.getData()
+    index = buildNeighbourIndex(cooccurance_matrix, args.k, args.score)
+    index.save(args.output)
+    print("Indexed %d neighbours of %d products in %s" % (index.k, len(product_list), args.output))
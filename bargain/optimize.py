@@ -0,0 +1,384 @@
+'''
+Hyper-parameter optimizer of the agent's concession strategy
+Searches the AgentConfig that does best against the scripted and stochastic buyers of simulate.py. Every
+configuration is evaluated on the same negotiations (products, buyers and seeds), played headless on all cores,
+and reported with the agent's mean profit per negotiation, its success rate and the rounds it takes to close a
+deal. Evaluations are cached in a JSON lines file, so a search can be resumed or extended without playing the
+configurations again. The searches:
+    random      - configurations sampled uniformly from the search space
+    halving     - successive halving: the configurations are played on a few negotiations, the best 1 / eta of them
+                  on eta times as many, and so on up to --negotiations
+    bayesian    - a Gaussian process fitted to the scores so far proposes the configurations of highest expected
+                  improvement, a batch of them per round to keep every process busy
+Run from the bargain directory, e.g.
+    python optimize.py --search halving --configs 81 --negotiations 2000 --output best_config.json
+    python optimize.py --search bayesian --space alpha=0.2:0.8,decay_factor=1:1.6,pace=0.08
+The best configuration is saved with AgentConfig.save, for simulate.py --config and BARGAIN_AGENT_CONFIG
+'''
+
+from __future__ import division, print_function
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import time
+
+import numpy as np
+
+import bargain as bg
+import simulate
+
+# name, low and high of every AgentConfig parameter searched by default, the defaults lie within; bidding_distance
+# is left out, the offers do not depend on it
+SPACE = [("max_initial_discount_rate", 0.0, 0.3), ("min_profit_margin", 0.0, 0.6), ("num_rounds", 0.2, 0.9),
+         ("alpha", 0.1, 1.0), ("decay_factor", 0.8, 1.6), ("first_round_pace", 0.02, 0.2), ("pace", 0.02, 0.2),
+         ("learning_rate_exponent", -3.0, -1.0)]
+OBJECTIVES = ["profit", "success_rate", "rounds_to_close"]
+
+
+def parseSpace(text):
+    '''
+    Parameters:
+        text    - comma separated name=low:high ranges, or name=value to fix a parameter
+    Returns:
+        the search space, the parameters not named keep their default
+    '''
+
+    space = []
+    names = [name for name, _, _ in SPACE]
+    for item in text.split(","):
+        name, _, bounds = item.partition("=")
+        name = name.strip()
+        if name not in names:
+            raise ValueError("unknown parameter %s, expected one of %s" % (name, ", ".join(names)))
+        values = [float(value) for value in bounds.split(":")]
+        space.append((name, values[0], values[-1]))
+    return space
+
+
+def sample(space, rnd):
+    values = {}
+    for name, low, high in space:
+        # rounded so that cache keys stay readable
+        values[name] = round(rnd.uniform(low, high), 6)
+    return values
+
+
+def makeConfig(values):
+    config = bg.AgentConfig()
+    for name, value in values.items():
+        setattr(config, name, value)
+    return config
+
+
+def normalize(space, configs):
+    # the searched parameters of the configs scaled to [0, 1]
+    points = np.zeros((len(configs), len(space)))
+    for j, (name, low, high) in enumerate(space):
+        for i, config in enumerate(configs):
+            points[i, j] = (getattr(config, name) - low) / (high - low) if high > low else 0.5
+    return points
+
+
+def score(metrics, objective):
+    '''
+    Returns:
+        the score of an evaluation, higher is better
+    '''
+
+    if objective == "rounds_to_close":
+        # fewer rounds is better, a configuration closing no deals is the worst
+        return -metrics["rounds_to_close"] if metrics["rounds_to_close"] is not None else -float("inf")
+    return metrics[objective]
+
+
+def playChunk(chunk):
+    '''
+    Plays negotiations of a configuration in a worker process
+    Parameters:
+        chunk   - (key of the configuration, list of simulate tasks)
+    Returns:
+        key     - key of the configuration
+        totals  - negotiations, total profit, successes, rounds of the successes and errors
+    '''
+
+    key, tasks = chunk
+    totals = [0, 0.0, 0, 0, 0]
+    for task in tasks:
+        totals[0] += 1
+        try:
+            result, _ = simulate.runNegotiation(task)
+        except (ZeroDivisionError, OverflowError, ValueError, KeyError):
+            # e.g. an alpha adapted down to 0, counted as a failure without profit
+            totals[4] += 1
+            continue
+        totals[1] += result[simulate.RESULT_COLUMNS.index("profit")]
+        if result[simulate.RESULT_COLUMNS.index("success")]:
+            totals[2] += 1
+            totals[3] += result[simulate.RESULT_COLUMNS.index("iterations")]
+    return key, totals
+
+
+class EvaluationCache:
+    def __init__(self, path=None):
+        '''
+        Parameters:
+            path    - JSON lines file the evaluations are read from and appended to, kept in memory only when None
+        '''
+
+        self.path = path
+        self.evaluations = {}
+        if path and os.path.exists(path):
+            with open(path) as cache_file:
+                for line in cache_file:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.evaluations[entry["key"]] = entry["metrics"]
+
+    def get(self, key):
+        return self.evaluations.get(key)
+
+    def put(self, key, metrics):
+        self.evaluations[key] = metrics
+        if self.path:
+            with open(self.path, "a") as cache_file:
+                cache_file.write(json.dumps({"key": key, "metrics": metrics}, sort_keys=True) + "\n")
+
+
+class Evaluator:
+    def __init__(self, pool, no_of_products, strategy="mixed", max_iterations=20, seed=0, cache=None,
+                 chunk_size=50):
+        '''
+        Parameters:
+            pool            - multiprocessing.Pool initialized with simulate.loadCatalog
+            no_of_products  - number of products in the catalog
+            strategy        - scripted, stochastic or mixed buyers, as simulate.py
+            max_iterations  - number of counter-offers after which the buyer gives up
+            seed            - seed of the simulated buyers, the same for every configuration
+            cache           - EvaluationCache of the evaluations
+            chunk_size      - negotiations played per task of the pool
+        '''
+
+        self.pool = pool
+        self.no_of_products = no_of_products
+        self.strategy = strategy
+        self.max_iterations = max_iterations
+        self.seed = seed
+        self.cache = cache if cache is not None else EvaluationCache()
+        self.chunk_size = chunk_size
+        self.played = 0
+        self.hits = 0
+
+    def key(self, config, negotiations):
+        return json.dumps({"config": config.asDict(), "negotiations": negotiations, "strategy": self.strategy,
+                           "max_iterations": self.max_iterations, "seed": self.seed}, sort_keys=True)
+
+    def evaluate(self, configs, negotiations):
+        '''
+        Parameters:
+            configs         - list of AgentConfig
+            negotiations    - number of negotiations every configuration is played on
+        Returns:
+            list of the metrics of every configuration: negotiations, profit (mean per negotiation), success_rate,
+            rounds_to_close (mean counter-offers of the successes, None without any) and errors
+        '''
+
+        keys = [self.key(config, negotiations) for config in configs]
+        chunks = []
+        pending = {}
+        for config, key in zip(configs, keys):
+            if self.cache.get(key) is not None or key in pending:
+                self.hits += 1
+                continue
+            pending[key] = [0, 0.0, 0, 0, 0]
+            values = config.asDict()
+            tasks = list(simulate.makeTasks(negotiations, self.strategy, [config.max_initial_discount_rate],
+                                            [config.min_profit_margin], [config.num_rounds], self.max_iterations,
+                                            self.seed, self.no_of_products, values))
+            for start in range(0, len(tasks), self.chunk_size):
+                chunks.append((key, tasks[start:start + self.chunk_size]))
+        # the chunks of all configurations share the pool
+        for key, totals in self.pool.imap_unordered(playChunk, chunks):
+            pending[key] = [total + value for total, value in zip(pending[key], totals)]
+        for key, (count, profit, successes, rounds, errors) in pending.items():
+            self.played += count
+            self.cache.put(key, {"negotiations": count, "profit": profit / count, "success_rate": successes / count,
+                                 "rounds_to_close": rounds / successes if successes else None, "errors": errors})
+        return [self.cache.get(key) for key in keys]
+
+
+def randomSearch(evaluator, space, configs, negotiations, objective, rnd):
+    '''
+    Returns:
+        list of (AgentConfig, metrics) of the configurations evaluated on all negotiations
+    '''
+
+    candidates = [makeConfig(sample(space, rnd)) for _ in range(configs)]
+    return list(zip(candidates, evaluator.evaluate(candidates, negotiations)))
+
+
+def successiveHalving(evaluator, space, configs, negotiations, objective, rnd, eta=3):
+    '''
+    Plays configs configurations on negotiations / eta ** k negotiations, keeps the best 1 / eta of them and plays
+    those on eta times as many, until the survivors are played on all negotiations
+    Returns:
+        list of (AgentConfig, metrics) of the configurations evaluated on all negotiations
+    '''
+
+    candidates = [makeConfig(sample(space, rnd)) for _ in range(configs)]
+    rungs = int(math.log(max(configs, 1)) / math.log(eta))
+    budget = max(1, negotiations // eta ** rungs)
+    while True:
+        metrics = evaluator.evaluate(candidates, budget)
+        print("%d configurations on %d negotiations" % (len(candidates), budget))
+        if budget >= negotiations:
+            return list(zip(candidates, metrics))
+        ranked = sorted(zip(candidates, metrics), key=lambda item: score(item[1], objective), reverse=True)
+        candidates = [config for config, _ in ranked[:max(1, len(ranked) // eta)]]
+        budget = min(negotiations, budget * eta)
+
+
+def gaussianProcess(points, values, candidates, length_scales=(0.1, 0.2, 0.5, 1.0), noise=1e-2):
+    '''
+    Posterior of a Gaussian process with a squared exponential kernel, its length scale chosen by the marginal
+    likelihood of the values
+    Parameters:
+        points      - array of the evaluated points, in [0, 1]
+        values      - their standardized scores
+        candidates  - array of the points to predict
+    Returns:
+        mean, std   - the posterior mean and standard deviation at the candidates
+    '''
+
+    def kernel(a, b, length_scale):
+        distances = ((a[:, np.newaxis, :] - b[np.newaxis, :, :]) ** 2).sum(axis=2)
+        return np.exp(-0.5 * distances / length_scale ** 2)
+
+    best = None
+    for length_scale in length_scales:
+        cholesky = np.linalg.cholesky(kernel(points, points, length_scale) + noise * np.eye(len(points)))
+        weights = np.linalg.solve(cholesky.T, np.linalg.solve(cholesky, values))
+        likelihood = -0.5 * values.dot(weights) - np.log(np.diag(cholesky)).sum()
+        if best is None or likelihood > best[0]:
+            best = (likelihood, length_scale, cholesky, weights)
+    _, length_scale, cholesky, weights = best
+    cross = kernel(candidates, points, length_scale)
+    mean = cross.dot(weights)
+    projection = np.linalg.solve(cholesky, cross.T)
+    variance = np.maximum(1 - (projection ** 2).sum(axis=0), 1e-12)
+    return mean, np.sqrt(variance)
+
+
+def expectedImprovement(mean, std, best):
+    z = (mean - best) / std
+    cdf = 0.5 * (1 + np.array([math.erf(value / math.sqrt(2)) for value in z]))
+    pdf = np.exp(-0.5 * z ** 2) / math.sqrt(2 * math.pi)
+    return (mean - best) * cdf + std * pdf
+
+
+def bayesianSearch(evaluator, space, configs, negotiations, objective, rnd, batch=4, initial=None,
+                   candidates=2000):
+    '''
+    Evaluates initial random configurations, then batches of those of highest expected improvement under a
+    Gaussian process fitted to the scores, until configs configurations were evaluated
+    Parameters:
+        batch       - configurations evaluated per round, e.g. the number of processes
+        initial     - random configurations evaluated first, twice the number of searched parameters by default
+        candidates  - random configurations the expected improvement is computed for every round
+    Returns:
+        list of (AgentConfig, metrics) of the configurations evaluated on all negotiations
+    '''
+
+    if initial is None:
+        initial = 2 * len(space)
+    initial = max(2, min(initial, configs))
+    evaluated = randomSearch(evaluator, space, initial, negotiations, objective, rnd)
+    while len(evaluated) < configs:
+        scores = np.array([score(metrics, objective) for _, metrics in evaluated])
+        finite = np.isfinite(scores)
+        # configurations closing no deals rank with the worst of the others
+        scores[~finite] = scores[finite].min() if finite.any() else 0
+        values = (scores - scores.mean()) / (scores.std() or 1)
+        proposals = [makeConfig(sample(space, rnd)) for _ in range(candidates)]
+        mean, std = gaussianProcess(normalize(space, [config for config, _ in evaluated]), values,
+                                    normalize(space, proposals))
+        improvement = expectedImprovement(mean, std, values.max())
+        chosen = [proposals[i] for i in np.argsort(-improvement)[:min(batch, configs - len(evaluated))]]
+        evaluated.extend(zip(chosen, evaluator.evaluate(chosen, negotiations)))
+        print("%d configurations evaluated, best %s %.4f" % (len(evaluated), objective, scores.max()))
+    return evaluated
+
+
+SEARCHES = {"random": randomSearch, "halving": successiveHalving, "bayesian": bayesianSearch}
+
+
+def formatMetrics(metrics):
+    rounds = metrics["rounds_to_close"]
+    return "%10.2f %8.1f%% %8s %6d" % (metrics["profit"], 100 * metrics["success_rate"],
+                                        "-" if rounds is None else "%.2f" % rounds, metrics["errors"])
+
+
+def report(evaluated, baseline, space, objective, top=10):
+    '''
+    Prints the best configurations next to the default one
+    Returns:
+        the best AgentConfig
+    '''
+
+    ranked = sorted(evaluated, key=lambda item: score(item[1], objective), reverse=True)
+    names = [name for name, _, _ in space]
+    print("%-8s %10s %9s %8s %6s  %s" % ("rank", "profit", "success", "rounds", "errors", " ".join(names)))
+    print("%-8s %s  %s" % ("default", formatMetrics(baseline[1]),
+                           " ".join("%g" % getattr(baseline[0], name) for name in names)))
+    for rank, (config, metrics) in enumerate(ranked[:top], 1):
+        print("%-8d %s  %s" % (rank, formatMetrics(metrics), " ".join("%g" % getattr(config, name) for name in names)))
+    return ranked[0][0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--search", choices=sorted(SEARCHES), default="halving")
+    parser.add_argument("--configs", type=int, default=27, help="configurations evaluated")
+    parser.add_argument("--negotiations", type=int, default=1000, help="negotiations every configuration is scored on")
+    parser.add_argument("--objective", choices=OBJECTIVES, default="profit")
+    parser.add_argument("--space", type=parseSpace, default=SPACE,
+                        help="name=low:high ranges searched, name=value fixes a parameter; all by default")
+    parser.add_argument("--eta", type=int, default=3, help="reduction factor of successive halving")
+    parser.add_argument("--strategy", choices=sorted(simulate.STRATEGIES) + ["mixed"], default="mixed")
+    parser.add_argument("--max-iterations", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0, help="seed of the simulated buyers and of the search")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--cache", default="optimize_cache.jsonl", help="evaluations read and appended, '' for none")
+    parser.add_argument("--output", default="best_config.json", help="where the best AgentConfig is saved")
+    parser.add_argument("--top", type=int, default=10, help="configurations reported")
+    args = parser.parse_args()
+
+    no_of_products = len(bg.getData()[0])
+    rnd = random.Random(args.seed)
+    start = time.time()
+    pool = multiprocessing.Pool(args.processes, initializer=simulate.loadCatalog)
+    try:
+        evaluator = Evaluator(pool, no_of_products, args.strategy, args.max_iterations, args.seed,
+                              EvaluationCache(args.cache or None))
+        search = SEARCHES[args.search]
+        if args.search == "halving":
+            evaluated = search(evaluator, args.space, args.configs, args.negotiations, args.objective, rnd,
+                               eta=args.eta)
+        elif args.search == "bayesian":
+            evaluated = search(evaluator, args.space, args.configs, args.negotiations, args.objective, rnd,
+                               batch=args.processes)
+        else:
+            evaluated = search(evaluator, args.space, args.configs, args.negotiations, args.objective, rnd)
+        default = bg.AgentConfig()
+        baseline = (default, evaluator.evaluate([default], args.negotiations)[0])
+    finally:
+        pool.close()
+        pool.join()
+
+    best = report(evaluated, baseline, args.space, args.objective, args.top)
+    best.save(args.output)
+    print("%d negotiations played, %d evaluations cached, in %.2f s on %d processes; best configuration saved to %s" % (
+        evaluator.played, evaluator.hits, time.time() - start, args.processes, args.output))
@@ -0,0 +1,126 @@
+'''
+HTML pages of the negotiation, rendered from fragments cached per product and bundle
+Product prices, the items of a bundle and the possible items of a product only depend on the catalog, they are
+rendered once and kept in an LRU cache; a request only renders the offer, its costs and the offer history around
+them. The index page only depends on the catalog too, it is rendered once and served with an ETag. Both are rendered
+again after the prices or the recommender changed; a negotiation keeps the prices it started with, its fragments are
+rendered and cached at the version of those prices
+'''
+
+import hashlib
+
+from flask import render_template
+
+import bargain as bg
+import priors
+import sessions
+from sessions import product_list
+
+fragments = priors.LRUCache(10000)
+index_page = None
+
+
+def clear():
+    '''
+    Drops the cached fragments and index page, after the catalog changed
+    '''
+
+    global index_page
+    fragments.clear()
+    index_page = None
+
+
+def cached(key, function):
+    value = fragments.get(key)
+    if value is None:
+        value = function()
+        fragments.put(key, value)
+    return value
+
+
+def fragment(template, key, price_version, **context):
+    '''
+    Parameters:
+        template        - template of the fragment
+        key             - key identifying the fragment among the ones rendered from template
+        price_version   - version of the prices of the negotiation, Agent.price_version
+        context         - variables of the template besides product_list and selling_price, evaluated on a miss
+                          only when given as functions
+    Returns:
+        the rendered fragment
+    '''
+
+    prices = sessions.negotiationPrices(price_version)
+
+    def render():
+        values = dict((name, value() if callable(value) else value) for name, value in context.items())
+        return render_template(template, product_list=product_list, selling_price=prices.priceDicts()[0], **values)
+    return cached((template, prices.version, key), render)
+
+
+def bundleItems(bundle, price_version):
+    bundle = tuple(int(i) for i in bundle)
+    return fragment('_bundle_items.html', bundle, price_version, bundle=bundle)
+
+
+def indexPage():
+    '''
+    Returns:
+        html    - the index page
+        etag    - the entity tag of the page, changes with the catalog only
+    '''
+
+    global index_page
+    # drops the page when the prices changed
+    selling_price = sessions.currentPrices().priceDicts()[0]
+    if index_page is None:
+        html = render_template('index.html', product_list=product_list, selling_price=selling_price)
+        index_page = (html, hashlib.sha1(html.encode('utf-8')).hexdigest())
+    return index_page
+
+
+def negotiatePage(offer, amount_saved, offer_history, price_version):
+    '''
+    Parameters:
+        offer           - the offer of the agent
+        amount_saved    - amount the buyer saves with the offer
+        offer_history   - offers of the agent and counter-offers of the buyer so far
+        price_version   - version of the prices of the negotiation, Agent.price_version
+    Returns:
+        the negotiate page of the offer
+    '''
+
+    bundle = tuple(int(i) for i in offer['Bundle'])
+    product_idx = bundle[-1]
+    recommender = sessions.recommender
+    return render_template(
+        'negotiate.html', offer=offer, amount_saved=amount_saved, product_name=product_list[product_idx],
+        product_names=cached(('product_names', bundle), lambda: ','.join(product_list[i] for i in bundle)),
+        offer_items=cached(('offer_items', bundle), lambda: ''.join(product_list[i] + ', ' for i in bundle[:-1])),
+        product_fragment=fragment('_product.html', bundle, price_version, bundle=bundle),
+        possible_items_fragment=fragment('_possible_items.html', (product_idx, bg.bundleKey(bundle)), price_version,
+                                         bundle=bundle,
+                                         possible_items=lambda: recommender.getListOfPossibleItems(product_idx)),
+        history=[(o['Cost'], bundleItems(o['Bundle'], price_version)) for o in offer_history])
+
+
+def acceptPage(product_idx, bundle_idx, amount_saved, cost, price_version, offer_history=None):
+    '''
+    Parameters:
+        product_idx     - index of the product the buyer wished to buy
+        bundle_idx      - indices of the items bought with it
+        amount_saved    - amount the buyer saves
+        cost            - amount the buyer pays
+        price_version   - version of the prices of the negotiation, Agent.price_version
+        offer_history   - offers made during the negotiation
+    Returns:
+        the accept page
+    '''
+
+    return render_template('accept.html', items_fragment=bundleItems([product_idx] + list(bundle_idx), price_version),
+                           amount_saved=amount_saved, cost=cost, offer_history=offer_history)
+
+
+# the possible items of products change with the recommender, the prices of the fragments with the prices
+sessions.swap_callbacks.append(lambda recommender: clear())
+sessions.price_callbacks.append(lambda prices: clear())
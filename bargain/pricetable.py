@@ -0,0 +1,350 @@
+'''
+Selling and cost prices in a memory-mapped file shared by all the workers of a machine, updated while they run
+The file holds a header and a few buffers of both price arrays, two by default (double buffering). A new version
+of the prices is written to the buffer of the oldest version and published by storing its number in the header,
+a single aligned 8 byte word, so readers see the previous prices or the new ones and never a mix. The prices are
+read in place, without a copy. A buffer is only reused grace seconds after its version was replaced, long enough
+for the rounds that read it to finish.
+Every version is also archived next to the file, so a negotiation keeps the prices it started with however many
+updates come after (the web app saves the version with the negotiation). The buffers hold floats, a version whose
+prices are all whole numbers, of a catalog priced in integers, is read back as integers
+    python pricetable.py create /dev/shm/bargain-prices --catalog ./data.pkl
+    python pricetable.py update /dev/shm/bargain-prices prices.csv
+update reads lines of product name or id, selling price and cost price, from a file or from - (standard input,
+e.g. a socket feed piped in) where every blank line publishes the updates read so far; products not listed keep
+their prices
+'''
+
+from __future__ import division, print_function
+
+import argparse
+import fcntl
+import os
+import sys
+import time
+
+import numpy as np
+
+import bargain as bg
+
+MAGIC = 0x42415247414e5054
+TABLE_VERSION = 2
+# the header words
+HEADER = 8
+MAGIC_WORD, FORMAT_WORD, PRODUCTS_WORD, SLOTS_WORD, VERSION_WORD, INTEGER_WORD = range(6)
+# the stamp words of every buffer, version 1 tables only have the first two and hold floats
+STAMP_VERSION, STAMP_REPLACED, STAMP_INTEGRAL = range(3)
+
+
+def stampWords(table_version):
+    return 2 if table_version == 1 else 3
+
+
+class Prices:
+    def __init__(self, version, selling_prices, cost_prices, product_list, price_dicts=None, integral=False):
+        '''
+        Parameters:
+            version         - version of the prices, 0 for the prices of the catalog
+            selling_prices  - array with the selling price of every product, indexed by product id
+            cost_prices     - array with the cost price of every product, indexed by product id
+            product_list    - list of the entire product base
+            price_dicts     - selling and cost price dictionaries of the arrays, built when first needed otherwise
+            integral        - the prices are integers held as floats, the dictionaries hold them as integers
+        '''
+
+        self.version = version
+        self.selling_prices = selling_prices
+        self.cost_prices = cost_prices
+        self.product_list = product_list
+        self.price_dicts = price_dicts
+        self.integral = integral
+
+    def priceDicts(self):
+        '''
+        Returns:
+            selling_price   - dictionary with the selling price of every product name
+            cost_price      - dictionary with the cost price of every product name
+        '''
+
+        if self.price_dicts is None:
+            selling_prices, cost_prices = self.selling_prices, self.cost_prices
+            if self.integral:
+                # the pages show the prices as the catalog does, Rs.10000 and not Rs.10000.0
+                selling_prices, cost_prices = selling_prices.astype(np.int64), cost_prices.astype(np.int64)
+            self.price_dicts = (dict(zip(self.product_list, selling_prices.tolist())),
+                                dict(zip(self.product_list, cost_prices.tolist())))
+        return self.price_dicts
+
+
+def isIntegral(prices, integer=True):
+    '''
+    Parameters:
+        prices  - array of the selling and cost prices of a version
+        integer - the prices of the catalog are integers
+    Returns:
+        1 when the prices are all whole numbers of a catalog priced in integers, 0 otherwise
+    '''
+
+    return int(bool(integer) and bool(np.all(np.floor(prices) == prices)))
+
+
+def layout(no_of_products, slots, table_version=TABLE_VERSION):
+    # offsets of the slot stamps and of the price buffers, every part 64 byte aligned
+    stamps_offset = HEADER * 8
+    prices_offset = stamps_offset + ((slots * stampWords(table_version) * 8 + 63) // 64) * 64
+    return stamps_offset, prices_offset, prices_offset + slots * 2 * no_of_products * 8
+
+
+def archivePath(path, version):
+    return "%s.v%d.npy" % (path, version)
+
+
+class PriceTable:
+    def __init__(self, path, product_list, grace=5.0, keep=64):
+        '''
+        Opens a table written by create
+        Parameters:
+            path            - path of the table file
+            product_list    - list of the entire product base, in the order of the prices
+            grace           - seconds a replaced buffer is left untouched
+            keep            - number of archived versions kept
+        '''
+
+        self.path = path
+        self.product_list = product_list
+        self.grace = grace
+        self.keep = keep
+        header = np.memmap(path, dtype=np.int64, mode="r+", shape=(HEADER,))
+        if header[MAGIC_WORD] != MAGIC or header[FORMAT_WORD] not in (1, TABLE_VERSION):
+            raise ValueError("%s is not a price table of version %d" % (path, TABLE_VERSION))
+        self.table_version = int(header[FORMAT_WORD])
+        # the prices of the catalog are integers, always false in a version 1 table
+        self.integer = self.table_version != 1 and bool(header[INTEGER_WORD])
+        self.no_of_products = int(header[PRODUCTS_WORD])
+        if self.no_of_products != len(product_list):
+            raise ValueError("%s holds the prices of %d products, the catalog has %d" % (
+                path, self.no_of_products, len(product_list)))
+        self.slots = int(header[SLOTS_WORD])
+        stamps_offset, prices_offset, _ = layout(self.no_of_products, self.slots, self.table_version)
+        self.header = header
+        # the version every buffer holds, when it was replaced, in nanoseconds, and whether its prices are integers
+        self.stamps = np.memmap(path, dtype=np.int64, mode="r+", offset=stamps_offset,
+                                shape=(self.slots, stampWords(self.table_version)))
+        self.buffers = np.memmap(path, dtype=np.float64, mode="r+", offset=prices_offset,
+                                 shape=(self.slots, 2, self.no_of_products))
+        self.archived = {}
+
+    @property
+    def version(self):
+        return int(self.header[VERSION_WORD])
+
+    def current(self):
+        '''
+        Returns:
+            the Prices of the current version, read in place
+        '''
+
+        while True:
+            version = self.version
+            slot = version % self.slots
+            buffers = self.buffers[slot]
+            integral = self.table_version != 1 and bool(self.stamps[slot, STAMP_INTEGRAL])
+            # a writer can only have reused the buffer if the version was replaced grace seconds ago
+            if self.stamps[slot, STAMP_VERSION] == version:
+                return Prices(version, buffers[0], buffers[1], self.product_list, integral=integral)
+
+    def get(self, version):
+        '''
+        Parameters:
+            version - a version of the prices
+        Returns:
+            the Prices of the version, its archive memory-mapped when it is no longer the current one
+        Raises:
+            KeyError when the version was never published or its archive was removed
+        '''
+
+        prices = self.current()
+        if version == prices.version:
+            return prices
+        prices = self.archived.get(version)
+        if prices is None:
+            try:
+                archive = np.load(archivePath(self.path, version), mmap_mode="r")
+            except (IOError, OSError):
+                raise KeyError(version)
+            # archived as integers when they are
+            prices = Prices(version, archive[0], archive[1], self.product_list, integral=archive.dtype.kind == "i")
+            if len(self.archived) >= 16:
+                self.archived.clear()
+            self.archived[version] = prices
+        return prices
+
+    def publish(self, selling_prices, cost_prices):
+        '''
+        Writes a new version of the prices and makes it the current one, waiting for the grace period of the
+        buffer it reuses. Writers of the same table take turns
+        Parameters:
+            selling_prices  - array with the selling price of every product
+            cost_prices     - array with the cost price of every product
+        Returns:
+            the version published
+        '''
+
+        prices = np.array([selling_prices, cost_prices], dtype=np.float64)
+        if prices.shape != (2, self.no_of_products):
+            raise ValueError("expected the prices of %d products" % self.no_of_products)
+        integral = self.table_version != 1 and isIntegral(prices, self.integer)
+        with open(self.path, "rb+") as table_file:
+            fcntl.flock(table_file, fcntl.LOCK_EX)
+            try:
+                current = self.version
+                version = current + 1
+                slot = version % self.slots
+                # written first, a version is never current without its archive
+                temporary = archivePath(self.path, version) + ".tmp"
+                with open(temporary, "wb") as archive_file:
+                    np.save(archive_file, prices.astype(np.int64) if integral else prices)
+                os.rename(temporary, archivePath(self.path, version))
+                replaced = self.stamps[slot, STAMP_REPLACED]
+                if replaced:
+                    wait = replaced / 1e9 + self.grace - time.time()
+                    if wait > 0:
+                        time.sleep(wait)
+                self.stamps[slot, STAMP_VERSION] = -1
+                self.buffers[slot] = prices
+                self.stamps[slot] = [version, 0, integral][:self.stamps.shape[1]]
+                self.stamps[current % self.slots, STAMP_REPLACED] = int(time.time() * 1e9)
+                # the stores of a process are seen in order on x86, readers that see the version see its prices
+                self.header[VERSION_WORD] = version
+                self.header.flush()
+                stale = archivePath(self.path, version - self.keep)
+                if os.path.exists(stale):
+                    os.remove(stale)
+            finally:
+                fcntl.flock(table_file, fcntl.LOCK_UN)
+        return version
+
+    def update(self, changes):
+        '''
+        Parameters:
+            changes - dictionary of product id to (selling price, cost price)
+        Returns:
+            the version published
+        '''
+
+        prices = self.current()
+        selling_prices = np.array(prices.selling_prices)
+        cost_prices = np.array(prices.cost_prices)
+        for product_idx, (selling, cost) in changes.items():
+            selling_prices[product_idx] = selling
+            cost_prices[product_idx] = cost
+        return self.publish(selling_prices, cost_prices)
+
+
+def create(path, product_list, selling_prices, cost_prices, slots=2):
+    '''
+    Writes a table holding the given prices as version 1
+    Parameters:
+        path            - path of the table file
+        product_list    - list of the entire product base
+        selling_prices  - array with the selling price of every product, integers when the catalog's are
+        cost_prices     - array with the cost price of every product
+        slots           - number of price buffers
+    Returns:
+        the PriceTable
+    '''
+
+    no_of_products = len(product_list)
+    stamps_offset, prices_offset, size = layout(no_of_products, slots)
+    integer = all(np.asarray(array).dtype.kind in "iu" for array in [selling_prices, cost_prices])
+    prices = np.array([selling_prices, cost_prices], dtype=np.float64)
+    integral = isIntegral(prices, integer)
+    np.save(archivePath(path, 1), prices.astype(np.int64) if integral else prices)
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as table_file:
+        table_file.truncate(size)
+    header = np.memmap(temporary, dtype=np.int64, mode="r+", shape=(HEADER,))
+    stamps = np.memmap(temporary, dtype=np.int64, mode="r+", offset=stamps_offset,
+                       shape=(slots, stampWords(TABLE_VERSION)))
+    buffers = np.memmap(temporary, dtype=np.float64, mode="r+", offset=prices_offset,
+                        shape=(slots, 2, no_of_products))
+    buffers[1 % slots] = prices
+    stamps[1 % slots] = [1, 0, integral]
+    header[:INTEGER_WORD + 1] = [MAGIC, TABLE_VERSION, no_of_products, slots, 1, integer]
+    for array in [header, stamps, buffers]:
+        array.flush()
+    del header, stamps, buffers
+    # readers only ever open a complete table
+    os.rename(temporary, path)
+    return PriceTable(path, product_list)
+
+
+def openTable(product_list, path=None):
+    '''
+    Returns:
+        the PriceTable of BARGAIN_PRICE_TABLE, None when prices are those of the catalog
+    '''
+
+    if path is None:
+        path = os.environ.get("BARGAIN_PRICE_TABLE")
+    if not path:
+        return None
+    return PriceTable(path, product_list, grace=float(os.environ.get("BARGAIN_PRICE_GRACE", 5.0)))
+
+
+def readUpdates(lines, product_index):
+    '''
+    Parameters:
+        lines           - lines of product name or id, selling price and cost price, comma separated
+        product_index   - catalog.ProductIndex of the catalog
+    Returns:
+        dictionary of product id to (selling price, cost price), unknown products are skipped
+    '''
+
+    changes = {}
+    for line in lines:
+        fields = [field.strip() for field in line.split(",")]
+        if len(fields) != 3:
+            continue
+        product, selling, cost = fields
+        if product.isdigit() and int(product) < len(product_index):
+            product_idx = int(product)
+        else:
+            ids = product_index.encode([product])
+            if not ids:
+                continue
+            product_idx = ids[0]
+        changes[product_idx] = (float(selling), float(cost))
+    return changes
+
+
+if __name__ == "__main__":
+    import catalog
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["create", "update"])
+    parser.add_argument("table", help="path of the price table, e.g. in /dev/shm")
+    parser.add_argument("updates", nargs="?", default="-", help="price updates to publish, - for standard input")
+    parser.add_argument("--catalog", default=os.environ.get("BARGAIN_CATALOG", "./data.pkl"))
+    parser.add_argument("--slots", type=int, default=2, help="price buffers of the table")
+    args = parser.parse_args()
+
+    product_list, selling_price, cost_price, cooccurance_matrix = bg.getData(args.catalog)
+    if args.command == "create":
+        create(args.table, product_list, *bg.priceArrays(product_list, selling_price, cost_price), slots=args.slots)
+        print("Created %s with the prices of %d products" % (args.table, len(product_list)))
+        sys.exit(0)
+
+    table = PriceTable(args.table, product_list)
+    product_index = catalog.ProductIndex(product_list)
+    updates = sys.stdin if args.updates == "-" else open(args.updates)
+    lines = []
+    for line in updates:
+        if line.strip():
+            lines.append(line)
+            continue
+        if lines:
+            print("Published version %d" % table.update(readUpdates(lines, product_index)))
+            lines = []
+    if lines:
+        print("Published version %d" % table.update(readUpdates(lines, product_index)))
@@ -0,0 +1,320 @@
+'''
+Prior utilities of bundles, read from a confidence matrix computed once per catalog
+and memoized per bundle for all the agents of the process, and the lift matrix of the buyer model
+'''
+
+from __future__ import division
+
+import itertools
+import threading
+import weakref
+
+import numpy as np
+
+
+def confidenceMatrix(cooccurance_matrix):
+    '''
+    Parameters:
+        cooccurance_matrix  - dense array or scipy sparse cooccurance matrix
+    Returns:
+        the matrix with every row divided by its diagonal entry, the confidence of product -> item
+    '''
+
+    # a product that never sold keeps the inf and nan the division gives
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if hasattr(cooccurance_matrix, "tocsr"):
+            confidence = cooccurance_matrix.tocsr().astype(np.float64)
+            diagonal = np.asarray(cooccurance_matrix.diagonal(), dtype=np.float64)
+            confidence.data /= np.repeat(diagonal, np.diff(confidence.indptr))
+            return confidence
+        matrix = np.asarray(cooccurance_matrix)
+        return matrix / np.diag(matrix)[:, np.newaxis].astype(np.float64)
+
+
+def confidenceRows(cooccurance_matrix, rows):
+    '''
+    Parameters:
+        cooccurance_matrix  - dense array or scipy sparse cooccurance matrix
+        rows                - sorted array of the indices of products
+    Returns:
+        the rows of confidenceMatrix of the products, equal to the whole matrix's, as a dense array or csr matrix
+    '''
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if hasattr(cooccurance_matrix, "tocsr"):
+            matrix = cooccurance_matrix.tocsr()
+            confidence = matrix[rows].astype(np.float64)
+            diagonal = np.asarray(matrix.diagonal(), dtype=np.float64)[rows]
+            confidence.data /= np.repeat(diagonal, np.diff(confidence.indptr))
+            return confidence
+        matrix = np.asarray(cooccurance_matrix)
+        return matrix[rows] / matrix[rows, rows][:, np.newaxis].astype(np.float64)
+
+
+class RowOverlay:
+    def __init__(self, base, rows, values):
+        '''
+        Matrix whose rows of some products replace those of a base matrix, so that a snapshot of the learned counts
+        only holds the rows that changed since its base
+        Parameters:
+            base    - dense array or scipy CSR matrix
+            rows    - sorted array of the indices of the replaced rows
+            values  - dense array or CSR matrix of the replaced rows, one per index of rows
+        '''
+
+        self.base = base
+        self.rows = rows
+        self.values = values
+        self.positions = dict((idx, position) for position, idx in enumerate(rows.tolist()))
+        self.shape = base.shape
+        self.sparse = hasattr(base, "tocsr")
+
+    def __getitem__(self, key):
+        # a row, or an entry by (row, column), as the base matrix indexes them
+        idx = key[0] if isinstance(key, tuple) else key
+        position = self.positions.get(int(idx))
+        if position is None:
+            return self.base[key]
+        if isinstance(key, tuple):
+            return self.values[(position,) + key[1:]]
+        return self.values[position]
+
+    def materialize(self):
+        '''
+        Returns:
+            the whole matrix as a dense array or csr matrix, a copy of the base
+        '''
+
+        if not self.sparse:
+            matrix = np.array(self.base)
+            matrix[self.rows] = self.values
+            return matrix
+        from scipy.sparse import coo_matrix, diags
+        kept = np.ones(self.shape[0])
+        kept[self.rows] = 0
+        values = self.values.tocoo()
+        replaced = coo_matrix((values.data, (self.rows[values.row], values.col)), shape=self.shape)
+        return (diags(kept) * self.base.tocsr() + replaced).tocsr()
+
+
+def wholeMatrix(matrix):
+    '''
+    Returns:
+        the matrix, materialized when it is a RowOverlay
+    '''
+
+    if isinstance(matrix, RowOverlay):
+        return matrix.materialize()
+    return matrix
+
+
+def estimateInvoices(cooccurance_matrix):
+    '''
+    Parameters:
+        cooccurance_matrix  - dense array or scipy sparse cooccurance matrix
+    Returns:
+        the number of invoices the matrix was counted from, assuming baskets of equal size: an item sold in
+        baskets of b items adds 1 to the diagonal and b - 1 off it
+    '''
+
+    if hasattr(cooccurance_matrix, "tocsr"):
+        total = float(cooccurance_matrix.sum())
+        sold = float(cooccurance_matrix.diagonal().sum())
+    else:
+        matrix = np.asarray(cooccurance_matrix)
+        total = float(matrix.sum())
+        sold = float(np.trace(matrix))
+    if sold <= 0:
+        return 1.0
+    basket_size = total / sold
+    return max(sold / basket_size, 1.0)
+
+
+def liftMatrix(cooccurance_matrix, no_of_invoices=None):
+    '''
+    Parameters:
+        cooccurance_matrix  - dense array or scipy sparse cooccurance matrix
+        no_of_invoices      - number of invoices the matrix was counted from, estimated when not given
+    Returns:
+        the lift of product -> item, P(product and item) / (P(product) P(item)), as a dense array or csr matrix
+    '''
+
+    if no_of_invoices is None:
+        no_of_invoices = estimateInvoices(cooccurance_matrix)
+    # as neighbours.py does, products that never sold count as sold once
+    if hasattr(cooccurance_matrix, "tocsr"):
+        lift = cooccurance_matrix.tocsr().astype(np.float64)
+        diagonal = np.maximum(np.asarray(cooccurance_matrix.diagonal(), dtype=np.float64), 1)
+        lift.data *= no_of_invoices / (np.repeat(diagonal, np.diff(lift.indptr)) * diagonal[lift.indices])
+        return lift
+    matrix = np.asarray(cooccurance_matrix, dtype=np.float64)
+    diagonal = np.maximum(np.diag(matrix), 1)
+    return matrix * no_of_invoices / diagonal[:, np.newaxis] / diagonal[np.newaxis, :]
+
+
+# serial numbers of the pairs of price arrays the agents of the process price with, keyed by the ids of the arrays
+price_sets = {}
+price_sets_lock = threading.Lock()
+price_set_serials = itertools.count(1)
+
+
+def priceKey(selling_prices, cost_prices):
+    '''
+    Parameters:
+        selling_prices  - selling prices as an array indexed by product id
+        cost_prices     - cost prices as an array indexed by product id
+    Returns:
+        serial number of the pair of arrays, keying the costs memoized for the agents pricing with them: unlike the
+        ids of the arrays, which are reused once they are freed, a serial is never given to other arrays
+    '''
+
+    key = (id(selling_prices), id(cost_prices))
+    entry = price_sets.get(key)
+    if entry is not None and entry[0]() is selling_prices and entry[1]() is cost_prices:
+        return entry[2]
+    with price_sets_lock:
+        # forget the arrays that were freed
+        for stale in [stale for stale, entry in price_sets.items() if entry[0]() is None or entry[1]() is None]:
+            del price_sets[stale]
+        serial = next(price_set_serials)
+        price_sets[key] = (weakref.ref(selling_prices), weakref.ref(cost_prices), serial)
+    return serial
+
+
+class LRUCache:
+    def __init__(self, capacity=100000):
+        '''
+        Dictionary with least recently used eviction that counts its hits and misses
+        A hit only stamps the entry with a tick, the least recently stamped quarter is evicted
+        at once when the cache is full, which keeps lookups as cheap as a dictionary's
+        Parameters:
+            capacity    - maximum number of entries kept, 0 disables the cache
+        '''
+
+        self.capacity = capacity
+        self.entries = {}
+        self.tick = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.tick += 1
+        entry[1] = self.tick
+        return entry[0]
+
+    def put(self, key, value):
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            self.tick += 1
+            self.entries[key] = [value, self.tick]
+            if len(self.entries) > self.capacity:
+                stale = sorted(self.entries.items(), key=lambda item: item[1][1])
+                for stale_key, _ in stale[:max(1, len(stale) // 4)]:
+                    del self.entries[stale_key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def hitRate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class PriorTable:
+    def __init__(self, cooccurance_matrix, capacity=100000, no_of_invoices=None, confidence=None):
+        '''
+        Parameters:
+            cooccurance_matrix  - the cooccurance matrix of the recommendation system, or a RowOverlay of it
+            capacity            - number of bundles memoized by each cache
+            no_of_invoices      - number of invoices of the lift matrix, estimated when not given
+            confidence          - confidenceMatrix of cooccurance_matrix, or a RowOverlay of it, e.g. memory-mapped
+                                  from a snapshot, computed when not given
+        '''
+
+        self.cooccurance_matrix = cooccurance_matrix
+        self.no_of_invoices = no_of_invoices
+        # computed the first time the buyer model needs it
+        self.lift = None
+        self.lift_lock = threading.Lock()
+        if confidence is None:
+            confidence = confidenceMatrix(wholeMatrix(cooccurance_matrix))
+        self.confidence = confidence
+        self.sparse = hasattr(confidence, "tocsr") or isinstance(confidence, RowOverlay) and confidence.sparse
+        self.priors = LRUCache(capacity)
+        # costs of the initial offers of the agents pricing this catalog, keyed by bundle, discount rate and the
+        # priceKey of the prices of the agent
+        self.initial_offers = LRUCache(capacity)
+
+    def priorUtility(self, bundle):
+        '''
+        Parameters:
+            bundle  - list or array of indices of items in the bundle, the product the buyer wishes to buy last
+        Returns:
+            the mean confidence of product -> item over the other items of the bundle, 0 for a single product
+        '''
+
+        key = tuple(bundle.tolist() if isinstance(bundle, np.ndarray) else bundle)
+        prior_utility = self.priors.get(key)
+        if prior_utility is None:
+            product_idx, items = key[-1], key[:-1]
+            if not self.sparse:
+                row = self.confidence[product_idx]
+            elif self.confidence[product_idx, product_idx] == 0:
+                # the implicit zeros of a product that never sold are nan in the dense matrix
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    row = self.confidence[product_idx].toarray()[0] / 0.0
+            else:
+                row = self.confidence[product_idx].toarray()[0]
+            # summed in bundle order as the agent always did
+            prior_utility = 0
+            for i in items:
+                prior_utility += row.item(i)
+            if len(items) > 0:
+                prior_utility /= len(items)
+            self.priors.put(key, prior_utility)
+        return prior_utility
+
+    def liftValues(self, product_idx, item_idx):
+        '''
+        Parameters:
+            product_idx - array of indices of products
+            item_idx    - array of indices of items, as long as product_idx
+        Returns:
+            array of the lift of every product -> item
+        '''
+
+        if self.lift is None:
+            with self.lift_lock:
+                if self.lift is None:
+                    lift = liftMatrix(wholeMatrix(self.cooccurance_matrix), self.no_of_invoices)
+                    if self.sparse:
+                        # the entries keyed by row * columns + column, sorted, so that any pairs are found at once
+                        lift.sum_duplicates()
+                        lift.sort_indices()
+                        self.lift_keys = np.repeat(np.arange(lift.shape[0], dtype=np.int64),
+                                                   np.diff(lift.indptr)) * lift.shape[1] + lift.indices
+                    self.lift = lift
+        if not self.sparse:
+            return self.lift[product_idx, item_idx]
+        keys = np.asarray(product_idx, dtype=np.int64) * self.lift.shape[1] + np.asarray(item_idx, dtype=np.int64)
+        position = np.minimum(np.searchsorted(self.lift_keys, keys), max(len(self.lift_keys) - 1, 0))
+        if not len(self.lift_keys):
+            return np.zeros(len(keys))
+        return np.where(self.lift_keys[position] == keys, self.lift.data[position], 0.0)
+
+    def stats(self):
+        return {"prior_hits": self.priors.hits, "prior_misses": self.priors.misses,
+                "prior_hit_rate": self.priors.hitRate(), "initial_offer_hits": self.initial_offers.hits,
+                "initial_offer_misses": self.initial_offers.misses,
+                "initial_offer_hit_rate": self.initial_offers.hitRate()}
@@ -0,0 +1,136 @@
+'''
+Replays a round log written with BARGAIN_ROUND_LOG through bargain.getOffer, without a server or a browser
+Every session is replayed as the web app plays it, the state of the agent and the buyer going through the
+negotiation store's serialization between rounds, and every offer is compared with the logged one bit for bit.
+A round without a previous offer starts a new negotiation of the session, with the agent parameters and prices
+logged with it
+Run from the bargain directory with the catalog the log was recorded on, e.g.
+    python replay.py rounds.jsonl --processes 8
+Exits with status 1 when an offer differs from the log
+'''
+
+from __future__ import division, print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import bargain as bg
+import bundles
+import pricetable
+import roundlog
+import store as st
+
+catalog = None
+
+
+def loadCatalog(path, price_table_path=None):
+    global catalog
+    product_list, selling_price, cost_price, cooccurance_matrix = bg.getData(path)
+    price_table = None if not price_table_path else pricetable.PriceTable(price_table_path, product_list)
+    # the bundle search is configured from the environment, as for the server that recorded the log
+    catalog = (product_list, selling_price, cost_price, bg.priceArrays(product_list, selling_price, cost_price),
+               bg.RecommenderSystem(cooccurance_matrix, bundle_search=bundles.fromEnvironment()), price_table)
+
+
+def offerKey(offer):
+    return json.dumps(offer, sort_keys=True, separators=(',', ':'), default=float)
+
+
+def replaySession(rounds):
+    '''
+    Parameters:
+        rounds      - the logged rounds of one session, in the order they were played
+    Returns:
+        offers      - number of offers replayed
+        mismatches  - list of (round number, logged offer, replayed offer) of the offers that differ
+        seconds     - time getOffer took in the replay
+        logged      - time getOffer took when the log was recorded
+    '''
+
+    product_list, selling_price, cost_price, catalog_prices, recommender, price_table = catalog
+    state = None
+    mismatches = []
+    seconds = 0
+    for number, entry in enumerate(rounds):
+        if entry["prev"] is None or number == 0:
+            # a session plays its negotiations one after the other, each starts afresh as in the app
+            state = None
+            # the AgentConfig parameters of the negotiation, older logs only carry some of them
+            config = bg.AgentConfig(**entry.get("agent", {}))
+            price_version = entry.get("prices", 0)
+            selling_prices, cost_prices = catalog_prices
+            if price_version:
+                if price_table is None:
+                    raise ValueError("a negotiation was played at updated prices, replay it with --price-table")
+                # the archived prices the negotiation was played at
+                prices = price_table.get(price_version)
+                selling_prices, cost_prices = prices.selling_prices, prices.cost_prices
+        agent = bg.Agent(product_list, cost_price, selling_price, selling_prices=selling_prices,
+                         cost_prices=cost_prices, price_version=price_version, config=config)
+        buyer = bg.Buyer(len(product_list))
+        if state is not None:
+            agent.setState(state["agent"])
+            buyer.setState(state["buyer"])
+        start = time.time()
+        offer = bg.getOffer(agent, buyer, recommender, selling_price, product_list, entry["proposed"], entry["prev"])
+        seconds += time.time() - start
+        replayed = offerKey(bg.serializeOffer(offer))
+        if replayed != offerKey(entry["offer"]):
+            mismatches.append((number, entry["offer"], json.loads(replayed)))
+        state = st.loadState(st.dumpState({"agent": agent.getState(), "buyer": buyer.getState()}))
+    return len(rounds), mismatches, seconds, sum(entry["seconds"] for entry in rounds)
+
+
+def replaySessions(sessions):
+    return [(session_id,) + replaySession(rounds) for session_id, rounds in sessions]
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("log", help="round log written with BARGAIN_ROUND_LOG")
+    parser.add_argument("--catalog", default=os.environ.get("BARGAIN_CATALOG", "./data.pkl"),
+                        help="catalog the log was recorded on")
+    parser.add_argument("--price-table", default=os.environ.get("BARGAIN_PRICE_TABLE"),
+                        help="price table of the server, for negotiations played at updated prices")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--repeat", type=int, default=1, help="replay the log this many times, for throughput")
+    parser.add_argument("--show", type=int, default=10, help="number of mismatching offers printed")
+    args = parser.parse_args()
+
+    sessions = sorted(roundlog.readRounds(args.log).items()) * args.repeat
+    offers = 0
+    mismatches = []
+    replay_seconds = logged_seconds = 0
+    start = time.time()
+    pool = multiprocessing.Pool(args.processes, initializer=loadCatalog, initargs=(args.catalog, args.price_table))
+    try:
+        for results in pool.imap_unordered(replaySessions, chunks(sessions, 64)):
+            for session_id, session_offers, session_mismatches, seconds, logged in results:
+                offers += session_offers
+                replay_seconds += seconds
+                logged_seconds += logged
+                mismatches += [(session_id,) + mismatch for mismatch in session_mismatches]
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+
+    print("%d sessions, %d offers replayed in %.2f s on %d processes: %.0f offers/s" % (
+        len(sessions), offers, elapsed, args.processes, offers / elapsed if elapsed else 0))
+    if offers:
+        print("getOffer: %.1f us replayed, %.1f us logged" % (replay_seconds * 1e6 / offers,
+                                                               logged_seconds * 1e6 / offers))
+    for session_id, number, logged, replayed in mismatches[:args.show]:
+        print("mismatch in session %s round %d: logged %s, replayed %s" % (
+            session_id, number, offerKey(logged), offerKey(replayed)))
+    print("%d mismatching offers" % len(mismatches))
+    sys.exit(1 if mismatches else 0)
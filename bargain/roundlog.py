@@ -0,0 +1,117 @@
+'''
+Append-only log of the rounds of every negotiation, replayed offline by replay.py
+With BARGAIN_ROUND_LOG=/path/rounds.jsonl every round is logged as one compact JSON line: the session, the offer
+the buyer proposed, the previous offer of the agent, the offer it made, its utilities and alpha, the version of
+its prices and the time getOffer took. A session plays its negotiations one after the other: the first round of
+each, which has no previous offer, starts it afresh and also carries the parameters of the agent
+Lines are buffered and appended with a single write, so the workers of a gunicorn server can share a log
+'''
+
+from __future__ import division
+
+import atexit
+import json
+import os
+import threading
+import time
+
+import bargain as bg
+
+
+class RoundLog:
+    def __init__(self, path, buffer_size=256, flush_interval=1.0):
+        '''
+        Parameters:
+            path            - path of the log file, appended to
+            buffer_size     - rounds buffered before they are written
+            flush_interval  - seconds after which buffered rounds are written at the next round
+        '''
+
+        self.path = path
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.lines = []
+        self.flushed = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, session_id, agent, proposed_offer, prev_offer, offer, start, seconds, agent_parameters=None):
+        '''
+        Parameters:
+            session_id          - id of the session of the negotiation
+            agent               - the agent, after it made offer
+            proposed_offer      - offer proposed by the buyer
+            prev_offer          - offer getOffer was given as the previous offer of the agent
+            offer               - offer returned by getOffer, before the caller changes it
+            start               - time getOffer was called at
+            seconds             - time getOffer took
+            agent_parameters    - AgentConfig parameters of the agent, logged with the first round
+        '''
+
+        agent_utility, buyer_utility, target_utility = agent.last_round
+        entry = {"session": session_id, "start": start, "seconds": seconds,
+                 "proposed": bg.serializeOffer(proposed_offer), "prev": bg.serializeOffer(prev_offer),
+                 "offer": bg.serializeOffer(offer), "alpha": agent.alpha, "prices": agent.price_version,
+                 "utilities": {"agent": agent_utility, "buyer": buyer_utility, "target": target_utility}}
+        if agent_parameters is not None:
+            entry["agent"] = agent_parameters
+        line = json.dumps(entry, sort_keys=True, separators=(',', ':'), default=float) + "\n"
+        with self.lock:
+            self.lines.append(line)
+            if len(self.lines) >= self.buffer_size or time.time() - self.flushed >= self.flush_interval:
+                self.flushLocked()
+
+    def flushLocked(self):
+        if self.lines:
+            os.write(self.fd, "".join(self.lines).encode("utf-8"))
+            self.lines = []
+        self.flushed = time.time()
+
+    def flush(self):
+        with self.lock:
+            self.flushLocked()
+
+    def close(self):
+        with self.lock:
+            self.flushLocked()
+            os.close(self.fd)
+            self.fd = None
+
+
+def readRounds(path):
+    '''
+    Parameters:
+        path    - path of a round log
+    Returns:
+        dictionary of session id to the list of its rounds, in the order they were played
+    '''
+
+    sessions = {}
+    with open(path) as log_file:
+        for line in log_file:
+            if not line.endswith("\n"):
+                # the last line of a log whose writer was killed mid-write
+                break
+            entry = json.loads(line)
+            sessions.setdefault(entry["session"], []).append(entry)
+    # the workers of a server flush their buffers independently, a session's rounds may be out of order
+    for rounds in sessions.values():
+        rounds.sort(key=lambda entry: entry["start"])
+    return sessions
+
+
+def openLog(path=None):
+    '''
+    Parameters:
+        path    - path of the round log, read from BARGAIN_ROUND_LOG when not given
+    Returns:
+        the RoundLog, flushed at exit, or None when rounds are not logged
+    '''
+
+    if path is None:
+        path = os.environ.get("BARGAIN_ROUND_LOG")
+    if not path:
+        return None
+    log = RoundLog(path)
+    atexit.register(log.flush)
+    return log
@@ -0,0 +1,219 @@
+'''
+Catalog, recommender and negotiation store of the web process, shared by the HTML views and the JSON API
+'''
+
+import os
+import time
+import uuid
+
+import bargain as bg
+import bundles
+import catalog
+import history
+import instrument
+import learning
+import neighbours as nb
+import pricetable
+import roundlog
+import store as st
+
+# the catalog is read once per process; with preload_app gunicorn workers share it copy-on-write,
+# a binary catalog written by catalog.py is memory-mapped instead
+product_list, selling_price, cost_price, cooccurance_matrix = bg.getData(os.environ.get('BARGAIN_CATALOG', './data.pkl'))
+product_index = catalog.ProductIndex(product_list)
+selling_prices, cost_prices = bg.priceArrays(product_list, selling_price, cost_price)
+# prices updated while the app runs are read from the shared table of BARGAIN_PRICE_TABLE, if any
+price_table = pricetable.openTable(product_list)
+catalog_prices = pricetable.Prices(0, selling_prices, cost_prices, product_list, (selling_price, cost_price))
+current_prices = catalog_prices
+# called with the new prices the first time the process reads them, e.g. to drop pages rendered with the old ones
+price_callbacks = []
+# BARGAIN_BUNDLE_ITEMS=3 searches initial bundles of up to 3 add-ons instead of offering the top 2 neighbours
+bundle_search = bundles.fromEnvironment()
+# an index rebuilt offline with neighbours.py is memory-mapped, otherwise it is built here
+if os.environ.get('BARGAIN_NEIGHBOUR_INDEX'):
+    recommender = bg.RecommenderSystem(cooccurance_matrix, nb.NeighbourIndex.load(os.environ['BARGAIN_NEIGHBOUR_INDEX']),
+                                       bundle_search=bundle_search)
+else:
+    recommender = bg.RecommenderSystem(cooccurance_matrix, bundle_search=bundle_search)
+# the gauges of the current recommender, which a snapshot of learning.py may replace
+instrument.registerGauges(lambda: recommender.prior_table.stats())
+if bundle_search is not None:
+    instrument.registerGauges(lambda: recommender.bundle_search.stats())
+# negotiation state of every session, shared by all workers unless BARGAIN_STORE says otherwise
+store = st.createStore()
+# every round appended to BARGAIN_ROUND_LOG when set, for replay.py
+round_log = roundlog.openLog()
+# the bundle of every negotiation that ended appended to BARGAIN_DEAL_LOG when set, for learning.py
+deal_log = learning.openDealLog()
+# called with the new recommender after a swap, e.g. to drop what was rendered from the old one
+swap_callbacks = []
+# the parameters of the agents, those tuned by optimize.py when BARGAIN_AGENT_CONFIG names its output
+if os.environ.get('BARGAIN_AGENT_CONFIG'):
+    agent_config = bg.AgentConfig.load(os.environ['BARGAIN_AGENT_CONFIG'])
+else:
+    agent_config = bg.AgentConfig(max_initial_discount_rate=0.1, min_profit_margin=0.3)
+AGENT_PARAMETERS = agent_config.asDict()
+# offers kept in the history of a negotiation, the latest ones
+HISTORY_CAPACITY = int(os.environ.get('BARGAIN_HISTORY', 32))
+
+
+def newSessionId():
+    return uuid.uuid4().hex
+
+
+def currentPrices():
+    '''
+    Returns:
+        the pricetable.Prices new negotiations start with
+    '''
+
+    global current_prices
+    if price_table is None or price_table.version == current_prices.version:
+        return current_prices
+    current_prices = price_table.current()
+    for callback in price_callbacks:
+        callback(current_prices)
+    return current_prices
+
+
+def negotiationPrices(version):
+    '''
+    Parameters:
+        version - version of the prices a negotiation started with
+    Returns:
+        the pricetable.Prices of the version, the current ones once it is no longer archived
+    '''
+
+    # the buffer of a version that is no longer current is reused by the next update, its archive is read instead
+    prices = currentPrices()
+    if version == prices.version:
+        return prices
+    if price_table is None or version == 0:
+        return catalog_prices
+    try:
+        return price_table.get(version)
+    except KeyError:
+        instrument.count("price_version_misses")
+        return currentPrices()
+
+
+def newNegotiation(prices=None):
+    '''
+    Parameters:
+        prices          - pricetable.Prices the negotiation is played at, the current ones by default
+    Returns:
+        agent, buyer, offer and offer_history of a negotiation that has not begun, as loadNegotiation
+    '''
+
+    if prices is None:
+        prices = currentPrices()
+    negotiation_selling_price, negotiation_cost_price = prices.priceDicts()
+    agent = bg.Agent(product_list, negotiation_cost_price, negotiation_selling_price,
+                     selling_prices=prices.selling_prices, cost_prices=prices.cost_prices,
+                     price_version=prices.version, config=agent_config)
+    buyer = bg.Buyer(len(product_list))
+    return agent, buyer, None, history.OfferHistory(HISTORY_CAPACITY)
+
+
+def loadNegotiation(session_id):
+    '''
+    Restores the negotiation of a session, whichever worker served its previous round
+    Parameters:
+        session_id      - id of the session
+    Returns:
+        agent           - the agent participating in the negotiation
+        buyer           - the buyer participating in the negotiation
+        offer           - the latest offer of the agent, None when the negotiation has not begun
+        offer_history   - history.OfferHistory of the offers made so far
+    '''
+
+    state = store.load(session_id)
+    if state is None:
+        return newNegotiation()
+    # a negotiation keeps the prices it started with, however they change in the meantime
+    agent, buyer, offer, offer_history = newNegotiation(negotiationPrices(state.get('price_version', 0)))
+    agent.setState(state['agent'])
+    buyer.setState(state['buyer'])
+    if isinstance(state['offer_history'], list):
+        # saved as a list of offers before the history was bounded
+        offer_history = history.fromOffers(state['offer_history'], HISTORY_CAPACITY)
+    else:
+        offer_history.setState(state['offer_history'])
+    return agent, buyer, state['offer'], offer_history
+
+
+def saveNegotiation(session_id, agent, buyer, offer, offer_history):
+    store.save(session_id, {'agent': agent.getState(), 'buyer': buyer.getState(), 'offer': bg.serializeOffer(offer),
+                            'offer_history': offer_history.getState(),
+                            'price_version': agent.price_version})
+
+
+def negotiate(session_id, agent, buyer, offer, proposed_offer):
+    '''
+    Plays a round of the negotiation of a session and logs it when rounds are logged
+    Parameters:
+        session_id      - id of the session
+        agent           - the agent participating in the negotiation
+        buyer           - the buyer participating in the negotiation
+        offer           - the latest offer of the agent, None when the negotiation has not begun
+        proposed_offer  - offer proposed by the buyer
+    Returns:
+        new_offer       - the offer of the agent
+    '''
+
+    if snapshot_watcher is not None:
+        # started by the first round of the process rather than at import: a gunicorn master preloading the app
+        # would poll for recommenders it never uses and fork the workers while the thread holds locks
+        snapshot_watcher.start()
+    start = time.time()
+    # read once, a swap during the round does not change the recommender of the round
+    round_recommender = recommender
+    new_offer = bg.negotiation(agent, buyer, cooccurance_matrix, product_list, selling_price, proposed_offer["Bundle"],
+                               offer, proposed_offer, round_recommender)
+    if round_log is not None:
+        round_log.record(session_id, agent, proposed_offer, offer, new_offer, start, time.time() - start,
+                         AGENT_PARAMETERS if offer is None else None)
+    return new_offer
+
+
+def deleteNegotiation(session_id):
+    store.delete(session_id)
+
+
+def finishNegotiation(offer_history, outcome):
+    '''
+    Records a negotiation that ended
+    Parameters:
+        offer_history   - history.OfferHistory of the offers made
+        outcome         - accepted or rejected
+    '''
+
+    instrument.count("negotiations", outcome=outcome)
+    instrument.observe("negotiation_rounds", offer_history.rounds)
+    offer = offer_history.last(history.AGENT)
+    if deal_log is not None and offer is not None:
+        deal_log.record(offer["Bundle"], outcome)
+
+
+def swapRecommender(new_recommender):
+    '''
+    Replaces the recommender of the process, the requests being served keep the one they read
+    Parameters:
+        new_recommender - the RecommenderSystem built on a new snapshot
+    '''
+
+    global recommender
+    recommender = new_recommender
+    for callback in swap_callbacks:
+        callback(new_recommender)
+
+
+# recommenders built on the snapshots learning.py publishes in BARGAIN_SNAPSHOTS, loaded in the background of the
+# workers, see negotiate
+snapshot_watcher = None
+if os.environ.get('BARGAIN_SNAPSHOTS'):
+    snapshot_watcher = learning.SnapshotWatcher(
+        os.environ['BARGAIN_SNAPSHOTS'], swapRecommender, float(os.environ.get('BARGAIN_SNAPSHOT_INTERVAL', 5)),
+        lambda snapshot: learning.loadRecommender(snapshot, bundles.fromEnvironment()))
+    instrument.registerGauges(snapshot_watcher.stats)
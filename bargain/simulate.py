@@ -0,0 +1,338 @@
+'''
+Headless simulator running automated Agent-vs-Buyer negotiations in parallel
+Every negotiation is driven through bargain.getOffer the same way main.py drives it, by a scripted or
+stochastic buyer instead of a person. The per-negotiation results use the columns of
+results_for_plot_no_headers.csv (followed by the agent parameters, the profit, the agent utility of the initial offer
+and the mean target utility of the rounds), the per-round records are streamed to a second file. Files ending in .parquet are written with pyarrow. --config plays agents with the
+concession parameters of an AgentConfig saved by optimize.py
+Run from the bargain directory, e.g.
+    python simulate.py --negotiations 1000 --max-initial-discount-rate 0.1,0.2,0.3 --min-profit-margin 0.1,0.3,0.5
+'''
+
+from __future__ import division, print_function
+
+import argparse
+import csv
+import itertools
+import multiprocessing
+import random
+import sys
+import time
+
+import bargain as bg
+
+RESULT_COLUMNS = ["product", "bundle", "agent_utility", "buyer_utility", "buyer_id", "iterations", "cost",
+                  "amount_saved", "success", "seconds", "strategy", "max_initial_discount_rate", "min_profit_margin",
+                  "num_rounds", "profit", "initial_agent_utility", "target_utility"]
+ROUND_COLUMNS = ["negotiation", "strategy", "max_initial_discount_rate", "min_profit_margin", "num_rounds",
+                 "iteration", "bundle", "proposed_cost", "cost", "agent_utility", "buyer_utility", "alpha",
+                 "accepted", "buyer_model_utility"]
+
+
+class ScriptedBuyer:
+    def __init__(self, seed, concessions=(0.55, 0.65, 0.75, 0.85, 0.95)):
+        '''
+        Buyer keeping the agent's bundle and offering fixed fractions of its selling price
+        Parameters:
+            seed        - unused, scripted buyers behave the same in every negotiation
+            concessions - fractions of the selling price offered in successive rounds
+        '''
+
+        self.concessions = concessions
+
+    def respond(self, iteration, offer, bundle_selling_price):
+        '''
+        Parameters:
+            iteration               - number of counter-offers the buyer has made, including this one
+            offer                   - the latest offer of the agent
+            bundle_selling_price    - function returning the total selling price of a bundle
+        Returns:
+            proposed_offer          - the counter-offer, True to accept the offer or False to walk away
+        '''
+
+        if iteration > len(self.concessions):
+            return False
+        price = int(self.concessions[iteration - 1] * bundle_selling_price(offer["Bundle"]))
+        if offer["Cost"] <= price:
+            return True
+        return {"Bundle": [int(i) for i in offer["Bundle"]], "Cost": price}
+
+
+class StochasticBuyer:
+    def __init__(self, seed):
+        '''
+        Buyer with a random reservation price and concession rate that may drop add-ons from the bundle
+        Parameters:
+            seed    - seed of the buyer's random choices
+        '''
+
+        self.random = random.Random(seed)
+        self.reservation = self.random.uniform(0.7, 1.0)
+        self.opening = self.random.uniform(0.4, 0.7)
+        self.step = self.random.uniform(0.02, 0.1)
+        self.drop_probability = self.random.uniform(0, 0.3)
+        self.bundle = None
+
+    def respond(self, iteration, offer, bundle_selling_price):
+        if self.bundle is None:
+            product_idx = int(offer["Bundle"][-1])
+            add_ons = [int(i) for i in offer["Bundle"][:-1] if self.random.random() >= self.drop_probability]
+            self.bundle = add_ons + [product_idx]
+
+        # the buyer is willing to pay this fraction of the selling price of any bundle
+        fraction = min(self.opening + self.step * (iteration - 1), self.reservation)
+        if offer["Cost"] <= fraction * bundle_selling_price(offer["Bundle"]):
+            return True
+        if fraction >= self.reservation and self.random.random() < 0.5:
+            return False
+        return {"Bundle": list(self.bundle), "Cost": int(fraction * bundle_selling_price(self.bundle))}
+
+
+STRATEGIES = {"scripted": ScriptedBuyer, "stochastic": StochasticBuyer}
+
+catalog = None
+
+
+def loadCatalog():
+    global catalog
+    product_list, selling_price, cost_price, cooccurance_matrix = bg.getData()
+    catalog = (product_list, selling_price, cost_price, bg.priceArrays(product_list, selling_price, cost_price),
+               bg.RecommenderSystem(cooccurance_matrix))
+
+
+def offerUtility(agent, offer):
+    # Agent.utility also updates the agent's minimum utility, which must follow the negotiation only
+    total_selling_price, total_cost_price = agent.bundleTotals(offer["Bundle"])
+    return (offer["Cost"] - total_cost_price) / (total_selling_price - total_cost_price)
+
+
+def runNegotiation(task):
+    '''
+    Plays one negotiation between an agent and a simulated buyer
+    Parameters:
+        task    - (number, product index, strategy, seed, max_initial_discount_rate, min_profit_margin,
+                  num_rounds, max_iterations), optionally followed by a dictionary of AgentConfig parameters the
+                  agent parameters of the task take precedence over
+    Returns:
+        result  - the result row of the negotiation
+        rounds  - the round rows of the negotiation
+    '''
+
+    number, product_idx, strategy, seed, max_initial_discount_rate, min_profit_margin, num_rounds, \
+        max_iterations = task[:8]
+    config = bg.AgentConfig(**(task[8] if len(task) > 8 else {}))
+    config.max_initial_discount_rate = max_initial_discount_rate
+    config.min_profit_margin = min_profit_margin
+    config.num_rounds = num_rounds
+    product_list, selling_price, cost_price, (selling_prices, cost_prices), recommender = catalog
+    start = time.time()
+
+    def bundle_selling_price(bundle):
+        return sum(selling_price[product_list[i]] for i in bundle)
+
+    agent = bg.Agent(product_list, cost_price, selling_price, selling_prices=selling_prices, cost_prices=cost_prices,
+                     config=config)
+    buyer = bg.Buyer(len(product_list))
+    simulated_buyer = STRATEGIES[strategy](seed)
+    parameters = [strategy, max_initial_discount_rate, min_profit_margin, num_rounds]
+
+    offer = bg.getOffer(agent, buyer, recommender, selling_price, product_list, {"Bundle": [product_idx], "Cost": None},
+                        None)
+    offer["Cost"] = round(offer["Cost"])
+    rounds = []
+
+    def record(iteration, proposed_cost, buyer_model_utility=""):
+        rounds.append([number] + parameters + [iteration, " ".join(str(int(i)) for i in offer["Bundle"]),
+                                               proposed_cost, offer["Cost"], offerUtility(agent, offer),
+                                               agent.buyer_utilities.last if agent.buyer_utilities else "",
+                                               agent.alpha, int(bool(offer["Accepted"])), buyer_model_utility])
+
+    record(0, "")
+    initial_agent_utility = offerUtility(agent, offer)
+    # the target utilities of TKI, none in the rounds the agent accepts without conceding
+    target_utilities = []
+    success = False
+    iteration = 0
+    while iteration < max_iterations:
+        if offer["Accepted"]:
+            success = True
+            break
+        iteration += 1
+        response = simulated_buyer.respond(iteration, offer, bundle_selling_price)
+        if response is True:
+            success = True
+            break
+        if response is False:
+            break
+        # the lift and counter based buyer model, next to the agent's opponent model
+        buyer_model_utility = buyer.utility(response, offer, recommender)
+        offer = bg.getOffer(agent, buyer, recommender, selling_price, product_list, response, offer)
+        offer["Cost"] = round(offer["Cost"])
+        if agent.last_round[2] is not None:
+            target_utilities.append(agent.last_round[2])
+        if offer["Cost"] <= response["Cost"]:
+            offer["Accepted"] = True
+        record(iteration, response["Cost"], buyer_model_utility)
+
+    buyer_utility = agent.buyer_utilities.last if agent.buyer_utilities else 0
+    if success:
+        bundle = [int(i) for i in offer["Bundle"]]
+        cost = offer["Cost"]
+        agent_utility = offerUtility(agent, offer)
+        amount_saved = bundle_selling_price(bundle) - cost
+        add_ons = ", ".join(product_list[i] for i in bundle[:-1]) or "NA"
+        profit = cost - agent.bundleTotals(bundle)[1]
+    else:
+        # the buyer walks away with the product alone, at its selling price
+        cost = selling_price[product_list[product_idx]]
+        profit = cost - cost_price[product_list[product_idx]]
+        agent_utility = agent.prev_agent_offers_utilities.last
+        amount_saved = 0
+        add_ons = "NA"
+
+    target_utility = sum(target_utilities) / len(target_utilities) if target_utilities else ""
+    result = [product_list[product_idx], add_ons, agent_utility, buyer_utility, seed, iteration, cost,
+              amount_saved, int(success), time.time() - start] + parameters + [profit, initial_agent_utility,
+                                                                              target_utility]
+    return result, rounds
+
+
+class RecordWriter:
+    def __init__(self, path, columns, header=True, batch_size=10000):
+        '''
+        Streams rows to a CSV file, or to a Parquet file when path ends with .parquet
+        Parameters:
+            path        - path of the output file
+            columns     - names of the columns
+            header      - whether a CSV file starts with the column names
+            batch_size  - rows buffered before a Parquet row group is written
+        '''
+
+        self.path = path
+        self.columns = columns
+        self.batch_size = batch_size
+        self.rows = []
+        self.parquet = path.endswith(".parquet")
+        if self.parquet:
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise ImportError("writing %s requires pyarrow: pip install pyarrow" % path)
+            self.pyarrow = pyarrow
+            self.writer = None
+        else:
+            if sys.version_info[0] == 2:
+                self.file = open(path, "wb")
+            else:
+                self.file = open(path, "w", newline="")
+            self.writer = csv.writer(self.file)
+            if header:
+                self.writer.writerow(columns)
+
+    def write(self, rows):
+        if not self.parquet:
+            self.writer.writerows(rows)
+            return
+        self.rows.extend(rows)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        columns = list(zip(*self.rows))
+        # empty strings mark missing values in the CSV output
+        table = self.pyarrow.Table.from_arrays(
+            [self.pyarrow.array([None if value == "" else value for value in column]) for column in columns],
+            names=self.columns)
+        if self.writer is None:
+            self.writer = self.pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+        self.rows = []
+
+    def close(self):
+        if self.parquet:
+            self.flush()
+            if self.writer is not None:
+                self.writer.close()
+        else:
+            self.file.close()
+
+
+def makeTasks(negotiations, strategy, max_initial_discount_rates, min_profit_margins, num_rounds_list,
+              max_iterations, seed, no_of_products, config=None):
+    '''
+    Parameters:
+        negotiations                - number of negotiations for every combination of agent parameters
+        strategy                    - scripted, stochastic or mixed
+        max_initial_discount_rates  - values of max_initial_discount_rate to sweep
+        min_profit_margins          - values of min_profit_margin to sweep
+        num_rounds_list             - values of num_rounds to sweep
+        max_iterations              - number of counter-offers after which the buyer gives up
+        seed                        - seed of the simulated buyers
+        no_of_products              - number of products in the catalog
+        config                      - dictionary of the other AgentConfig parameters of the agents
+    Returns:
+        generator of negotiation tasks
+    '''
+
+    strategies = sorted(STRATEGIES) if strategy == "mixed" else [strategy]
+    number = 0
+    for parameters in itertools.product(max_initial_discount_rates, min_profit_margins, num_rounds_list):
+        for n in range(negotiations):
+            task = (number, n % no_of_products, strategies[n % len(strategies)], seed + n) + parameters + \
+                   (max_iterations,)
+            yield task if config is None else task + (config,)
+            number += 1
+
+
+def parseValues(text):
+    return [float(value) for value in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--negotiations", type=int, default=1000, help="negotiations per parameter combination")
+    parser.add_argument("--strategy", choices=sorted(STRATEGIES) + ["mixed"], default="mixed")
+    parser.add_argument("--max-initial-discount-rate", type=parseValues, help="0.1 unless --config sets it")
+    parser.add_argument("--min-profit-margin", type=parseValues, help="0.3 unless --config sets it")
+    parser.add_argument("--num-rounds", type=parseValues, help="0.6 unless --config sets it")
+    parser.add_argument("--max-iterations", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--config", help="AgentConfig saved by optimize.py, its agent parameters are the defaults")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--results", default="simulation_results.csv")
+    parser.add_argument("--rounds", default="simulation_rounds.csv")
+    args = parser.parse_args()
+
+    config = None
+    defaults = bg.AgentConfig()
+    if args.config:
+        defaults = bg.AgentConfig.load(args.config)
+        config = defaults.asDict()
+    for name in ["max_initial_discount_rate", "min_profit_margin", "num_rounds"]:
+        if getattr(args, name) is None:
+            setattr(args, name, [getattr(defaults, name)])
+    no_of_products = len(bg.getData()[0])
+    tasks = makeTasks(args.negotiations, args.strategy, args.max_initial_discount_rate, args.min_profit_margin,
+                      args.num_rounds, args.max_iterations, args.seed, no_of_products, config)
+    # like results_for_plot_no_headers.csv, so that the gnuplot scripts can read the results directly
+    results = RecordWriter(args.results, RESULT_COLUMNS, header=False)
+    rounds = RecordWriter(args.rounds, ROUND_COLUMNS)
+
+    start = time.time()
+    count = 0
+    pool = multiprocessing.Pool(args.processes, initializer=loadCatalog)
+    try:
+        for result, negotiation_rounds in pool.imap_unordered(runNegotiation, tasks, chunksize=64):
+            results.write([result])
+            rounds.write(negotiation_rounds)
+            count += 1
+    finally:
+        pool.close()
+        pool.join()
+        results.close()
+        rounds.close()
+
+    print("%d negotiations in %.2f s on %d processes" % (count, time.time() - start, args.processes))
@@ -0,0 +1,187 @@
+'''
+Session keyed storage of negotiation state, so that any worker can serve any round of a negotiation
+'''
+
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+
+def dumpState(state):
+    '''
+    Parameters:
+        state   - dictionary of plain python values describing a negotiation
+    Returns:
+        the compressed serialized state
+    '''
+
+    return zlib.compress(json.dumps(state, separators=(',', ':')).encode("utf-8"))
+
+
+def loadState(data):
+    '''
+    Parameters:
+        data    - serialized state returned by dumpState
+    Returns:
+        state   - dictionary describing a negotiation
+    '''
+
+    return json.loads(zlib.decompress(data).decode("utf-8"))
+
+
+class MemoryStore:
+    def __init__(self, capacity=10000, ttl=3600):
+        '''
+        In-process store with least recently used eviction, only shared by the threads of one worker
+        Parameters:
+            capacity    - maximum number of negotiations kept
+            ttl         - seconds after the last update when a negotiation expires
+        '''
+
+        self.capacity = capacity
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, session_id):
+        with self.lock:
+            entry = self.sessions.pop(session_id, None)
+            if entry is None:
+                return None
+            if entry[0] + self.ttl < time.time():
+                return None
+            self.sessions[session_id] = entry
+        return loadState(entry[1])
+
+    def save(self, session_id, state):
+        data = dumpState(state)
+        with self.lock:
+            self.sessions.pop(session_id, None)
+            now = time.time()
+            self.sessions[session_id] = (now, data)
+            while len(self.sessions) > self.capacity:
+                self.sessions.popitem(last=False)
+            # the least recently saved come first, the expired ones are dropped rather than kept until evicted
+            while True:
+                oldest = next(iter(self.sessions))
+                if self.sessions[oldest][0] + self.ttl >= now:
+                    break
+                del self.sessions[oldest]
+
+    def delete(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+
+class SQLiteStore:
+    def __init__(self, path, ttl=3600, purge_interval=1000):
+        '''
+        Store backed by a SQLite file that all workers on the machine open
+        Parameters:
+            path            - path of the database file
+            ttl             - seconds after the last update when a negotiation expires
+            purge_interval  - number of saves between two purges of expired negotiations
+        '''
+
+        self.path = path
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self.saves = 0
+        self.local = threading.local()
+        # not kept open, the store may be created before gunicorn forks its workers
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS negotiations "
+                           "(session_id TEXT PRIMARY KEY, updated REAL NOT NULL, state BLOB NOT NULL)")
+        connection.commit()
+        connection.close()
+
+    def connection(self):
+        # sqlite connections can not be shared between threads
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            self.local.connection = connection
+        return connection
+
+    def load(self, session_id):
+        row = self.connection().execute("SELECT updated, state FROM negotiations WHERE session_id = ?",
+                                        (session_id,)).fetchone()
+        if row is None or row[0] + self.ttl < time.time():
+            return None
+        return loadState(bytes(row[1]))
+
+    def save(self, session_id, state):
+        connection = self.connection()
+        connection.execute("INSERT OR REPLACE INTO negotiations (session_id, updated, state) VALUES (?, ?, ?)",
+                           (session_id, time.time(), sqlite3.Binary(dumpState(state))))
+        self.saves += 1
+        if self.saves % self.purge_interval == 0:
+            connection.execute("DELETE FROM negotiations WHERE updated < ?", (time.time() - self.ttl,))
+        connection.commit()
+
+    def delete(self, session_id):
+        connection = self.connection()
+        connection.execute("DELETE FROM negotiations WHERE session_id = ?", (session_id,))
+        connection.commit()
+
+
+class RedisStore:
+    def __init__(self, url, ttl=3600, prefix="bargain:"):
+        '''
+        Store backed by any server speaking the Redis protocol
+        Parameters:
+            url     - redis:// url of the server
+            ttl     - seconds after the last update when a negotiation expires
+            prefix  - prefix of the keys holding negotiations
+        '''
+
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("RedisStore requires the redis package: pip install redis")
+
+        self.client = redis.StrictRedis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def load(self, session_id):
+        data = self.client.get(self.prefix + session_id)
+        if data is None:
+            return None
+        return loadState(data)
+
+    def save(self, session_id, state):
+        self.client.setex(self.prefix + session_id, self.ttl, dumpState(state))
+
+    def delete(self, session_id):
+        self.client.delete(self.prefix + session_id)
+
+
+def createStore(url=None, ttl=3600):
+    '''
+    Parameters:
+        url     - memory://, sqlite:///<path> or redis://<host>:<port>/<db>, read from
+                  BARGAIN_STORE when not given; defaults to a SQLite file in the temp directory
+        ttl     - seconds after the last update when a negotiation expires
+    Returns:
+        store   - the negotiation store
+    '''
+
+    if url is None:
+        url = os.environ.get("BARGAIN_STORE")
+    if not url:
+        url = "sqlite:///" + os.path.join(tempfile.gettempdir(), "bargain-negotiations.db")
+
+    if url.startswith("memory://"):
+        return MemoryStore(ttl=ttl)
+    if url.startswith("sqlite:///"):
+        return SQLiteStore(url[len("sqlite:///"):], ttl=ttl)
+    if url.startswith("redis://"):
+        return RedisStore(url, ttl=ttl)
+    raise ValueError("Unknown negotiation store %s" % url)